@@ -0,0 +1,75 @@
+import sys
+import json
+import time
+import tracemalloc
+from bs4 import BeautifulSoup
+
+sys.path.append("merchant_crawler")
+from jsonld_extractor import extract_json_ld_scripts, scan_json_ld_chunks, is_product_json_ld
+
+# saved search results that include the raw html of each page
+PAGES_FILE = "jsonresponses/products_with_jsonld.json"
+REPEAT = 20
+CHUNK_SIZE = 64 * 1024
+
+def bs4_scripts(html):
+    # what extract_json_ld used to do
+    soup = BeautifulSoup(html, "html.parser")
+    return [script.string for script in soup.find_all("script", type="application/ld+json")]
+
+def parse_all(scripts):
+    parsed = []
+    for script in scripts:
+        try:
+            parsed.append(json.loads(script))
+        except (json.JSONDecodeError, TypeError):
+            continue
+    return parsed
+
+def measure(function, page):
+    # cpu time per page
+    start = time.process_time()
+    for _ in range(REPEAT):
+        function(page)
+    cpu_ms = (time.process_time() - start) / REPEAT * 1000
+
+    # peak memory of a single run
+    tracemalloc.start()
+    function(page)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu_ms, peak / 1024 / 1024
+
+def main():
+    with open(PAGES_FILE, "r", encoding="utf-8") as f:
+        results = json.load(f)["results"]
+
+    pages = [result["html"] for result in results if result.get("html")]
+    print(f"Benchmarking {len(pages)} pages, {REPEAT} runs each\n")
+
+    for i, html in enumerate(pages):
+        page_bytes = html.encode("utf-8")
+        chunks = [page_bytes[j:j + CHUNK_SIZE] for j in range(0, len(page_bytes), CHUNK_SIZE)]
+
+        # output has to be the same as the BeautifulSoup version
+        same_output = parse_all(bs4_scripts(html)) == parse_all(extract_json_ld_scripts(page_bytes))
+
+        bs4_cpu, bs4_mem = measure(bs4_scripts, html)
+        scan_cpu, scan_mem = measure(extract_json_ld_scripts, page_bytes)
+
+        # how much of the page we read when stopping at the product JSON-LD
+        scanned = [0]
+        def counted_chunks():
+            for chunk in chunks:
+                scanned[0] += len(chunk)
+                yield chunk
+        _, stopped_early = scan_json_ld_chunks(counted_chunks(), stop_when=is_product_json_ld)
+
+        print(f"Page {i} - {len(page_bytes) / 1024:.0f} KB - same output: {same_output}")
+        print(f"  BeautifulSoup: {bs4_cpu:8.2f} ms cpu  {bs4_mem:8.2f} MB peak")
+        print(f"  Scanner:       {scan_cpu:8.2f} ms cpu  {scan_mem:8.2f} MB peak")
+        print(f"  Speedup: {bs4_cpu / scan_cpu:.0f}x cpu, {bs4_mem / scan_mem:.0f}x memory")
+        print(f"  Early stop: {stopped_early} - read {scanned[0] / 1024:.0f} of {len(page_bytes) / 1024:.0f} KB\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+import os
+import csv
+import json
+import time
+import argparse
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+
+SNAPSHOT_PATH = "catalogue_snapshot.arrow"
+
+# columns of the Vision Product Search bulk import, in order
+VISION_COLUMNS = [
+    "image_uri",
+    "image_id",
+    "product_set_id",
+    "product_id",
+    "product_category",
+    "product_display_name",
+    "labels",
+    "bounding_poly"
+]
+# extra column written by csv_to_gcs_bucket.py, kept in the snapshot when present
+WEBSITE_IMAGE_COLUMN = "website_image_link"
+# every label of a row in order, as list<struct<key, value>> (the key is null for a label that isn't
+# "key=value"), exported as they are
+LABEL_PAIRS_COLUMN = "label_pairs"
+# the value of a "key=value" label is also stored in the column LABEL_PREFIX + key (the first one
+# for a repeated key), to filter and group on
+LABEL_PREFIX = "label_"
+# labels that weren't "key=value", only in snapshots from before LABEL_PAIRS_COLUMN
+UNPARSED_LABELS_COLUMN = "labels_unparsed"
+# low-cardinality columns, stored once per distinct value
+DICTIONARY_COLUMNS = ["product_set_id", "product_category"]
+# rows per record batch, also the unit of the CSV export
+BATCH_ROWS = 65536
+
+LABEL_PAIR_TYPE = pa.struct([("key", pa.string()), ("value", pa.string())])
+
+def _scatter(values: pa.Array, rows: np.ndarray, length: int) -> pa.Array:
+    # values[i] placed at rows[i] of an array of nulls (the first value wins for a repeated row)
+    positions = np.full(length, -1, dtype=np.int64)
+    positions[rows[::-1]] = np.arange(len(rows))[::-1]
+    return pc.take(values, pa.array(positions, mask=positions < 0))
+
+def split_labels(labels: pa.ChunkedArray) -> tuple:
+    """
+    Split the packed "color=BLACK,size=2XL" labels into their pairs and one column per key
+
+    A label without "=" continues the value of the label before it ("color=BLACK, WHITE" is the
+    color "BLACK, WHITE"), one before the first "key=value" is kept with a null key.
+
+    Args:
+        labels (pa.ChunkedArray): Packed labels, null or empty for none
+
+    Returns:
+        tuple: ({key: string column of its first value} with keys in order of first appearance,
+            list<struct<key, value>> column of the labels in order, null for rows without any)
+    """
+    labels = labels.combine_chunks()
+    pieces = pc.split_pattern(labels, ",")
+    flat_pieces = pc.list_flatten(pieces)
+    rows = pc.list_parent_indices(pieces).to_numpy()
+    parsed = pc.extract_regex(flat_pieces, r"^\s*(?P<key>[^=]*?)\s*=\s*(?P<value>.*?)\s*$")
+    keys = pc.struct_field(parsed, "key")
+    trimmed = pc.utf8_trim_whitespace(flat_pieces)
+
+    is_pair = pc.fill_null(pc.not_equal(keys, ""), False).to_numpy(zero_copy_only=False)
+    # blank pieces ("a=1,,b=2") are dropped
+    blank = pc.equal(trimmed, "").to_numpy(zero_copy_only=False)
+    # the last pair at or before every piece, a piece continues it if it's in the same row
+    last_pair = np.maximum.accumulate(np.where(is_pair, np.arange(len(rows)), -1)) if len(rows) else rows
+    continues = ~is_pair & ~blank & (last_pair >= 0) & (rows[last_pair] == rows)
+    is_label = is_pair | (~blank & ~continues)
+
+    label_keys = pc.if_else(is_pair, keys, pa.scalar(None, pa.string()))
+    label_values = pc.if_else(is_pair, pc.struct_field(parsed, "value"), trimmed)
+    if continues.any():
+        values = label_values.to_pylist()
+        tails = pc.utf8_rtrim_whitespace(flat_pieces).to_pylist()
+        for index in np.flatnonzero(continues):
+            values[last_pair[index]] += "," + tails[index]
+        label_values = pa.array(values, pa.string())
+
+    mask = pa.array(is_label)
+    label_keys, label_values = pc.filter(label_keys, mask), pc.filter(label_values, mask)
+    label_rows = rows[is_label]
+
+    counts = np.bincount(label_rows, minlength=len(labels))
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int32)
+    pairs = pa.ListArray.from_arrays(
+        pa.array(offsets),
+        pa.StructArray.from_arrays([label_keys, label_values], fields=list(LABEL_PAIR_TYPE)),
+        mask=pa.array(counts == 0)
+    )
+
+    columns = {}
+    for key in pc.unique(pc.drop_null(label_keys)).to_pylist():
+        selected = pc.fill_null(pc.equal(label_keys, key), False)
+        key_rows = label_rows[selected.to_numpy(zero_copy_only=False)]
+        columns[key] = _scatter(pc.filter(label_values, selected), key_rows, len(labels))
+    return columns, pairs
+
+def join_label_pairs(pairs: pa.ChunkedArray) -> pa.ChunkedArray:
+    """
+    Pack the label pairs back into "color=BLACK,size=2XL" strings, labels without a key as they are
+    """
+    chunks = []
+    for chunk in pairs.chunks:
+        # the offsets of a sliced chunk point into its unsliced values
+        labels = chunk.values
+        keys, values = pc.struct_field(labels, "key"), pc.struct_field(labels, "value")
+        pieces = pc.coalesce(pc.binary_join_element_wise(keys, values, "="), values)
+        # (from_arrays can't take a null mask with the offsets of a slice, rows without labels are nulled after)
+        joined = pc.binary_join(pa.ListArray.from_arrays(chunk.offsets, pieces), ",")
+        chunks.append(pc.if_else(chunk.is_null(), pa.scalar(None, pa.string()), joined))
+    return pa.chunked_array(chunks, pa.string())
+
+def join_labels(table: pa.Table, label_keys: list) -> pa.ChunkedArray:
+    """
+    Pack the label columns of a snapshot from before LABEL_PAIRS_COLUMN back into
+    "color=BLACK,size=2XL" strings, the unparsed labels last
+    """
+    parts = [
+        pc.binary_join_element_wise(key, pc.cast(table[LABEL_PREFIX + key], pa.string()), "=")
+        for key in label_keys
+    ]
+    if UNPARSED_LABELS_COLUMN in table.column_names:
+        parts.append(table[UNPARSED_LABELS_COLUMN])
+    if not parts:
+        return pa.chunked_array([pa.nulls(table.num_rows, pa.string())])
+    # "part," for every part present, keys without a value are left out (null_handling="skip"
+    # can't be used, it drops the rows whose parts are all null). Labels never contain ","
+    pieces = [pc.fill_null(pc.binary_join_element_wise(part, "", ","), "") for part in parts]
+    joined = pc.utf8_rtrim(pc.binary_join_element_wise(*pieces, ""), characters=",")
+    # rows without any label stay null
+    return pc.if_else(pc.equal(joined, ""), None, joined)
+
+def label_keys_of(table_or_schema) -> list:
+    metadata = table_or_schema.schema.metadata if isinstance(table_or_schema, pa.Table) else table_or_schema.metadata
+    return json.loads(metadata[b"label_keys"]) if metadata and b"label_keys" in metadata else []
+
+def read_catalogue_csv(path: str, header: bool = True) -> pa.Table:
+    """
+    Read a catalogue CSV in the Vision import format, every field as a string and empty fields as nulls
+
+    Args:
+        path (str): CSV path
+        header (bool): The first row names the columns, otherwise the columns are VISION_COLUMNS
+    """
+    string_columns = VISION_COLUMNS + [WEBSITE_IMAGE_COLUMN]
+    return pcsv.read_csv(
+        path,
+        read_options=pcsv.ReadOptions(column_names=None if header else VISION_COLUMNS),
+        convert_options=pcsv.ConvertOptions(
+            column_types={column: pa.string() for column in string_columns},
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=True,
+            null_values=[""]
+        )
+    )
+
+def catalogue_to_snapshot_table(table: pa.Table) -> pa.Table:
+    """
+    Columnar snapshot of a catalogue: labels kept as pairs and split into typed columns, low-cardinality
+    columns dictionary encoded
+    """
+    labels, pairs = split_labels(table["labels"]) if "labels" in table.column_names else ({}, None)
+
+    columns = {}
+    for name in table.column_names:
+        if name == "labels":
+            continue
+        column = table[name]
+        if name in DICTIONARY_COLUMNS:
+            column = pc.dictionary_encode(column)
+        columns[name] = column
+    if pairs is not None:
+        columns[LABEL_PAIRS_COLUMN] = pairs
+    for key, values in labels.items():
+        columns[LABEL_PREFIX + key] = pc.dictionary_encode(values)
+
+    snapshot = pa.table(columns)
+    # the key order, so exported labels come out as they went in
+    return snapshot.replace_schema_metadata({"label_keys": json.dumps(list(labels))})
+
+def write_snapshot(table: pa.Table, path: str = SNAPSHOT_PATH, batch_rows: int = BATCH_ROWS):
+    """
+    Write a snapshot as an Arrow IPC file
+
+    The file is left uncompressed, so it can be memory-mapped and read without copying.
+    """
+    table = table.unify_dictionaries()
+    with pa.OSFile(path + ".part", "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=batch_rows)
+    # a reader never sees a half-written snapshot
+    os.replace(path + ".part", path)
+
+def build_snapshot(csv_paths: list, path: str = SNAPSHOT_PATH, header: bool = True) -> pa.Table:
+    """
+    Build the snapshot of one or more catalogue CSVs (with the same columns)
+
+    Args:
+        csv_paths (list): Catalogue CSVs in the Vision import format
+        path (str): Snapshot path
+        header (bool): The CSVs start with a header row
+
+    Returns:
+        pa.Table: The snapshot
+    """
+    start_time = time.time()
+    table = pa.concat_tables([read_catalogue_csv(csv_path, header=header) for csv_path in csv_paths])
+    snapshot = catalogue_to_snapshot_table(table)
+    write_snapshot(snapshot, path)
+    print(f"Snapshot of {snapshot.num_rows} products written to {path} in {time.time() - start_time:.2f}s")
+    return snapshot
+
+def load_snapshot(path: str = SNAPSHOT_PATH, columns: list = None) -> pa.Table:
+    """
+    Memory-map a snapshot, only the pages of the columns actually used are read from disk
+
+    Args:
+        path (str): Snapshot path
+        columns (list): Columns to keep (column projection), all of them if None
+
+    Returns:
+        pa.Table: Table backed by the mapped file
+    """
+    with pa.memory_map(path, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+    if columns is not None:
+        table = table.select(columns)
+    return table
+
+def export_csv(table: pa.Table, output_csv: str, header: bool = False, batch_rows: int = BATCH_ROWS) -> int:
+    """
+    Write a snapshot as a Vision Product Search import CSV
+
+    Args:
+        table (pa.Table): Snapshot (from load_snapshot)
+        output_csv (str): CSV path
+        header (bool): Write the header row (the Vision import expects none)
+        batch_rows (int): Rows converted at a time
+
+    Returns:
+        int: Amount of rows written
+    """
+    label_keys = label_keys_of(table)
+    rows = 0
+    with open(output_csv, "w", newline="", encoding="utf-8") as f:
+        # minimal quoting, like the CSVs written with pandas (pyarrow's writer quotes every string)
+        writer = csv.writer(f, lineterminator="\n")
+        if header:
+            writer.writerow(VISION_COLUMNS)
+        for batch in table.to_batches(max_chunksize=batch_rows):
+            batch_table = pa.Table.from_batches([batch])
+            columns = []
+            for name in VISION_COLUMNS:
+                if name == "labels" and LABEL_PAIRS_COLUMN in batch_table.column_names:
+                    columns.append(join_label_pairs(batch_table[LABEL_PAIRS_COLUMN]).to_pylist())
+                elif name == "labels":
+                    columns.append(join_labels(batch_table, label_keys).to_pylist())
+                elif name in batch_table.column_names:
+                    columns.append(pc.cast(batch_table[name], pa.string()).to_pylist())
+                else:
+                    columns.append([None] * batch.num_rows)
+            writer.writerows(zip(*columns))
+            rows += batch.num_rows
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar (Arrow IPC) snapshot of the catalogue CSVs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="Build the snapshot of catalogue CSVs")
+    build.add_argument("csv", nargs="+")
+    build.add_argument("--snapshot", default=SNAPSHOT_PATH)
+    build.add_argument("--no-header", action="store_true", help="The CSVs have no header row")
+
+    export = subparsers.add_parser("export", help="Write the snapshot as a Vision import CSV")
+    export.add_argument("output")
+    export.add_argument("--snapshot", default=SNAPSHOT_PATH)
+    export.add_argument("--header", action="store_true")
+
+    info = subparsers.add_parser("info", help="Show the columns of the snapshot")
+    info.add_argument("--snapshot", default=SNAPSHOT_PATH)
+
+    args = parser.parse_args()
+    if args.command == "build":
+        build_snapshot(args.csv, args.snapshot, header=not args.no_header)
+    elif args.command == "export":
+        start_time = time.time()
+        rows = export_csv(load_snapshot(args.snapshot), args.output, header=args.header)
+        print(f"Exported {rows} products to {args.output} in {time.time() - start_time:.2f}s")
+    else:
+        table = load_snapshot(args.snapshot)
+        print(f"{table.num_rows} products, {table.nbytes / 1e6:.1f} MB, label keys: {label_keys_of(table)}")
+        print(table.schema.remove_metadata())
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,98 @@
+import time
+import argparse
 import pandas as pd
 
-FILE_PATH = "updated_demo_product_images-noweblink.csv"
+# output of csv_to_gcs_bucket.py, image_uri points to the bucket copy
+FILE_PATH = "updated_demo_product_images.csv"
 BUCKET_NAME = "demo-product-seekeasy-images"
 OUTPUT_FILE_PATH = "updated_demo_product_images_noweblink_gsutil.csv"
+NOHEADER_FILE_PATH = "demo_product_files_noheader.csv"
 
-def transfrom_image_uri(image_uri):
-
-    image_name = image_uri.split("/")[-1]
-    return f"gs://{BUCKET_NAME}/{image_name}"
-
-def clean_labels(label_str):
-    if not isinstance(label_str, str):
-        return ""  # or return None if there's no label string
-    # Remove trailing or leading commas/spaces
-    cleaned = label_str.strip().strip(",")
-
-    # Remove any spaces
-    cleaned = cleaned.replace(" ", "")
-    return cleaned
+# rows read, transformed and written at a time
+CHUNK_ROWS = 100000
 
+# columns of the Vision Product Search bulk import, in order (website_image_link is left out)
+VISION_COLUMNS = [
+    "image_uri",
+    "image_id",
+    "product_set_id",
+    "product_id",
+    "product_category",
+    "product_display_name",
+    "labels",
+    "bounding_poly"
+]
 
 """
 gs://[BUCKET_NAME]/[OBJECT_NAME]
-Error on index 825: Invalid GCS path specified: 
+Error on index 825: Invalid GCS path specified:
 
 https://storage.googleapis.com/demo-product-seekeasy-images/15231834_hi
 
 example: gs://demo-product-seekeasy-images/11552290_hi
 """
 
-df = pd.read_csv(FILE_PATH)
+def transform_image_uri(image_uris: pd.Series) -> pd.Series:
+    # gs:// path of the object, named after the last segment of the URL
+    image_names = image_uris.str.rsplit("/", n=1).str[-1]
+    return f"gs://{BUCKET_NAME}/" + image_names
+
+def clean_labels(labels: pd.Series) -> pd.Series:
+    # Remove trailing or leading commas/spaces, then any spaces
+    return labels.str.strip().str.strip(",").str.replace(" ", "", regex=False)
+
+# every output written in the single pass over the input:
+# (path, header row, {column: transform}), columns without a transform are copied as is
+OUTPUTS = [
+    # what importProductstoML.py imports, the Vision import expects no header
+    (NOHEADER_FILE_PATH, False, {"image_uri": transform_image_uri}),
+    (OUTPUT_FILE_PATH, True, {"image_uri": transform_image_uri, "labels": clean_labels}),
+]
+
+def transform_catalogue(
+    input_path: str = FILE_PATH,
+    outputs: list = OUTPUTS,
+    columns: list = VISION_COLUMNS,
+    chunk_rows: int = CHUNK_ROWS
+) -> int:
+    """
+    Write every output of the catalogue CSV in one chunked read-transform-write pass
+
+    Args:
+        input_path (str): Catalogue CSV with a header row
+        outputs (list): (path, header, {column: transform}) of every output
+        columns (list): Columns kept, in output order
+        chunk_rows (int): Rows held in memory at once
 
-# export to csv with out header
-df.to_csv(f"demo_product_files_noheader.csv", index=False, header=False)
+    Returns:
+        int: Amount of rows transformed
+    """
+    files = [open(path, "w", newline="", encoding="utf-8") for path, _, _ in outputs]
+    rows = 0
+    start_time = time.time()
+    try:
+        # every field stays a string (SKUs keep leading zeros, empty ones stay empty)
+        chunks = pd.read_csv(input_path, usecols=columns, dtype=str, keep_default_na=False, chunksize=chunk_rows)
+        for chunk in chunks:
+            chunk = chunk[columns]
+            for file, (_, header, transforms) in zip(files, outputs):
+                output = chunk.assign(**{column: transform(chunk[column]) for column, transform in transforms.items()})
+                output.to_csv(file, index=False, header=header and rows == 0)
+            rows += len(chunk)
+    finally:
+        for file in files:
+            file.close()
 
-# df["image_uri"] = df["image_uri"].apply(transfrom_image_uri)
+    print(f"Transformed {rows} rows in {time.time() - start_time:.1f}s into {', '.join(path for path, _, _ in outputs)}")
+    return rows
 
-# df["labels"] = df["labels"].apply(clean_labels)
+def main():
+    parser = argparse.ArgumentParser(description="Write the Vision Product Search import CSVs of a mirrored catalogue CSV")
+    parser.add_argument("--input", default=FILE_PATH)
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    args = parser.parse_args()
 
-# print(df.head(3))
-# df.to_csv(OUTPUT_FILE_PATH, index=False)
+    transform_catalogue(args.input, chunk_rows=args.chunk_rows)
 
+if __name__ == "__main__":
+    main()
@@ -1,69 +1,226 @@
 import os
+import csv
+import shutil
+import time
+import argparse
 import requests
-import pandas as pd
-from google.cloud import storage
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import quote
+from urllib3.util.retry import Retry
 from uuid import uuid4
 
 # Global configuration
 BUCKET_NAME = "demo-product-seekeasy-images"
 INPUT_CSV = "top1000_firebase_products.csv"
 OUTPUT_CSV = "updated_demo_product_images.csv"
+# rows whose image could not be mirrored, kept out of OUTPUT_CSV
+REJECTS_CSV = "rejected_demo_product_images.csv"
 
-def get_gcs_client():
-    """Initialize and return a Google Cloud Storage client."""
-    return storage.Client()
+# images downloaded / uploaded at once
+MIRROR_WORKERS = 32
+# bytes copied at a time when streaming to a local file
+CHUNK_SIZE = 256 * 1024
+# resumable upload chunk (multiple of 256 KB) for bodies of unknown size, the library default buffers 100 MB
+UPLOAD_CHUNK_SIZE = 4 * CHUNK_SIZE
+PROGRESS_EVERY = 1000
 
-def upload_image_to_gcs(image_url: str, bucket_name: str, blob_name: str) -> str:
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
+}
+
+class GCSBackend:
+    def __init__(self, bucket_name: str):
+        """
+        Google Cloud Storage bucket, one client shared by every upload
+        """
+        from google.cloud import storage
+
+        self.client = storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+
+    def existing_names(self) -> set:
+        # one paginated listing instead of a HEAD request per image
+        return {blob.name for blob in self.client.list_blobs(self.bucket)}
+
+    def url(self, name: str) -> str:
+        return f"https://storage.googleapis.com/{self.bucket.name}/{quote(name)}"
+
+    def upload(self, name: str, stream, content_type: str, size: int = None) -> str:
+        blob = self.bucket.blob(name, chunk_size=UPLOAD_CHUNK_SIZE)
+        # with a known size small images go in one multipart request, others are sent in resumable chunks
+        blob.upload_from_file(stream, content_type=content_type, size=size, rewind=False)
+        return blob.public_url
+
+class LocalBackend:
+    def __init__(self, directory: str):
+        """
+        Local directory standing in for the bucket (for testing)
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def existing_names(self) -> set:
+        return {name for name in os.listdir(self.directory) if not name.endswith(".part")}
+
+    def url(self, name: str) -> str:
+        return os.path.abspath(os.path.join(self.directory, name))
+
+    def upload(self, name: str, stream, content_type: str, size: int = None) -> str:
+        path = os.path.join(self.directory, name)
+        # written under a temporary name so a crash never leaves a truncated image behind
+        with open(path + ".part", "wb") as f:
+            shutil.copyfileobj(stream, f, CHUNK_SIZE)
+        os.replace(path + ".part", path)
+        return self.url(name)
+
+def create_session(workers: int) -> requests.Session:
+    """
+    Pooled session for the image downloads, transient errors are retried
+    """
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",))
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(HEADERS)
+    return session
+
+def blob_name_for(image_url: str) -> str:
+    # Derive a filename from the URL
+    file_name = os.path.basename(image_url.split("?", 1)[0])
+    if not file_name:
+        # Fallback if no basename is found
+        # needs to be unique
+        file_name = f"uploaded_image_{uuid4().hex[:5]}.jpg"
+    return file_name
+
+def mirror_image(image_url: str, name: str, backend, session: requests.Session) -> tuple:
+    """
+    Stream an image from `image_url` to the backend as `name`
+
+    Returns:
+        tuple: (status, detail) - "uploaded" with the mirrored URL, "failed" with the error
+    """
+    try:
+        with session.get(image_url, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            # the body is streamed straight into the upload, never held in full
+            response.raw.decode_content = True
+            length = response.headers.get("Content-Length")
+            size = int(length) if length and "Content-Encoding" not in response.headers else None
+            url = backend.upload(
+                name,
+                response.raw,
+                content_type=response.headers.get("Content-Type", "application/octet-stream"),
+                size=size
+            )
+        return "uploaded", url
+    except Exception as e:
+        print(f"Error mirroring {image_url}: {e}")
+        return "failed", str(e)
+
+def _done(result: tuple) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+def mirror_csv(
+    input_csv: str,
+    output_csv: str,
+    backend,
+    workers: int = MIRROR_WORKERS,
+    rejects_csv: str = REJECTS_CSV
+) -> dict:
     """
-    Fetches an image from `image_url` and uploads it to the specified GCS bucket.
-    Returns the public GCS URL of the uploaded object.
+    Mirror the images of a catalogue CSV to a bucket and write the CSV pointing to the copies
+
+    The CSV is streamed: at most 2 * workers rows are in flight, and rows are written in
+    input order as soon as their image is mirrored. Every object name is uploaded once,
+    rows sharing it wait for the same upload. Rows whose image failed are written to
+    `rejects_csv` instead, so the output only points to images that are in the bucket.
+
+    Args:
+        input_csv (str): CSV with an `image_uri` column
+        output_csv (str): CSV written with `image_uri` replaced and the original in `website_image_link`
+        backend: GCSBackend or LocalBackend
+        workers (int): Images mirrored at once
+        rejects_csv (str): CSV of the rows that failed, with the error in `error`
+
+    Returns:
+        dict: Amount of images uploaded, skipped (already in the bucket or uploaded for an earlier row) and failed
     """
-    storage_client = get_gcs_client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
-    }
-    # Download image from the URL
-    response = requests.get(image_url, stream=True, headers=headers)
-    response.raise_for_status()  # raise an exception if the download failed
-
-    # Upload the content to GCS
-    # You could also detect or explicitly set a more accurate content type if desired
-    blob.upload_from_string(
-        response.content,
-        content_type=response.headers.get('Content-Type', 'application/octet-stream')
-    )
-
-    return blob.public_url
+    counts = {"uploaded": 0, "skipped": 0, "failed": 0}
+    existing = backend.existing_names()
+    print(f"Objects already in the bucket: {len(existing)}")
+
+    session = create_session(workers)
+    start_time = time.time()
+
+    with open(input_csv, newline="", encoding="utf-8") as input_file, \
+            open(output_csv, "w", newline="", encoding="utf-8") as output_file, \
+            open(rejects_csv, "w", newline="", encoding="utf-8") as rejects_file, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        reader = csv.DictReader(input_file)
+        writer = csv.DictWriter(output_file, fieldnames=reader.fieldnames + ["website_image_link"])
+        writer.writeheader()
+        rejects_writer = csv.DictWriter(rejects_file, fieldnames=reader.fieldnames + ["error"])
+        rejects_writer.writeheader()
+
+        pending = deque()
+        # {object name: future of its upload}, names are claimed here on the reading thread only
+        uploads = {}
+
+        def write_next():
+            row, future, first = pending.popleft()
+            status, detail = future.result()
+            if status == "uploaded" and not first:
+                status = "skipped"
+            counts[status] += 1
+            if status == "failed":
+                row["error"] = detail
+                rejects_writer.writerow(row)
+            else:
+                # Keep the original URL, point image_uri at the copy
+                row["website_image_link"] = row["image_uri"]
+                row["image_uri"] = detail
+                writer.writerow(row)
+
+            done = sum(counts.values())
+            if done % PROGRESS_EVERY == 0:
+                print(f"{done} images - {counts} - {done / (time.time() - start_time):.1f}/s")
+
+        for row in reader:
+            name = blob_name_for(row["image_uri"])
+            if name in existing:
+                pending.append((row, _done(("skipped", backend.url(name))), False))
+            elif name in uploads:
+                pending.append((row, uploads[name], False))
+            else:
+                uploads[name] = executor.submit(mirror_image, row["image_uri"], name, backend, session)
+                pending.append((row, uploads[name], True))
+            # bounded read-ahead, the CSV is never loaded in full
+            if len(pending) >= 2 * workers:
+                write_next()
+        while pending:
+            write_next()
+
+    print(f"Mirrored {sum(counts.values())} images in {time.time() - start_time:.1f}s: {counts}")
+    return counts
 
 def main():
-    # Read the CSV as a pandas DataFrame
-    df = pd.read_csv(INPUT_CSV)
-
-    # Create a new column `website_image_link` to hold the original URLs
-    df["website_image_link"] = df["image_uri"]
-
-    # Function to process a single image link
-    def process_image_url(image_url):
-        # Derive a filename from the URL
-        file_name = os.path.basename(image_url)
-        if not file_name:
-            # Fallback if no basename is found
-            # needs to be unique
-            file_name = f"uploaded_image_{uuid4().hex[:5]}.jpg"
-        
-        # Upload the image and return the GCS URL
-        new_url = upload_image_to_gcs(image_url, BUCKET_NAME, file_name)
-        return new_url
-
-    # Apply the upload process to each row in `image_uri`
-    df["image_uri"] = df["image_uri"].apply(process_image_url)
-
-    # Save the updated DataFrame to a new CSV
-    df.to_csv(OUTPUT_CSV, index=False)
-    print(f"Finished! The updated CSV has been written to {OUTPUT_CSV}")
+    parser = argparse.ArgumentParser(description="Mirror the images of a catalogue CSV to a GCS bucket (or a local directory)")
+    parser.add_argument("--input", default=INPUT_CSV)
+    parser.add_argument("--output", default=OUTPUT_CSV)
+    parser.add_argument("--rejects", default=REJECTS_CSV, help="CSV of the rows whose image could not be mirrored")
+    parser.add_argument("--bucket", default=BUCKET_NAME)
+    parser.add_argument("--local-dir", help="Mirror to this directory instead of the bucket")
+    parser.add_argument("--workers", type=int, default=MIRROR_WORKERS)
+    args = parser.parse_args()
+
+    backend = LocalBackend(args.local_dir) if args.local_dir else GCSBackend(args.bucket)
+    mirror_csv(args.input, args.output, backend, workers=args.workers, rejects_csv=args.rejects)
+    print(f"Finished! The updated CSV has been written to {args.output}")
 
 if __name__ == "__main__":
     main()
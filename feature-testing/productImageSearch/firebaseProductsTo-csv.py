@@ -1,115 +1,347 @@
+import os
 import csv
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
 
+# Path to your Firebase Admin service account JSON file
+SERVICE_ACCOUNT_PATH = "credentials/bag-haven-qt9s4v-firebase-adminsdk-h9x05-e584032402.json"
+OUTPUT_DIR = "all_firebase_products"
+PRODUCT_SET_ID = "visualsearch-demo-product-set"
+
+# document id ranges read at once
+EXPORT_PARTITIONS = 16
+# documents fetched per query, only one page per partition is held in memory
+PAGE_SIZE = 1000
+# rows per CSV file, each partition writes its own sequence of shards
+ROWS_PER_SHARD = 100000
+CHECKPOINT_FILE = "checkpoint.json"
+
+# Define the CSV columns in the correct order
+CSV_HEADERS = [
+    "image_uri",         # (1) image URI
+    "image_id",          # (2) optional, can leave blank or set unique value
+    "product_set_id",    # (3) product set ID in Product Search
+    "product_id",        # (4) your internal product ID
+    "product_category",  # (5) 'general', 'apparel', etc.
+    "product_display_name",  # (6) optional
+    "labels",            # (7) optional comma-delimited key=value pairs
+    "bounding_poly"      # (8) optional
+]
+
+def product_to_row(data: dict, doc_id: str, product_set_id: str, product_category: str) -> list:
+    """
+    Map a Firestore product to a Vision Product Search bulk import row
+    """
+    # (1) image_uri: pick 'image' or 'baseImage' from your data
+    image_uri = data.get("image") or data.get("baseImage") or ""
+
+    # (2) image_id: optional. Using 'sku' or leave it blank
+    image_id = data.get("sku", "")
+
+    # (4) product_id: from 'productId', or fallback to Firestore doc ID
+    prod_id = data.get("productId", doc_id)
+
+    # (6) product_display_name: 'name' or 'baseName'
+    display_name = data.get("name") or data.get("baseName") or ""
+
+    # (7) labels: e.g. "color=BLACK,size=2XL"
+    label_parts = []
+    if data.get("color"):
+        label_parts.append(f"color={data.get('color')}")
+    if data.get("size"):
+        label_parts.append(f"size={data.get('size')}")
+    labels = ",".join(label_parts)
+
+    # (8) bounding_poly: leave blank unless you have bounding boxes
+    bounding_poly = ""
+
+    return [
+        image_uri,
+        image_id,
+        product_set_id,
+        prod_id,
+        product_category,
+        display_name,
+        labels,
+        bounding_poly
+    ]
+
+def partition_bounds(db, collection_name: str, partitions: int) -> list:
+    """
+    Split a collection into contiguous document id ranges of about the same size
+
+    The split points are ids of actual documents, picked by Firestore (a partition
+    query), so the ranges stay balanced whatever the ids look like (auto ids, uuids).
+    The first range is open at the start and the last one at the end.
+
+    Returns:
+        list: [start, end) id bounds of every partition, None for an open end
+    """
+    cuts = set()
+    if partitions > 1:
+        # Firestore may return fewer partitions than asked for (small collections). Only collection
+        # groups can be partitioned, the group also holds the subcollections named like the root
+        # collection (e.g. products/{id}/products), their split points are not ids of the root collection
+        for partition in db.collection_group(collection_name).get_partitions(partitions):
+            if partition.end_at is not None and partition.end_at.path == f"{collection_name}/{partition.end_at.id}":
+                cuts.add(partition.end_at.id)
+    cuts = sorted(cuts)
+    return list(zip([None] + cuts, cuts + [None]))
+
+def load_checkpoint(path: str, db, collection_name: str, partitions: int) -> dict:
+    """
+    Load the export checkpoint, or start a new one
+
+    The partition bounds are part of the checkpoint, so a resumed export reads the
+    same ranges even if a different amount of partitions is asked for.
+    """
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        if checkpoint["collection"] != collection_name:
+            raise ValueError(f"{path} is the checkpoint of an export of '{checkpoint['collection']}'")
+        return checkpoint
+
+    return {
+        "collection": collection_name,
+        "partitions": [
+            {
+                "start": start,
+                "end": end,
+                # last document exported, the next page starts after it
+                "lastId": None,
+                "done": False,
+                "rows": 0,
+                "shard": 0,
+                # size of the current shard when lastId was exported, anything after it is dropped on resume
+                "shardBytes": 0,
+                "shardRows": 0,
+            }
+            for start, end in partition_bounds(db, collection_name, partitions)
+        ],
+    }
+
+def save_checkpoint(path: str, checkpoint: dict):
+    # written under a temporary name so an interrupted export never leaves a truncated checkpoint
+    with open(path + ".part", "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(path + ".part", path)
+
+def shard_path(output_dir: str, partition: int, shard: int) -> str:
+    return os.path.join(output_dir, f"products-{partition:05d}-{shard:04d}.csv")
+
+def partition_query(collection, start: str, end: str, after: str, page_size: int):
+    """
+    Next page of a partition, ordered by document id
+    """
+    document_id = firestore.FieldPath.document_id()
+    query = collection.order_by(document_id)
+    if start is not None:
+        query = query.where(filter=firestore.FieldFilter(document_id, ">=", collection.document(start)))
+    if end is not None:
+        query = query.where(filter=firestore.FieldFilter(document_id, "<", collection.document(end)))
+    if after is not None:
+        # cursor pagination, no documents are skipped over with an offset
+        query = query.start_after({document_id: collection.document(after)})
+    return query.limit(page_size)
+
+class ShardWriter:
+    def __init__(self, output_dir: str, index: int, state: dict, rows_per_shard: int, header: bool):
+        """
+        CSV shards of a partition, reopened where the checkpoint left them
+        """
+        self.output_dir = output_dir
+        self.index = index
+        self.state = state
+        self.rows_per_shard = rows_per_shard
+        self.header = header
+        self.file = None
+        self.writer = None
+
+    def open(self):
+        path = shard_path(self.output_dir, self.index, self.state["shard"])
+        if self.state["shardBytes"] and os.path.exists(path):
+            # rows written after the last checkpoint are exported again, drop them
+            self.file = open(path, "r+", newline="", encoding="utf-8")
+            self.file.truncate(self.state["shardBytes"])
+            self.file.seek(self.state["shardBytes"])
+        else:
+            self.file = open(path, "w", newline="", encoding="utf-8")
+            self.state["shardRows"] = 0
+        self.writer = csv.writer(self.file)
+        if self.header and self.file.tell() == 0:
+            self.writer.writerow(CSV_HEADERS)
+
+    def write(self, row: list):
+        if self.file is None:
+            self.open()
+        elif self.state["shardRows"] >= self.rows_per_shard:
+            self.file.close()
+            self.state["shard"] += 1
+            self.state["shardBytes"] = 0
+            self.open()
+        self.writer.writerow(row)
+        self.state["shardRows"] += 1
+        self.state["rows"] += 1
+
+    def sync(self):
+        # the rows are on disk before the checkpoint points past them
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.state["shardBytes"] = self.file.tell()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def export_partition(
+    db,
+    collection_name: str,
+    index: int,
+    state: dict,
+    output_dir: str,
+    product_set_id: str,
+    product_category: str,
+    page_size: int,
+    rows_per_shard: int,
+    header: bool,
+    save_progress
+) -> int:
+    """
+    Export one key range page by page, checkpointing after every page
+
+    Returns:
+        int: Amount of rows exported by this run
+    """
+    collection = db.collection(collection_name)
+    # the checkpoint only sees the progress of whole pages, once they are on disk
+    progress = dict(state)
+    shards = ShardWriter(output_dir, index, progress, rows_per_shard, header)
+    exported = 0
+    try:
+        while not progress["done"]:
+            last_id = None
+            page_rows = 0
+            for doc in partition_query(collection, progress["start"], progress["end"], progress["lastId"], page_size).stream():
+                shards.write(product_to_row(doc.to_dict(), doc.id, product_set_id, product_category))
+                last_id = doc.id
+                page_rows += 1
+
+            shards.sync()
+            if last_id is not None:
+                progress["lastId"] = last_id
+            # a short page is the last one of the range
+            progress["done"] = page_rows < page_size
+            exported += page_rows
+            save_progress(state, progress)
+    finally:
+        shards.close()
+    return exported
+
 def export_products_to_csv(
     service_account_path: str,
     collection_name: str = "products",
-    output_csv: str = "products.csv",
+    output_dir: str = OUTPUT_DIR,
     product_set_id: str = "my_product_set_id",
-    product_category: str = "general"
-):
+    product_category: str = "general",
+    partitions: int = EXPORT_PARTITIONS,
+    page_size: int = PAGE_SIZE,
+    rows_per_shard: int = ROWS_PER_SHARD,
+    header: bool = True,
+    db=None
+) -> int:
     """
-    Exports all documents from a Firebase Firestore collection to a CSV file
+    Exports all documents from a Firebase Firestore collection to sharded CSV files
     formatted for Google Cloud Vision Product Search bulk import.
+
+    The collection is split into document id ranges read in parallel, each one
+    paginated with cursors and written to its own shards. Progress is checkpointed
+    after every page in output_dir, running the export again resumes it.
+
+    Args:
+        service_account_path (str): Path to Firebase credentials JSON file
+        collection_name (str): Firestore collection to export
+        output_dir (str): Directory of the CSV shards and the checkpoint
+        product_set_id (str): The ID of the product set you created in GCP
+        product_category (str): 'general', 'apparel', etc.
+        partitions (int): Key ranges read at once
+        page_size (int): Documents per query
+        rows_per_shard (int): Rows per CSV file
+        header (bool): Write the header row in every shard (the Vision import expects none)
+        db (firestore.Client): Firestore client, initialized from the service account if not given
+
+    Returns:
+        int: Amount of rows exported by this run
     """
+    if db is None:
+        # 1. Initialize Firebase Admin using your downloaded service account key
+        cred = credentials.Certificate(service_account_path)
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(cred)
 
-    # 1. Initialize Firebase Admin using your downloaded service account key
-    cred = credentials.Certificate(service_account_path)
-
-    # If you have multiple apps, you can optionally name this app. Otherwise, just do:
-    firebase_admin.initialize_app(cred)
-
-    # 2. Get Firestore client via Firebase Admin
-    db = firestore.client()
-
-    # 3. Define the CSV columns in the correct order
-    csv_headers = [
-        "image_uri",         # (1) image URI
-        "image_id",          # (2) optional, can leave blank or set unique value
-        "product_set_id",    # (3) product set ID in Product Search
-        "product_id",        # (4) your internal product ID
-        "product_category",  # (5) 'general', 'apparel', etc.
-        "product_display_name",  # (6) optional
-        "labels",            # (7) optional comma-delimited key=value pairs
-        "bounding_poly"      # (8) optional
-    ]
+        # 2. Get Firestore client via Firebase Admin
+        db = firestore.client()
 
-    # 4. Open the CSV file for writing
-    with open(output_csv, mode="w", newline="", encoding="utf-8") as csv_file:
-        writer = csv.writer(csv_file)
-        
-        # Write the header row
-        writer.writerow(csv_headers)
-
-        # 5. Query the Firestore collection
-        docs = db.collection(collection_name).limit(1000).stream()
-
-        count = 0
-        for doc in docs:
-            data = doc.to_dict()
-            
-            # 6. Map Firestore fields to CSV columns
-
-            # (1) image_uri: pick 'image' or 'baseImage' from your data
-            image_uri = data.get("image") or data.get("baseImage") or ""
-
-            # (2) image_id: optional. Using 'sku' or leave it blank
-            image_id = data.get("sku", "")
-
-            # (3) product_set_id: the ID of the product set you created in GCP
-            ps_id = product_set_id
-
-            # (4) product_id: from 'productId', or fallback to Firestore doc ID
-            prod_id = data.get("productId", doc.id)
-
-            # (5) product_category: 'general', 'apparel', etc.
-            category = product_category
-
-            # (6) product_display_name: 'name' or 'baseName'
-            display_name = data.get("name") or data.get("baseName") or ""
-
-            # (7) labels: e.g. "color=BLACK,size=2XL"
-            color_label = f"color={data.get('color')}" if data.get("color") else ""
-            size_label = f"size={data.get('size')}" if data.get("size") else ""
-            
-            label_parts = []
-            if color_label:
-                label_parts.append(color_label)
-            if size_label:
-                label_parts.append(size_label)
-            
-            labels = ",".join(label_parts)  # e.g. "color=BLACK,size=2XL"
-
-            # (8) bounding_poly: leave blank unless you have bounding boxes
-            bounding_poly = ""
-
-            # Build the CSV row
-            row = [
-                image_uri,
-                image_id,
-                ps_id,
-                prod_id,
-                category,
-                display_name,
-                labels,
-                bounding_poly
-            ]
-            
-            writer.writerow(row)
-            count += 1
-
-        print(f"Exported {count} products to '{output_csv}' from Firestore.")
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
+    checkpoint = load_checkpoint(checkpoint_path, db, collection_name, partitions)
+    checkpoint_lock = threading.Lock()
 
-if __name__ == "__main__":
-    # Path to your Firebase Admin service account JSON file
-    SERVICE_ACCOUNT_PATH = "credentials/bag-haven-qt9s4v-firebase-adminsdk-h9x05-e584032402.json"
+    def save_progress(state: dict, progress: dict):
+        with checkpoint_lock:
+            state.update(progress)
+            save_checkpoint(checkpoint_path, checkpoint)
+
+    pending = [(index, state) for index, state in enumerate(checkpoint["partitions"]) if not state["done"]]
+    print(f"Exporting '{collection_name}': {len(pending)} of {len(checkpoint['partitions'])} partitions left")
+    start_time = time.time()
+
+    with ThreadPoolExecutor(max_workers=max(1, len(pending))) as executor:
+        futures = [
+            executor.submit(
+                export_partition, db, collection_name, index, state, output_dir,
+                product_set_id, product_category, page_size, rows_per_shard, header, save_progress
+            )
+            for index, state in pending
+        ]
+        count = sum(future.result() for future in futures)
+
+    total = sum(state["rows"] for state in checkpoint["partitions"])
+    print(f"Exported {count} products in {time.time() - start_time:.1f}s ({total} in total) to '{output_dir}' from Firestore.")
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a Firestore collection to CSV shards for Vision Product Search bulk import")
+    parser.add_argument("--credentials", default=SERVICE_ACCOUNT_PATH)
+    parser.add_argument("--collection", default="products")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--product-set-id", default=PRODUCT_SET_ID)
+    parser.add_argument("--product-category", default="general")
+    parser.add_argument("--partitions", type=int, default=EXPORT_PARTITIONS)
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--rows-per-shard", type=int, default=ROWS_PER_SHARD)
+    parser.add_argument("--no-header", action="store_true", help="Leave out the header row, as the Vision import expects")
+    args = parser.parse_args()
 
     export_products_to_csv(
-        service_account_path=SERVICE_ACCOUNT_PATH,
-        collection_name="products",        # your Firestore collection
-        output_csv="all_firebase_products.csv",         # output CSV filename
-        product_set_id="visualsearch-demo-product-set",# must match your GCP product set ID
-        product_category="general"         # or 'general', 'homegoods', etc.
+        service_account_path=args.credentials,
+        collection_name=args.collection,
+        output_dir=args.output_dir,
+        product_set_id=args.product_set_id,
+        product_category=args.product_category,
+        partitions=args.partitions,
+        page_size=args.page_size,
+        rows_per_shard=args.rows_per_shard,
+        header=not args.no_header
     )
+
+if __name__ == "__main__":
+    main()
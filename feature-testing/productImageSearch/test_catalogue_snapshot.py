@@ -0,0 +1,71 @@
+import csv
+
+import pyarrow as pa
+
+from catalogue_snapshot import (
+    LABEL_PAIRS_COLUMN,
+    LABEL_PREFIX,
+    VISION_COLUMNS,
+    build_snapshot,
+    export_csv,
+    load_snapshot,
+)
+
+LABELS = [
+    "style=womens,style=casual,color=RED",
+    "color=BLACK, WHITE",
+    "color=BLUE,size=2XL",
+    None,
+    "noeq,color=GREEN",
+    "size=M,=odd",
+]
+
+def write_catalogue(path, labels):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        for index, label in enumerate(labels):
+            writer.writerow([
+                f"gs://bucket/{index}.jpg", "", "set", f"product-{index}", "apparel", f"Product {index}", label or "", ""
+            ])
+
+def read_labels(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return [row[VISION_COLUMNS.index("labels")] or None for row in csv.reader(f)]
+
+def test_labels_round_trip(tmp_path):
+    write_catalogue(tmp_path / "catalogue.csv", LABELS)
+    build_snapshot([str(tmp_path / "catalogue.csv")], str(tmp_path / "snapshot.arrow"), header=False)
+
+    export_csv(load_snapshot(str(tmp_path / "snapshot.arrow")), str(tmp_path / "export.csv"))
+
+    assert read_labels(tmp_path / "export.csv") == LABELS
+
+def test_labels_round_trip_in_batches(tmp_path):
+    labels = LABELS * 5
+    write_catalogue(tmp_path / "catalogue.csv", labels)
+    build_snapshot([str(tmp_path / "catalogue.csv")], str(tmp_path / "snapshot.arrow"), header=False)
+
+    # the batches are slices of the snapshot columns
+    export_csv(load_snapshot(str(tmp_path / "snapshot.arrow")), str(tmp_path / "export.csv"), batch_rows=4)
+
+    assert read_labels(tmp_path / "export.csv") == labels
+
+def test_label_pairs_keep_repeated_keys(tmp_path):
+    write_catalogue(tmp_path / "catalogue.csv", LABELS)
+    snapshot = build_snapshot([str(tmp_path / "catalogue.csv")], str(tmp_path / "snapshot.arrow"), header=False)
+
+    pairs = [
+        [(pair["key"], pair["value"]) for pair in row] if row is not None else None
+        for row in snapshot[LABEL_PAIRS_COLUMN].to_pylist()
+    ]
+    assert pairs == [
+        [("style", "womens"), ("style", "casual"), ("color", "RED")],
+        [("color", "BLACK, WHITE")],
+        [("color", "BLUE"), ("size", "2XL")],
+        None,
+        [(None, "noeq"), ("color", "GREEN")],
+        [("size", "M,=odd")],
+    ]
+    # the typed columns hold the first value of a key
+    assert pa.chunked_array(snapshot[LABEL_PREFIX + "style"]).to_pylist() == ["womens", None, None, None, None, None]
+    assert snapshot[LABEL_PREFIX + "color"].to_pylist() == ["RED", "BLACK, WHITE", "BLUE", None, "GREEN", None]
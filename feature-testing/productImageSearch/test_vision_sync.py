@@ -0,0 +1,161 @@
+import pyarrow as pa
+import pytest
+
+from catalogue_snapshot import catalogue_to_snapshot_table
+from vision_sync import (
+    NOT_FOUND,
+    UNKNOWN,
+    VISION_COLUMNS,
+    LocalVisionClient,
+    Product,
+    Status,
+    VisionSync,
+    catalogue_products,
+)
+
+PRODUCT_SET_ID = "test-set"
+
+class FailingDeleteClient(LocalVisionClient):
+    def delete_product(self, product_id):
+        self.calls["deleteProduct"] += 1
+        return Status(UNKNOWN, "Deadline exceeded")
+
+class PartialStatusClient(LocalVisionClient):
+    def import_rows(self, rows):
+        # Vision reporting fewer statuses than rows sent
+        return super().import_rows(rows)[:1]
+
+def product(category="apparel", display_name="Bag", labels=(("color", "RED"),), images=None):
+    return Product(category, display_name, tuple(labels), images or {"1": "gs://bucket/1.jpg"})
+
+def stored(client, product_id):
+    return client.product_sets.get(PRODUCT_SET_ID, {}).get(product_id)
+
+@pytest.fixture
+def sync_to(tmp_path):
+    syncs = []
+
+    def make(client):
+        sync = VisionSync(client, str(tmp_path / "state.sqlite3"), product_set_id=PRODUCT_SET_ID)
+        syncs.append(sync)
+        return sync
+
+    yield make
+    for sync in syncs:
+        sync.close()
+
+def test_add_update_delete(sync_to):
+    client = LocalVisionClient()
+    sync = sync_to(client)
+
+    report = sync.sync({
+        "a": product(display_name="Bag A"),
+        "b": product(display_name="Bag B", images={"2": "gs://bucket/2.jpg", "3": "gs://bucket/3.jpg"}),
+    })
+    assert report["imported"] == 3 and report["failed"] == 0
+    assert set(client.product_sets[PRODUCT_SET_ID]) == {"a", "b"}
+
+    catalogue = {
+        "a": product(display_name="Bag A v2", labels=(("color", "BLUE"),)),
+        "b": product(display_name="Bag B", images={"2": "gs://bucket/2.jpg"}),
+        "c": product(display_name="Bag C", images={"4": "gs://bucket/4.jpg"}),
+    }
+    plan = sync.plan(catalogue)
+    assert plan.counts() == {"importRows": 1, "updateProducts": 1, "deleteImages": 1, "deleteProducts": 0}
+    report = sync.apply(plan)
+    assert (report["imported"], report["updated"], report["imagesDeleted"], report["failed"]) == (1, 1, 1, 0)
+    assert stored(client, "a")["displayName"] == "Bag A v2"
+    assert stored(client, "a")["labels"] == "color=BLUE"
+    assert stored(client, "b")["images"] == {"2": "gs://bucket/2.jpg"}
+    assert stored(client, "c") is not None
+
+    del catalogue["c"]
+    report = sync.sync(catalogue)
+    assert report["productsDeleted"] == 1
+    assert stored(client, "c") is None
+
+    # nothing left to send
+    assert sync.plan(catalogue).counts() == {"importRows": 0, "updateProducts": 0, "deleteImages": 0, "deleteProducts": 0}
+
+def test_category_change_recreates_the_product(sync_to):
+    client = LocalVisionClient()
+    sync = sync_to(client)
+    sync.sync({"a": product(category="apparel")})
+
+    plan = sync.plan({"a": product(category="homegoods")})
+    assert plan.delete_products == ["a"]
+    assert plan.update_products == [] and plan.delete_images == []
+    assert len(plan.import_rows) == 1
+
+    report = sync.apply(plan)
+    assert (report["productsDeleted"], report["imported"], report["failed"]) == (1, 1, 0)
+    assert stored(client, "a")["category"] == "homegoods"
+    assert sync.plan({"a": product(category="homegoods")}).counts()["importRows"] == 0
+
+def test_failed_delete_blocks_the_imports_of_the_product(sync_to):
+    client = FailingDeleteClient()
+    sync = sync_to(client)
+    sync.sync({"a": product(category="apparel"), "b": product()})
+
+    catalogue = {"a": product(category="homegoods"), "b": product(), "c": product()}
+    report = sync.sync(catalogue)
+    # the import of "a" would fail on its old category, the new product "c" still goes in
+    assert (report["failed"], report["skipped"], report["imported"]) == (1, 1, 1)
+    assert stored(client, "a")["category"] == "apparel"
+    assert stored(client, "c") is not None
+    assert [(failure["productId"], failure["operation"]) for failure in sync.failures()] == [("a", "deleteProduct")]
+
+    # tried again by the next sync
+    plan = sync.plan(catalogue)
+    assert plan.delete_products == ["a"]
+    assert [row[VISION_COLUMNS.index("product_id")] for row in plan.import_rows] == ["a"]
+
+def test_missing_import_statuses_are_failures(sync_to):
+    client = PartialStatusClient()
+    sync = sync_to(client)
+    catalogue = {"a": product(images={"1": "gs://bucket/1.jpg", "2": "gs://bucket/2.jpg"})}
+
+    report = sync.sync(catalogue)
+    assert (report["imported"], report["failed"]) == (1, 1)
+    failures = sync.failures()
+    assert [(failure["imageId"], failure["code"]) for failure in failures] == [("2", UNKNOWN)]
+
+    # only the image without a status is sent again
+    plan = sync.plan(catalogue)
+    assert [row[VISION_COLUMNS.index("image_id")] for row in plan.import_rows] == ["2"]
+    report = sync.apply(plan)
+    assert (report["imported"], report["failed"]) == (1, 0)
+    assert sync.failures() == []
+
+def test_delete_of_a_missing_product_is_done(sync_to):
+    client = LocalVisionClient()
+    sync = sync_to(client)
+    sync.sync({"a": product()})
+    client.product_sets[PRODUCT_SET_ID].clear()
+
+    assert client.delete_product("a") == Status(NOT_FOUND, "Product a not found")
+    report = sync.sync({})
+    assert (report["productsDeleted"], report["failed"]) == (1, 0)
+
+def test_catalogue_products_keep_repeated_label_keys(sync_to):
+    table = pa.table({
+        "image_uri": ["gs://bucket/1.jpg", "gs://bucket/2.jpg", "gs://bucket/3.jpg"],
+        "image_id": ["1", "2", "3"],
+        "product_set_id": [PRODUCT_SET_ID] * 3,
+        "product_id": ["a", "a", "b"],
+        "product_category": ["apparel"] * 3,
+        "product_display_name": ["Bag A", "Bag A", "Bag B"],
+        "labels": ["style=womens,style=casual,color=RED", "style=womens,style=casual,color=RED", "noeq,color=BLACK, WHITE"],
+        "bounding_poly": [None] * 3,
+    })
+    catalogue = catalogue_products(catalogue_to_snapshot_table(table))
+    assert catalogue["a"].labels == (("style", "womens"), ("style", "casual"), ("color", "RED"))
+    assert catalogue["a"].images == {"1": "gs://bucket/1.jpg", "2": "gs://bucket/2.jpg"}
+    # a label without a key can't be sent to Vision
+    assert catalogue["b"].labels == (("color", "BLACK, WHITE"),)
+
+    client = LocalVisionClient()
+    report = sync_to(client).sync(catalogue)
+    assert report["imported"] == 3
+    assert stored(client, "a")["labels"] == "style=womens,style=casual,color=RED"
+    assert stored(client, "b")["labels"] == "color=BLACK, WHITE"
@@ -0,0 +1,617 @@
+import io
+import os
+import csv
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from uuid import uuid4
+
+from catalogue_snapshot import (
+    LABEL_PAIRS_COLUMN,
+    LABEL_PREFIX,
+    SNAPSHOT_PATH,
+    VISION_COLUMNS,
+    catalogue_to_snapshot_table,
+    label_keys_of,
+    load_snapshot,
+    read_catalogue_csv
+)
+
+SYNC_STATE_PATH = "vision_sync.sqlite3"
+PROJECT_ID = "baghaven"
+LOCATION = "us-west1"
+PRODUCT_SET_ID = "visualsearch-demo-product-set"
+STAGING_BUCKET = "demo-products-bkt"
+
+# rows per import_product_sets call, each one is a CSV staged in the bucket
+IMPORT_BATCH_ROWS = 1000
+# import operations running at once
+MAX_CONCURRENT_IMPORTS = 4
+# update / delete calls running at once
+RPC_WORKERS = 16
+
+# google.rpc.Code values used in the statuses
+OK = 0
+UNKNOWN = 2
+INVALID_ARGUMENT = 3
+NOT_FOUND = 5
+
+class Status(NamedTuple):
+    code: int
+    message: str = ""
+
+class Product(NamedTuple):
+    category: str
+    display_name: str
+    # (key, value) pairs in catalogue order
+    labels: Tuple[Tuple[str, str], ...]
+    # {reference image id: image uri}
+    images: Dict[str, str]
+
+class SyncPlan(NamedTuple):
+    # Vision import rows: new products, new or changed reference images
+    import_rows: List[list]
+    # products whose display name or labels changed
+    update_products: List[Tuple[str, Product]]
+    # (product id, reference image id) removed from the catalogue or pointing to a new uri
+    delete_images: List[Tuple[str, str]]
+    # products removed from the catalogue, or re-created in another category
+    delete_products: List[str]
+    # catalogue products, to record what was synced
+    catalogue: Dict[str, Product]
+
+    def counts(self) -> Dict[str, int]:
+        return {
+            "importRows": len(self.import_rows),
+            "updateProducts": len(self.update_products),
+            "deleteImages": len(self.delete_images),
+            "deleteProducts": len(self.delete_products),
+        }
+
+def reference_image_id(image_id: Optional[str], image_uri: str) -> str:
+    # the catalogue image_id (the SKU), or one derived from the uri so the image can be deleted later
+    return image_id or hashlib.blake2b(image_uri.encode("utf-8"), digest_size=8).hexdigest()
+
+def product_hash(product: Product) -> str:
+    return hashlib.blake2b(
+        json.dumps([product.category, product.display_name, product.labels]).encode("utf-8"),
+        digest_size=16
+    ).hexdigest()
+
+def format_labels(labels) -> str:
+    return ",".join(f"{key}={value}" for key, value in labels)
+
+def catalogue_products(table) -> Dict[str, Product]:
+    """
+    Products of a catalogue snapshot, rows of the same product_id are its reference images
+
+    Args:
+        table (pa.Table): Snapshot (from catalogue_snapshot.load_snapshot)
+
+    Returns:
+        dict: {product id: Product}
+    """
+    columns = ["product_id", "product_category", "product_display_name", "image_uri", "image_id"]
+    values = [table[column].to_pylist() for column in columns]
+    if LABEL_PAIRS_COLUMN in table.column_names:
+        # every label in order, repeated keys included (labels without a key can't be sent to Vision)
+        label_pairs = table[LABEL_PAIRS_COLUMN].to_pylist()
+        row_labels = lambda index: tuple(
+            (pair["key"], pair["value"]) for pair in label_pairs[index] or () if pair["key"] is not None
+        )
+    else:
+        # snapshots from before LABEL_PAIRS_COLUMN only have one value per key
+        label_keys = label_keys_of(table)
+        label_values = [table[LABEL_PREFIX + key].to_pylist() for key in label_keys]
+        row_labels = lambda index: tuple(
+            (key, column[index]) for key, column in zip(label_keys, label_values) if column[index] is not None
+        )
+
+    products = {}
+    for index, (product_id, category, display_name, image_uri, image_id) in enumerate(zip(*values)):
+        if not product_id or not image_uri:
+            continue
+        product = products.get(product_id)
+        if product is None:
+            product = products[product_id] = Product(category or "general", display_name or "", row_labels(index), {})
+        product.images[reference_image_id(image_id, image_uri)] = image_uri
+    return products
+
+class VisionClient(ABC):
+    """
+    Remote side of the sync, one status per item
+
+    ProductSearchClient talks to Vision Product Search, LocalVisionClient stands in for it.
+    """
+
+    @abstractmethod
+    def import_rows(self, rows: List[list]) -> List[Status]:
+        """
+        Import Vision CSV rows (VISION_COLUMNS) into the product set
+
+        Returns:
+            list: Status of every row, in order
+        """
+
+    @abstractmethod
+    def update_product(self, product_id: str, product: Product) -> Status:
+        """Update the display name and labels of a product"""
+
+    @abstractmethod
+    def delete_reference_image(self, product_id: str, image_id: str) -> Status:
+        ...
+
+    @abstractmethod
+    def delete_product(self, product_id: str) -> Status:
+        """Delete a product and its reference images"""
+
+class ProductSearchClient(VisionClient):
+    def __init__(
+        self,
+        project_id: str = PROJECT_ID,
+        location: str = LOCATION,
+        staging_bucket: str = STAGING_BUCKET,
+        staging_prefix: str = "vision-sync/"
+    ):
+        """
+        Vision Product Search, import batches are staged as CSVs in a bucket
+        """
+        from google.api_core import exceptions
+        from google.cloud import storage, vision_v1
+
+        self.vision = vision_v1
+        self.not_found = exceptions.NotFound
+        self.client = vision_v1.ProductSearchClient()
+        self.bucket = storage.Client().bucket(staging_bucket)
+        self.staging_prefix = staging_prefix
+        self.project_id = project_id
+        self.location = location
+        self.parent = f"projects/{project_id}/locations/{location}"
+
+    def _call(self, function, **kwargs) -> Status:
+        try:
+            function(**kwargs)
+            return Status(OK)
+        except self.not_found as e:
+            return Status(NOT_FOUND, str(e))
+        except Exception as e:
+            code = getattr(e, "grpc_status_code", None)
+            return Status(code.value[0] if code is not None else UNKNOWN, str(e))
+
+    def import_rows(self, rows: List[list]) -> List[Status]:
+        data = io.StringIO()
+        csv.writer(data, lineterminator="\n").writerows(rows)
+        blob = self.bucket.blob(f"{self.staging_prefix}{uuid4().hex}.csv")
+        staged = False
+        try:
+            # a failed upload fails the rows of the batch like a failed import, the other batches go on
+            blob.upload_from_string(data.getvalue(), content_type="text/csv")
+            staged = True
+            operation = self.client.import_product_sets(
+                parent=self.parent,
+                input_config=self.vision.ImportProductSetsInputConfig(
+                    gcs_source=self.vision.ImportProductSetsGcsSource(csv_file_uri=f"gs://{self.bucket.name}/{blob.name}")
+                )
+            )
+            result = operation.result()
+        except Exception as e:
+            return [Status(UNKNOWN, str(e))] * len(rows)
+        finally:
+            if staged:
+                try:
+                    blob.delete()
+                except Exception as e:
+                    print(f"Could not delete the staged batch {blob.name}: {e}")
+        # one status per line of the CSV
+        return [Status(status.code, status.message) for status in result.statuses]
+
+    def update_product(self, product_id: str, product: Product) -> Status:
+        return self._call(
+            self.client.update_product,
+            product=self.vision.Product(
+                name=self.client.product_path(self.project_id, self.location, product_id),
+                display_name=product.display_name,
+                product_labels=[self.vision.Product.KeyValue(key=key, value=value) for key, value in product.labels]
+            ),
+            update_mask={"paths": ["display_name", "product_labels"]}
+        )
+
+    def delete_reference_image(self, product_id: str, image_id: str) -> Status:
+        return self._call(
+            self.client.delete_reference_image,
+            name=self.client.reference_image_path(self.project_id, self.location, product_id, image_id)
+        )
+
+    def delete_product(self, product_id: str) -> Status:
+        return self._call(self.client.delete_product, name=self.client.product_path(self.project_id, self.location, product_id))
+
+class LocalVisionClient(VisionClient):
+    def __init__(self, path: Optional[str] = None):
+        """
+        In-memory stand-in for Vision Product Search (for testing and dry runs)
+
+        Rejects what the real import rejects most often (image uris that are not gs:// paths)
+        and counts the calls made.
+
+        Args:
+            path (str): JSON file the fake product set is loaded from and saved to
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        # {product set id: {product id: {"category", "displayName", "labels", "images": {image id: uri}}}}
+        self.product_sets = {}
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.product_sets = json.load(f)
+        self.calls = {"importRows": 0, "updateProduct": 0, "deleteReferenceImage": 0, "deleteProduct": 0}
+
+    def save(self):
+        if self.path:
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(self.product_sets, f)
+
+    def _find(self, product_id: str) -> Optional[dict]:
+        for products in self.product_sets.values():
+            if product_id in products:
+                return products[product_id]
+        return None
+
+    def import_rows(self, rows: List[list]) -> List[Status]:
+        statuses = []
+        with self.lock:
+            self.calls["importRows"] += 1
+            for image_uri, image_id, product_set_id, product_id, category, display_name, labels, _ in rows:
+                if not image_uri.startswith("gs://"):
+                    statuses.append(Status(INVALID_ARGUMENT, f"Invalid GCS path specified: {image_uri}"))
+                    continue
+                product = self._find(product_id)
+                if product is not None and product["category"] != category:
+                    statuses.append(Status(INVALID_ARGUMENT, f"Product {product_id} exists in category {product['category']}"))
+                    continue
+                if product is None:
+                    product = self.product_sets.setdefault(product_set_id, {})[product_id] = {"category": category, "images": {}}
+                product["displayName"] = display_name
+                product["labels"] = labels
+                product["images"][image_id] = image_uri
+                statuses.append(Status(OK))
+        return statuses
+
+    def update_product(self, product_id: str, product: Product) -> Status:
+        with self.lock:
+            self.calls["updateProduct"] += 1
+            stored = self._find(product_id)
+            if stored is None:
+                return Status(NOT_FOUND, f"Product {product_id} not found")
+            stored["displayName"] = product.display_name
+            stored["labels"] = format_labels(product.labels)
+            return Status(OK)
+
+    def delete_reference_image(self, product_id: str, image_id: str) -> Status:
+        with self.lock:
+            self.calls["deleteReferenceImage"] += 1
+            stored = self._find(product_id)
+            if stored is None or stored["images"].pop(image_id, None) is None:
+                return Status(NOT_FOUND, f"Reference image {product_id}/{image_id} not found")
+            return Status(OK)
+
+    def delete_product(self, product_id: str) -> Status:
+        with self.lock:
+            self.calls["deleteProduct"] += 1
+            for products in self.product_sets.values():
+                if products.pop(product_id, None) is not None:
+                    return Status(OK)
+            return Status(NOT_FOUND, f"Product {product_id} not found")
+
+class VisionSync:
+    def __init__(
+        self,
+        client: VisionClient,
+        state_path: str = SYNC_STATE_PATH,
+        product_set_id: str = PRODUCT_SET_ID,
+        import_batch_rows: int = IMPORT_BATCH_ROWS,
+        max_concurrent_imports: int = MAX_CONCURRENT_IMPORTS,
+        rpc_workers: int = RPC_WORKERS
+    ):
+        """
+        Incremental sync of the catalogue to a Vision product set
+
+        The state of the last sync (product hashes and reference images) is kept in SQLite.
+        A sync diffs the catalogue against it and only sends the differences: imports for
+        new products and images, updates for changed products, deletes for removed ones.
+        An item is recorded as synced only once Vision reports it OK, so failed items are
+        sent again by the next sync; their last error is kept in the failures table.
+
+        Args:
+            client (VisionClient): Vision Product Search, or a stand-in
+            state_path (str): Path to the SQLite file
+            product_set_id (str): Product set the catalogue is synced to
+            import_batch_rows (int): Rows per import
+            max_concurrent_imports (int): Imports running at once
+            rpc_workers (int): Update / delete calls running at once
+        """
+        self.client = client
+        self.product_set_id = product_set_id
+        self.import_batch_rows = import_batch_rows
+        self.max_concurrent_imports = max_concurrent_imports
+        self.rpc_workers = rpc_workers
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(state_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS products (
+                product_id TEXT PRIMARY KEY,
+                category TEXT NOT NULL,
+                product_hash TEXT NOT NULL,
+                synced_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS images (
+                product_id TEXT NOT NULL,
+                image_id TEXT NOT NULL,
+                image_uri TEXT NOT NULL,
+                synced_at REAL,
+                PRIMARY KEY (product_id, image_id)
+            );
+            CREATE TABLE IF NOT EXISTS failures (
+                product_id TEXT NOT NULL,
+                image_id TEXT NOT NULL,
+                operation TEXT NOT NULL,
+                code INTEGER NOT NULL,
+                message TEXT,
+                failed_at REAL,
+                PRIMARY KEY (product_id, image_id, operation)
+            );
+            """
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def plan(self, catalogue: Dict[str, Product]) -> SyncPlan:
+        """
+        Diff the catalogue against the last synced state
+
+        Args:
+            catalogue (dict): {product id: Product} (from catalogue_products)
+
+        Returns:
+            SyncPlan: Operations bringing the product set up to date
+        """
+        with self.lock:
+            synced_products = {
+                product_id: (category, hash_)
+                for product_id, category, hash_ in self.conn.execute("SELECT product_id, category, product_hash FROM products")
+            }
+            synced_images = {}
+            for product_id, image_id, image_uri in self.conn.execute("SELECT product_id, image_id, image_uri FROM images"):
+                synced_images.setdefault(product_id, {})[image_id] = image_uri
+
+        plan = SyncPlan([], [], [], [], catalogue)
+        for product_id, product in catalogue.items():
+            synced = synced_products.get(product_id)
+            images = synced_images.get(product_id, {})
+            if synced is not None and synced[0] != product.category:
+                # the category of a product can't be changed, it is created again
+                plan.delete_products.append(product_id)
+                synced, images = None, {}
+            elif synced is not None and synced[1] != product_hash(product):
+                plan.update_products.append((product_id, product))
+
+            for image_id, image_uri in product.images.items():
+                synced_uri = images.get(image_id)
+                if synced_uri == image_uri:
+                    continue
+                if synced_uri is not None:
+                    plan.delete_images.append((product_id, image_id))
+                plan.import_rows.append(self._import_row(product_id, product, image_id, image_uri))
+            for image_id in images.keys() - product.images.keys():
+                plan.delete_images.append((product_id, image_id))
+
+        plan.delete_products.extend(product_id for product_id in synced_products if product_id not in catalogue)
+        return plan
+
+    def _import_row(self, product_id: str, product: Product, image_id: str, image_uri: str) -> list:
+        row = {
+            "image_uri": image_uri,
+            "image_id": image_id,
+            "product_set_id": self.product_set_id,
+            "product_id": product_id,
+            "product_category": product.category,
+            "product_display_name": product.display_name,
+            "labels": format_labels(product.labels),
+            "bounding_poly": "",
+        }
+        return [row[column] for column in VISION_COLUMNS]
+
+    def apply(self, plan: SyncPlan) -> Dict[str, int]:
+        """
+        Send the operations of a plan, deletes and updates first, then the imports in concurrent batches
+
+        Returns:
+            dict: Amount of items per outcome
+        """
+        report = {"imported": 0, "updated": 0, "imagesDeleted": 0, "productsDeleted": 0, "failed": 0, "skipped": 0}
+        # products whose deletes failed, importing into them would fail too (or duplicate images)
+        blocked = set()
+
+        with ThreadPoolExecutor(max_workers=self.rpc_workers) as executor:
+            deletes = [
+                (product_id, "", "deleteProduct", executor.submit(self.client.delete_product, product_id))
+                for product_id in plan.delete_products
+            ] + [
+                (product_id, image_id, "deleteImage", executor.submit(self.client.delete_reference_image, product_id, image_id))
+                for product_id, image_id in plan.delete_images
+            ]
+            updates = [
+                (product_id, product, executor.submit(self.client.update_product, product_id, product))
+                for product_id, product in plan.update_products
+            ]
+
+            for product_id, image_id, operation, future in deletes:
+                status = future.result()
+                # already gone is what a delete wants
+                if status.code in (OK, NOT_FOUND):
+                    self._record_deleted(product_id, image_id)
+                    report["productsDeleted" if operation == "deleteProduct" else "imagesDeleted"] += 1
+                else:
+                    self._record_failure(product_id, image_id, operation, status)
+                    blocked.add(product_id)
+                    report["failed"] += 1
+
+            for product_id, product, future in updates:
+                status = future.result()
+                if status.code == OK:
+                    self._record_product(product_id, product)
+                    report["updated"] += 1
+                else:
+                    self._record_failure(product_id, "", "updateProduct", status)
+                    report["failed"] += 1
+        self._commit()
+
+        rows = [row for row in plan.import_rows if row[VISION_COLUMNS.index("product_id")] not in blocked]
+        report["skipped"] = len(plan.import_rows) - len(rows)
+        batches = [rows[i:i + self.import_batch_rows] for i in range(0, len(rows), self.import_batch_rows)]
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_imports) as executor:
+            for batch, statuses in zip(batches, executor.map(self.client.import_rows, batches)):
+                imported, failed = self._record_imports(batch, statuses, plan.catalogue)
+                report["imported"] += imported
+                report["failed"] += failed
+        return report
+
+    def sync(self, catalogue: Dict[str, Product], dry_run: bool = False) -> Dict[str, int]:
+        """
+        Diff the catalogue against the last sync and send the differences
+
+        Args:
+            catalogue (dict): {product id: Product} (from catalogue_products)
+            dry_run (bool): Only plan, nothing is sent
+
+        Returns:
+            dict: Operations planned and, unless dry_run, the amount of items per outcome
+        """
+        start_time = time.time()
+        plan = self.plan(catalogue)
+        print(f"Sync plan for {len(catalogue)} products: {plan.counts()}")
+        if dry_run:
+            return plan.counts()
+        report = self.apply(plan)
+        print(f"Synced in {time.time() - start_time:.1f}s: {report}")
+        return {**plan.counts(), **report}
+
+    def _record_imports(self, rows: List[list], statuses: List[Status], catalogue: Dict[str, Product]) -> Tuple[int, int]:
+        product_column = VISION_COLUMNS.index("product_id")
+        image_column = VISION_COLUMNS.index("image_id")
+        uri_column = VISION_COLUMNS.index("image_uri")
+        imported = failed = 0
+        now = time.time()
+        with self.lock:
+            for index, row in enumerate(rows):
+                status = statuses[index] if index < len(statuses) else Status(UNKNOWN, "No status returned")
+                product_id, image_id = row[product_column], row[image_column]
+                if status.code != OK:
+                    self._record_failure(product_id, image_id, "import", status, locked=True)
+                    failed += 1
+                    continue
+                product = catalogue[product_id]
+                # the hash of an existing product only changes with its update, which may have failed
+                self.conn.execute(
+                    "INSERT INTO products (product_id, category, product_hash, synced_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (product_id) DO UPDATE SET synced_at = excluded.synced_at",
+                    (product_id, product.category, product_hash(product), now)
+                )
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO images (product_id, image_id, image_uri, synced_at) VALUES (?, ?, ?, ?)",
+                    (product_id, image_id, row[uri_column], now)
+                )
+                self.conn.execute("DELETE FROM failures WHERE product_id = ? AND image_id = ?", (product_id, image_id))
+                imported += 1
+            self.conn.commit()
+        return imported, failed
+
+    def _record_product(self, product_id: str, product: Product):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE products SET product_hash = ?, synced_at = ? WHERE product_id = ?",
+                (product_hash(product), time.time(), product_id)
+            )
+            self.conn.execute("DELETE FROM failures WHERE product_id = ? AND image_id = ''", (product_id,))
+
+    def _record_deleted(self, product_id: str, image_id: str):
+        with self.lock:
+            if image_id:
+                self.conn.execute("DELETE FROM images WHERE product_id = ? AND image_id = ?", (product_id, image_id))
+            else:
+                self.conn.execute("DELETE FROM products WHERE product_id = ?", (product_id,))
+                self.conn.execute("DELETE FROM images WHERE product_id = ?", (product_id,))
+            self.conn.execute("DELETE FROM failures WHERE product_id = ? AND image_id = ?", (product_id, image_id))
+
+    def _record_failure(self, product_id: str, image_id: str, operation: str, status: Status, locked: bool = False):
+        if not locked:
+            with self.lock:
+                return self._record_failure(product_id, image_id, operation, status, locked=True)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO failures (product_id, image_id, operation, code, message, failed_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (product_id, image_id, operation, status.code, status.message, time.time())
+        )
+
+    def _commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def failures(self, limit: int = 100) -> List[dict]:
+        """
+        Items that failed to sync, with the last error Vision reported
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT product_id, image_id, operation, code, message, failed_at FROM failures ORDER BY failed_at DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return [
+            {"productId": product_id, "imageId": image_id, "operation": operation, "code": code, "message": message, "failedAt": failed_at}
+            for product_id, image_id, operation, code, message, failed_at in rows
+        ]
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync the catalogue to Vision Product Search incrementally")
+    parser.add_argument("--snapshot", default=SNAPSHOT_PATH, help="Catalogue snapshot (catalogue_snapshot.py)")
+    parser.add_argument("--csv", help="Read the catalogue from a Vision import CSV instead of the snapshot")
+    parser.add_argument("--no-header", action="store_true", help="The CSV has no header row")
+    parser.add_argument("--state", default=SYNC_STATE_PATH)
+    parser.add_argument("--project", default=PROJECT_ID)
+    parser.add_argument("--location", default=LOCATION)
+    parser.add_argument("--product-set", default=PRODUCT_SET_ID)
+    parser.add_argument("--staging-bucket", default=STAGING_BUCKET)
+    parser.add_argument("--local", help="Sync to a local fake product set saved in this JSON file")
+    parser.add_argument("--dry-run", action="store_true", help="Only show what would be sent")
+    args = parser.parse_args()
+
+    if args.csv:
+        table = catalogue_to_snapshot_table(read_catalogue_csv(args.csv, header=not args.no_header))
+    else:
+        table = load_snapshot(args.snapshot)
+    catalogue = catalogue_products(table)
+
+    client = LocalVisionClient(args.local) if args.local else ProductSearchClient(args.project, args.location, args.staging_bucket)
+    sync = VisionSync(client, args.state, product_set_id=args.product_set)
+    try:
+        sync.sync(catalogue, dry_run=args.dry_run)
+        for failure in sync.failures(limit=10):
+            print(f"Failed: {failure}")
+    finally:
+        sync.close()
+        if args.local and not args.dry_run:
+            client.save()
+
+if __name__ == "__main__":
+    main()
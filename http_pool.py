@@ -0,0 +1,120 @@
+import aiohttp
+
+# default pool configuration
+HTML_POOL_LIMIT = 100
+HTML_POOL_LIMIT_PER_HOST = 10
+HTML_POOL_DNS_TTL = 300
+HTML_POOL_KEEPALIVE = 30
+
+class SharedHTTPSession:
+    def __init__(
+        self,
+        limit=HTML_POOL_LIMIT,
+        limit_per_host=HTML_POOL_LIMIT_PER_HOST,
+        dns_ttl=HTML_POOL_DNS_TTL,
+        keepalive_timeout=HTML_POOL_KEEPALIVE
+    ):
+        """
+        One aiohttp session for the whole app so merchant connections stay warm
+
+        Args:
+            limit (int): Max connections open at the same time (0 is unlimited)
+            limit_per_host (int): Max connections to a single host (0 is unlimited)
+            dns_ttl (int): Seconds a resolved host is kept in the DNS cache
+            keepalive_timeout (float): Seconds an idle connection is kept open
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.connector = None
+        self._session = None
+        self.counters = {
+            "requests": 0,
+            "requestErrors": 0,
+            "connectionsCreated": 0,
+            "connectionsReused": 0,
+            "connectionsQueued": 0,
+            "dnsCacheHits": 0,
+            "dnsCacheMisses": 0,
+        }
+
+    def _trace_config(self):
+        # count pool events so we can tell if connections are really reused
+        trace_config = aiohttp.TraceConfig()
+
+        def counter(name):
+            async def increment(session, context, params):
+                self.counters[name] += 1
+            return increment
+
+        trace_config.on_request_start.append(counter("requests"))
+        trace_config.on_request_exception.append(counter("requestErrors"))
+        trace_config.on_connection_create_end.append(counter("connectionsCreated"))
+        trace_config.on_connection_reuseconn.append(counter("connectionsReused"))
+        trace_config.on_connection_queued_start.append(counter("connectionsQueued"))
+        trace_config.on_dns_cache_hit.append(counter("dnsCacheHits"))
+        trace_config.on_dns_cache_miss.append(counter("dnsCacheMisses"))
+        return trace_config
+
+    async def start(self):
+        """
+        Create the session, called once at app startup
+        """
+        if self._session is not None and not self._session.closed:
+            return
+
+        self.connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_ttl,
+            keepalive_timeout=self.keepalive_timeout
+        )
+        self._session = aiohttp.ClientSession(
+            connector=self.connector,
+            trace_configs=[self._trace_config()]
+        )
+
+    async def close(self):
+        """
+        Close the session and every pooled connection, called once at app shutdown
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self.connector = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            raise RuntimeError("Shared HTTP session has not been started")
+        return self._session
+
+    def stats(self):
+        """
+        Get the current pool stats
+
+        Returns:
+            dict: Pool configuration, open connections and event counters
+        """
+        stats = {
+            "open": self._session is not None and not self._session.closed,
+            "limit": self.limit,
+            "limitPerHost": self.limit_per_host,
+            "dnsCacheTTL": self.dns_ttl,
+            "keepaliveTimeout": self.keepalive_timeout,
+            "connectionsInUse": 0,
+            "connectionsIdle": 0,
+            "idleHosts": 0,
+            **self.counters,
+        }
+
+        # aiohttp doesn't expose these publicly, so don't fail if they move
+        if self.connector is not None:
+            stats["connectionsInUse"] = len(getattr(self.connector, "_acquired", ()))
+            idle = getattr(self.connector, "_conns", {})
+            stats["connectionsIdle"] = sum(len(conns) for conns in idle.values())
+            stats["idleHosts"] = len([key for key, conns in idle.items() if conns])
+
+        return stats
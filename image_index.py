@@ -0,0 +1,386 @@
+import csv
+import io
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import requests
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+IMAGE_VECTORS_PATH = "image_index.u64"
+IMAGE_METADATA_PATH = "image_index.sqlite3"
+# pHash + horizontal dHash + vertical dHash, 64 bits each
+SIGNATURE_WORDS = 3
+SIGNATURE_BITS = SIGNATURE_WORDS * 64
+# (query, row) pairs compared at once, bounds the temporary arrays of a search
+SEARCH_CHUNK_PAIRS = 65536
+# rows the vector file grows by (at least) when it is full
+GROW_ROWS = 4096
+DOWNLOAD_WORKERS = 16
+ADD_BATCH_SIZE = 256
+
+# popcount of every byte, for NumPy versions without bitwise_count
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def _popcount(words: np.ndarray) -> np.ndarray:
+    # bits set in every uint64, same shape
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    return _POPCOUNT_TABLE[words.view(np.uint8)].reshape(*words.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+def _dct_matrix(size: int) -> np.ndarray:
+    # orthonormal DCT-II, the 2D transform of x is D @ x @ D.T
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.sqrt(2.0 / size) * np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+_DCT_32 = _dct_matrix(32)
+
+def _pack(bits: np.ndarray) -> np.uint64:
+    return np.packbits(bits.astype(np.uint8).ravel()).view(">u8")[0].astype(np.uint64)
+
+def image_signature(data: bytes) -> np.ndarray:
+    """
+    Perceptual signature of an image: pHash (low DCT frequencies) and horizontal / vertical
+    dHash (brightness gradients), robust to resizing, recompression and small edits
+
+    Args:
+        data (bytes): Encoded image (JPEG, PNG, WebP, ...)
+
+    Returns:
+        np.ndarray: SIGNATURE_WORDS uint64, compared by Hamming distance
+    """
+    if Image is None:
+        raise RuntimeError("Pillow is required to compute image signatures (pip install pillow)")
+
+    image = Image.open(io.BytesIO(data))
+    # JPEGs are decoded straight at a reduced scale, we only need 32x32
+    image.draft("L", (64, 64))
+    image = ImageOps.exif_transpose(image).convert("L")
+
+    pixels = np.asarray(image.resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    low_frequencies = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8].ravel()
+    # the DC term is the average brightness, left out of the median
+    phash = low_frequencies > np.median(low_frequencies[1:])
+
+    wide = np.asarray(image.resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    tall = np.asarray(image.resize((8, 9), Image.LANCZOS), dtype=np.int16)
+    dhash_horizontal = wide[:, 1:] > wide[:, :-1]
+    dhash_vertical = tall[1:, :] > tall[:-1, :]
+
+    return np.array([_pack(phash), _pack(dhash_horizontal), _pack(dhash_vertical)], dtype=np.uint64)
+
+class ImageIndex:
+    def __init__(self, vectors_path: str = IMAGE_VECTORS_PATH, metadata_path: str = IMAGE_METADATA_PATH):
+        """
+        Local visual similarity index of the catalogue images
+
+        Signatures live in a memory-mapped file of uint64 rows, searched with vectorised
+        Hamming distances (XOR + popcount over every row at once). Row n of the file is
+        described by row n of the SQLite metadata, which is committed after the vectors
+        are flushed, so a reader never sees a row without its vector. One process adds
+        images (the build), any number of processes search.
+
+        Args:
+            vectors_path (str): Path to the signature file
+            metadata_path (str): Path to the SQLite file with the product of every row
+        """
+        self.vectors_path = vectors_path
+        self.metadata_path = metadata_path
+        self.lock = threading.Lock()
+        self.vectors = None
+        self.count = 0
+        self.counters = {
+            "searches": 0,
+            "searchSeconds": 0.0,
+        }
+
+        self.conn = sqlite3.connect(metadata_path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS images (
+                row INTEGER PRIMARY KEY,
+                product_id TEXT NOT NULL,
+                image_url TEXT NOT NULL UNIQUE,
+                title TEXT,
+                added_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.commit()
+        if not os.path.exists(vectors_path):
+            open(vectors_path, "wb").close()
+        self._reload()
+
+    def close(self):
+        self.vectors = None
+        self.conn.close()
+
+    def _reload(self):
+        # maps the rows committed so far, called again when another process added some
+        count = self.conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+        if count:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.uint64, mode="r", shape=(count, SIGNATURE_WORDS))
+        else:
+            self.vectors = np.zeros((0, SIGNATURE_WORDS), dtype=np.uint64)
+        self.count = count
+
+    def _refresh(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+        if count != self.count:
+            self._reload()
+
+    def indexed_urls(self, image_urls: Iterable[str]) -> set:
+        """
+        Image URLs of a batch that are already indexed
+        """
+        image_urls = list(image_urls)
+        if not image_urls:
+            return set()
+        placeholders = ", ".join("?" for _ in image_urls)
+        with self.lock:
+            rows = self.conn.execute(f"SELECT image_url FROM images WHERE image_url IN ({placeholders})", image_urls).fetchall()
+        return {row[0] for row in rows}
+
+    def add(self, items: List[Tuple[str, str, Optional[str], np.ndarray]]) -> int:
+        """
+        Append images to the index
+
+        Args:
+            items (list): (product id, image url, title, signature) of images not indexed yet
+
+        Returns:
+            int: Amount of images added
+        """
+        if not items:
+            return 0
+        with self.lock:
+            start = self.conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+            end = start + len(items)
+
+            # grow the file by whole chunks, not on every batch
+            row_bytes = SIGNATURE_WORDS * 8
+            size = os.path.getsize(self.vectors_path)
+            if size < end * row_bytes:
+                with open(self.vectors_path, "r+b") as f:
+                    f.truncate(max(end, start + GROW_ROWS, 2 * size // row_bytes) * row_bytes)
+
+            vectors = np.memmap(self.vectors_path, dtype=np.uint64, mode="r+", offset=start * row_bytes, shape=(len(items), SIGNATURE_WORDS))
+            vectors[:] = np.stack([signature for _, _, _, signature in items])
+            vectors.flush()
+            del vectors
+
+            now = time.time()
+            self.conn.executemany(
+                "INSERT INTO images (row, product_id, image_url, title, added_at) VALUES (?, ?, ?, ?, ?)",
+                [(start + i, product_id, image_url, title, now) for i, (product_id, image_url, title, _) in enumerate(items)]
+            )
+            self.conn.commit()
+            self._reload()
+        return len(items)
+
+    def nearest(self, signatures: np.ndarray, k: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Nearest rows of a batch of signatures by Hamming distance
+
+        Args:
+            signatures (np.ndarray): (queries, SIGNATURE_WORDS) uint64
+            k (int): Neighbours per query
+
+        Returns:
+            tuple: rows and distances, both (queries, k) sorted by distance (fewer if the index is smaller)
+        """
+        with self.lock:
+            self._refresh()
+            vectors = self.vectors
+        signatures = np.atleast_2d(signatures).astype(np.uint64)
+        queries = len(signatures)
+        k = min(k, len(vectors))
+        if k == 0:
+            return np.zeros((queries, 0), dtype=np.int64), np.zeros((queries, 0), dtype=np.int64)
+
+        chunk_rows = max(1024, SEARCH_CHUNK_PAIRS // queries)
+        best_rows = np.zeros((queries, 0), dtype=np.int64)
+        best_distances = np.zeros((queries, 0), dtype=np.int64)
+        for start in range(0, len(vectors), chunk_rows):
+            chunk = np.asarray(vectors[start:start + chunk_rows])
+            # (queries, rows) distances in one pass
+            distances = _popcount(signatures[:, None, :] ^ chunk[None, :, :]).sum(axis=-1, dtype=np.int64)
+
+            # keep the k best of this chunk and of the previous ones
+            chunk_k = min(k, distances.shape[1])
+            top = np.argpartition(distances, chunk_k - 1, axis=1)[:, :chunk_k]
+            rows = np.concatenate([best_rows, top + start], axis=1)
+            merged = np.concatenate([best_distances, np.take_along_axis(distances, top, axis=1)], axis=1)
+            keep = np.argsort(merged, axis=1, kind="stable")[:, :k]
+            best_rows = np.take_along_axis(rows, keep, axis=1)
+            best_distances = np.take_along_axis(merged, keep, axis=1)
+
+        return best_rows, best_distances
+
+    def search_image(self, data: bytes, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        Find the catalogue images most similar to an image
+
+        Args:
+            data (bytes): Encoded query image
+            limit (int): Max amount of matches
+
+        Returns:
+            list: productId, imageUrl, title, distance (differing bits) and score (1 = identical), most similar first
+        """
+        signature = image_signature(data)
+
+        start_time = time.perf_counter()
+        rows, distances = self.nearest(signature[None, :], limit)
+        rows, distances = rows[0].tolist(), distances[0].tolist()
+
+        with self.lock:
+            metadata = {}
+            if rows:
+                placeholders = ", ".join("?" for _ in rows)
+                metadata = {
+                    row: (product_id, image_url, title)
+                    for row, product_id, image_url, title in self.conn.execute(
+                        f"SELECT row, product_id, image_url, title FROM images WHERE row IN ({placeholders})", rows
+                    )
+                }
+            self.counters["searches"] += 1
+            self.counters["searchSeconds"] += time.perf_counter() - start_time
+
+        return [
+            {
+                "productId": metadata[row][0],
+                "imageUrl": metadata[row][1],
+                "title": metadata[row][2],
+                "distance": distance,
+                "score": round(1 - distance / SIGNATURE_BITS, 4),
+            }
+            for row, distance in zip(rows, distances) if row in metadata
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            searches = self.counters["searches"]
+            return {
+                "images": self.count,
+                "searches": searches,
+                "avgSearchMs": round(self.counters["searchSeconds"] / searches * 1000, 3) if searches else None,
+            }
+
+def iter_vision_csv(path: str) -> Iterator[Tuple[str, str, Optional[str]]]:
+    """
+    (product id, image url, title) of a Vision Product Search import CSV (see firebaseProductsTo-csv.py)
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            if row.get("image_uri") and row.get("product_id"):
+                yield row["product_id"], row["image_uri"], row.get("product_display_name")
+
+def iter_catalogue(path: str) -> Iterator[Tuple[str, str, Optional[str]]]:
+    """
+    (product id, image url, title) of the products of the catalogue index (merchant_crawler/catalogue_index.py)
+    """
+    conn = sqlite3.connect(path)
+    try:
+        yield from conn.execute("SELECT product_id, image_url, title FROM products WHERE image_url LIKE 'http%' ORDER BY id")
+    finally:
+        conn.close()
+
+def build_image_index(
+    index: ImageIndex,
+    products: Iterable[Tuple[str, str, Optional[str]]],
+    workers: int = DOWNLOAD_WORKERS,
+    batch_size: int = ADD_BATCH_SIZE
+) -> Dict[str, int]:
+    """
+    Download and index the images not indexed yet, images are searchable as soon as their batch is added
+
+    Args:
+        index (ImageIndex): Index to add to
+        products (iterable): (product id, image url, title)
+        workers (int): Images downloaded and hashed at once
+        batch_size (int): Images per batch
+
+    Returns:
+        dict: Amount of images added, skipped (already indexed) and failed
+    """
+    counts = {"added": 0, "skipped": 0, "failed": 0}
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+    def signature_of(product):
+        product_id, image_url, title = product
+        try:
+            response = session.get(image_url, timeout=30)
+            response.raise_for_status()
+            return product_id, image_url, title, image_signature(response.content)
+        except Exception as e:
+            print(f"Error indexing {image_url}: {e}")
+            return None
+
+    def batches():
+        batch = []
+        for product in products:
+            batch.append(product)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in batches():
+            indexed = index.indexed_urls(image_url for _, image_url, _ in batch)
+            seen = set()
+            todo = []
+            for product in batch:
+                if product[1] in indexed or product[1] in seen:
+                    counts["skipped"] += 1
+                    continue
+                seen.add(product[1])
+                todo.append(product)
+
+            items = [item for item in executor.map(signature_of, todo) if item is not None]
+            counts["failed"] += len(todo) - len(items)
+            counts["added"] += index.add(items)
+            print(f"Image index: {counts}")
+
+    return counts
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Add the catalogue images to the local visual similarity index")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--csv", help="Vision Product Search import CSV (image_uri, product_id, product_display_name)")
+    source.add_argument("--catalogue", help="Catalogue index SQLite file")
+    parser.add_argument("--vectors", default=IMAGE_VECTORS_PATH)
+    parser.add_argument("--metadata", default=IMAGE_METADATA_PATH)
+    parser.add_argument("--workers", type=int, default=DOWNLOAD_WORKERS)
+    parser.add_argument("--query", help="Image file to search for once the index is built")
+    args = parser.parse_args()
+
+    index = ImageIndex(args.vectors, args.metadata)
+    products = iter_vision_csv(args.csv) if args.csv else iter_catalogue(args.catalogue)
+    print(f"Done: {build_image_index(index, products, workers=args.workers)} - {index.stats()}")
+
+    if args.query:
+        with open(args.query, "rb") as f:
+            for match in index.search_image(f.read()):
+                print(match)
+    index.close()
@@ -1,12 +1,12 @@
 from datetime import datetime
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from pydantic import BaseModel
+from typing import List, Optional
 from dotenv import load_dotenv
 import os
 import requests
 import base64
 import json
-from bs4 import BeautifulSoup
 import json
 import time
 import aiohttp
@@ -14,9 +14,19 @@ import asyncio
 import firebase_admin
 from firebase_admin import credentials, firestore
 import logging
-from uuid import uuid5, NAMESPACE_DNS
-from urllib.parse import urlparse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from search_client import GoogleSearchClient
+from http_pool import SharedHTTPSession
+from search_cache import create_search_cache
+from product_cache import ProductPageCache
+from merchant_crawler.jsonld_extractor import scan_json_ld_stream, is_product_json_ld
+from product_extraction import Product, get_seller_from_url, extract_json_ld, extract_json_ld_from_scripts
+from parse_executor import ParseExecutor
+from image_index import ImageIndex
+from merchant_crawler.firestore_sink import FirestoreSink
+from merchant_crawler.catalogue_index import CatalogueIndex, CatalogueFacets
 
 load_dotenv()
 
@@ -34,6 +44,53 @@ app.add_middleware(
 SEARCH_ENGINE_ID_BAGHAVEN = os.getenv("SEARCH_ENGINE_ID_BAGHAVEN")
 GOOGLE_API_KEY = os.getenv("GOOGLE_VISION_API_KEY")
 HTML_FETCH_TIMEOUT = 2
+HTML_CHUNK_SIZE = 64 * 1024
+
+# stop downloading a page at its first product JSON-LD script (off by default: later
+# scripts can hold more variants, a ProductGroup or an @graph of products)
+JSONLD_STOP_AT_PRODUCT = os.getenv("JSONLD_STOP_AT_PRODUCT", "false").lower() == "true"
+
+# cache for the custom search pages ("memory", "sqlite" or "none")
+SEARCH_CACHE_BACKEND = os.getenv("SEARCH_CACHE_BACKEND", "memory")
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", 3600))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 1000))
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", "search_cache.sqlite3")
+
+# cache of the products parsed from each context link
+PRODUCT_CACHE_ENABLED = os.getenv("PRODUCT_CACHE_ENABLED", "true").lower() == "true"
+PRODUCT_CACHE_PATH = os.getenv("PRODUCT_CACHE_PATH", "product_cache.sqlite3")
+PRODUCT_CACHE_MAX_ENTRIES = int(os.getenv("PRODUCT_CACHE_MAX_ENTRIES", 10000))
+PRODUCT_CACHE_FRESH_FOR = int(os.getenv("PRODUCT_CACHE_FRESH_FOR", 900))
+
+# where the pages are scanned and parsed: "thread", "process" or "inline" (on the event loop)
+# threads share the GIL with the event loop, use "process" to spread the parsing over the cores
+PARSE_EXECUTOR_MODE = os.getenv("PARSE_EXECUTOR_MODE", "thread")
+PARSE_EXECUTOR_WORKERS = int(os.getenv("PARSE_EXECUTOR_WORKERS", 0)) or None
+
+# connection pool used to fetch the merchant pages
+HTML_POOL_LIMIT = int(os.getenv("HTML_POOL_LIMIT", 100))
+HTML_POOL_LIMIT_PER_HOST = int(os.getenv("HTML_POOL_LIMIT_PER_HOST", 10))
+HTML_POOL_DNS_TTL = int(os.getenv("HTML_POOL_DNS_TTL", 300))
+HTML_POOL_KEEPALIVE = float(os.getenv("HTML_POOL_KEEPALIVE", 30))
+
+# write-behind Firestore writes: batch size (max 500), seconds a write can wait, commits in flight
+FIRESTORE_BATCH_SIZE = int(os.getenv("FIRESTORE_BATCH_SIZE", 500))
+FIRESTORE_FLUSH_INTERVAL = float(os.getenv("FIRESTORE_FLUSH_INTERVAL", 1.0))
+FIRESTORE_MAX_CONCURRENT_COMMITS = int(os.getenv("FIRESTORE_MAX_CONCURRENT_COMMITS", 4))
+
+# local full-text index of the crawled products (kept up to date by merchant_crawler)
+CATALOGUE_INDEX_ENABLED = os.getenv("CATALOGUE_INDEX_ENABLED", "true").lower() == "true"
+CATALOGUE_INDEX_PATH = os.getenv("CATALOGUE_INDEX_PATH", "catalogue_index.sqlite3")
+# source "localFirst": local hits are returned without the live search when there are at least this many
+LOCAL_SEARCH_MIN_RESULTS = int(os.getenv("LOCAL_SEARCH_MIN_RESULTS", 10))
+LOCAL_SEARCH_LIMIT = int(os.getenv("LOCAL_SEARCH_LIMIT", 50))
+SEARCH_SOURCES = ("live", "local", "localFirst")
+
+# local visual similarity index (built with image_index.py), instead of Vision Product Search
+IMAGE_INDEX_ENABLED = os.getenv("IMAGE_INDEX_ENABLED", "true").lower() == "true"
+IMAGE_INDEX_VECTORS_PATH = os.getenv("IMAGE_INDEX_VECTORS_PATH", "image_index.u64")
+IMAGE_INDEX_METADATA_PATH = os.getenv("IMAGE_INDEX_METADATA_PATH", "image_index.sqlite3")
+IMAGE_SEARCH_MAX_BYTES = int(os.getenv("IMAGE_SEARCH_MAX_BYTES", 10 * 1024 * 1024))
 
 # fetch firebase credentials
 print("Fetching firebase credentials...")
@@ -45,6 +102,49 @@ print("Initializing firestore...")
 db = firestore.client()
 print("Initializing firestore done")
 
+# writes are buffered and committed in batches in the background, never on the request path
+firestore_sink = FirestoreSink(
+    db,
+    batch_size=FIRESTORE_BATCH_SIZE,
+    flush_interval=FIRESTORE_FLUSH_INTERVAL,
+    max_concurrent_commits=FIRESTORE_MAX_CONCURRENT_COMMITS
+)
+
+# shared custom search client (one pooled session for the whole app)
+search_cache = create_search_cache(
+    backend=SEARCH_CACHE_BACKEND,
+    ttl=SEARCH_CACHE_TTL,
+    max_entries=SEARCH_CACHE_MAX_ENTRIES,
+    path=SEARCH_CACHE_PATH
+)
+search_client = GoogleSearchClient(GOOGLE_API_KEY, SEARCH_ENGINE_ID_BAGHAVEN, cache=search_cache)
+
+# shared session for the merchant pages (keeps connections and DNS warm between searches)
+html_session = SharedHTTPSession(
+    limit=HTML_POOL_LIMIT,
+    limit_per_host=HTML_POOL_LIMIT_PER_HOST,
+    dns_ttl=HTML_POOL_DNS_TTL,
+    keepalive_timeout=HTML_POOL_KEEPALIVE
+)
+
+# products already parsed per context link (revalidated with ETag / Last-Modified)
+product_cache = ProductPageCache(
+    path=PRODUCT_CACHE_PATH,
+    max_entries=PRODUCT_CACHE_MAX_ENTRIES,
+    fresh_for=PRODUCT_CACHE_FRESH_FOR
+) if PRODUCT_CACHE_ENABLED else None
+
+# products already crawled, searched before (or instead of) the live search
+catalogue_index = CatalogueIndex(CATALOGUE_INDEX_PATH) if CATALOGUE_INDEX_ENABLED else None
+# facet bitmaps of the catalogue, loaded on the first query and refreshed incrementally
+catalogue_facets = CatalogueFacets(catalogue_index) if catalogue_index else None
+
+# perceptual hashes of the catalogue images, memory-mapped
+image_index = ImageIndex(IMAGE_INDEX_VECTORS_PATH, IMAGE_INDEX_METADATA_PATH) if IMAGE_INDEX_ENABLED else None
+
+# workers that parse the pages off the event loop
+parse_executor = ParseExecutor(mode=PARSE_EXECUTOR_MODE, max_workers=PARSE_EXECUTOR_WORKERS)
+
 # configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -59,22 +159,22 @@ logger = logging.getLogger("Merchant Backend API")
 class SearchRequest(BaseModel):
     query: str
     pages: int
-
-# products class
-class Product(BaseModel):
-    productId: str
-    id: str
-    url: str
-    title: str
-    imageURL: str
-    description: str
-    price: float
-    seller: str
-    isOriginal: bool
-    offerType: str
-    priceCurrency: str
-    timeCreated: datetime
-    availability: str
+    bypassCache: bool = False
+    # "live": Google search + merchant pages, "local": catalogue index only,
+    # "localFirst": catalogue index, live search only when it has too few hits (or the index is disabled)
+    source: str = "live"
+
+class CatalogueQuery(BaseModel):
+    query: str = ""
+    sellers: List[str] = []
+    availability: List[str] = []
+    colors: List[str] = []
+    sizes: List[str] = []
+    priceCurrency: List[str] = []
+    minPrice: Optional[float] = None
+    maxPrice: Optional[float] = None
+    limit: int = 20
+    offset: int = 0
 
 """
 # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=- #
@@ -84,17 +184,11 @@ class Product(BaseModel):
 
 # save to firestore - not tested yet
 def save_batch_to_firebase(data_list, collection_name="products"):
-    batch = db.batch()
-    collection_ref = db.collection(collection_name)
-    
-    for data in data_list:
-        doc_ref = collection_ref.document()  # Auto-generate document ID
-        batch.set(doc_ref, data)
-
-    # Commit the batch
+    # queued on the sink, committed in batches of up to 500 in the background
     try:
-        batch.commit()
-        print(f"Batch write completed with {len(data_list)} documents.")
+        for data in data_list:
+            firestore_sink.set(collection_name, None, data)  # Auto-generate document ID
+        print(f"Batch write queued with {len(data_list)} documents.")
     except Exception as e:
         print(f"Error in batch write: {e}")
 
@@ -122,129 +216,140 @@ def search_image_google_vision(image_path, api_key):
         return {"error": response.text}
 
 # performs the google search
-def perform_google_text_search(query, start):
-    # this function performs the google search multiple times
-    print(f"Starting at page {start}")
-    try:
-        url = f"https://www.googleapis.com/customsearch/v1"
-        params = {
-            "key": GOOGLE_API_KEY,
-            "cx": SEARCH_ENGINE_ID_BAGHAVEN,
-            "q": query,
-            "searchType": "image",
-            "num": 10,
-            "start": start
-        }
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        data = response.json()
-        
-        raw_search_results = data.get("items", [])
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    
-    return raw_search_results
+async def perform_google_text_search(query, start):
+    # fetches a single page of results through the shared search client
+    return await search_client.search_page(query, start)
 
 
-async def fetch_html_async(url, session):
+async def fetch_html_async(url, session, headers=None):
     print(f"Fetching {url}...")
     try:
-        async with session.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=HTML_FETCH_TIMEOUT) as response:
-            print(f"Content-Type: {response.headers['Content-Type']}")
+        request_headers = {"User-Agent": "Mozilla/5.0", **(headers or {})}
+        async with session.get(url, headers=request_headers, timeout=HTML_FETCH_TIMEOUT) as response:
+            print(f"Content-Type: {response.headers.get('Content-Type')}")
             response.raise_for_status()
 
             print(f"[SUCCESS] - Status code: {response.status} - {url}\n")
-            responseText = await response.text()
-            return {"url": url, "html": responseText}
+
+            # the body is scanned for the JSON-LD scripts on a parse worker, together with the parse.
+            # Stopping at the first product needs the scripts as the body downloads, so that
+            # scan runs here on the event loop
+            body = None
+            scripts = None
+            encoding = response.charset or "utf-8"
+            if response.status != 304:
+                if JSONLD_STOP_AT_PRODUCT:
+                    scripts, stoppedEarly = await scan_json_ld_stream(
+                        response.content.iter_chunked(HTML_CHUNK_SIZE),
+                        encoding=encoding,
+                        stop_when=is_product_json_ld
+                    )
+                    if stoppedEarly:
+                        print(f"[EARLY STOP] - Product JSON-LD found - {url}")
+                else:
+                    body = await response.read()
+
+            return {
+                "url": url,
+                "body": body,
+                "encoding": encoding,
+                "jsonLdScripts": scripts,
+                "status": response.status,
+                "etag": response.headers.get("ETag"),
+                "lastModified": response.headers.get("Last-Modified"),
+            }
     except Exception as e:
         
         # save these errors somewhere else -- just to check on why they are failing
         print(f"Error fetching {url}: {e}\n")
         return None
 
-async def fetch_and_extract(urls):
+async def fetch_and_extract_url(url, session, use_cache=True):
+    """
+    Fetch a context link and extract its products, going through the product cache
+
+    Args:
+        url (str): Context link to fetch
+        session (aiohttp.ClientSession): Shared session
+        use_cache (bool): False to skip the cached entry and always re-download (the result is still stored)
+
+    Returns:
+        list: Product dicts, or None if the page could not be fetched
+    """
+    entry = None
+    if product_cache is not None:
+        if use_cache:
+            # sqlite reads and commits stay off the event loop
+            entry = await asyncio.to_thread(product_cache.get, url)
+        else:
+            product_cache.counters["bypassed"] += 1
+
+    # still fresh, don't even ask the merchant
+    if entry is not None and product_cache.is_fresh(entry):
+        product_cache.counters["freshHits"] += 1
+        print(f"[CACHE] - Fresh - {url}")
+        return entry["products"]
+
+    headers = product_cache.conditional_headers(entry) if entry is not None else None
+    htmlObject = await fetch_html_async(url, session, headers)
+    if not htmlObject:
+        return None
+
+    # page didn't change since we parsed it, skip the parse
+    if htmlObject["status"] == 304 and entry is not None:
+        product_cache.counters["revalidated"] += 1
+        await asyncio.to_thread(product_cache.touch, url)
+        print(f"[CACHE] - Not Modified - {url}")
+        return entry["products"]
+
+    # scan and parse on a worker as soon as this page arrives
+    if htmlObject["jsonLdScripts"] is not None:
+        products = await parse_executor.run(extract_json_ld_from_scripts, htmlObject["jsonLdScripts"], url)
+    else:
+        products = await parse_executor.run(extract_json_ld, htmlObject["body"] or b"", url, htmlObject["encoding"])
+
+    if product_cache is not None:
+        if use_cache:
+            product_cache.counters["misses"] += 1
+        await asyncio.to_thread(product_cache.set, url, products, htmlObject["etag"], htmlObject["lastModified"])
+    return products
+
+async def fetch_and_extract(urls, use_cache=True):
     print("Fetching and extracting JSON-LD...")
-    html_list = await fetch_all_html(urls)
+    session = html_session.session
+    tasks = [fetch_and_extract_url(url, session, use_cache) for url in urls]
     results = []
 
-    # print(f"Results: {[(html['url'], len(html['html'])) for html in html_list if html]}\n\n")
-    
-    # create the product objects that you will send to the frontend
-    for htmlObject in html_list:
-        if htmlObject:
-
-            # create the product object from the json ld and url
-            url = htmlObject["url"]
-            html = htmlObject["html"]
-            json_ld = extract_json_ld(html, url)
-            results.extend(json_ld)
+    # create the product objects that you will send to the frontend, in search order
+    for products in await asyncio.gather(*tasks):
+        if products:
+            results.extend(products)
     return results
 
+async def fetch_and_extract_stream(urls, use_cache=True):
+    """
+    Fetch and extract every url, yielding each page as soon as it is done
 
-async def fetch_all_html(urls):
-    async with aiohttp.ClientSession() as session:
-        tasks = [fetch_html_async(url, session) for url in urls]
-        return await asyncio.gather(*tasks)
-
-def get_seller_from_url(url):
-    parsed_url = urlparse(url)
-    domain = parsed_url.netloc
-    return domain
-
-def extract_json_ld(html, url):
-    soup = BeautifulSoup(html, "html.parser")
-    json_ld = []
-    for script in soup.find_all("script", type="application/ld+json"):
-        try:
-            data = json.loads(script.string)
-
-            # # check if data is a list so that we only get lists of objects
-            if isinstance(data, list):
-                # get only the products in the array
-                data = data[0]
-            
-            
-            
-            # we only care about Products and Organizations (TODO: Add Logic for Organizations)
-            if data.get("@type", None) != "Product":
-                print(f"Skipping {url} because it is not a product...")
-                continue
+    Args:
+        urls (list): Context links to fetch
+        use_cache (bool): False to bypass the product cache
 
-            # get the seller
-            seller = "Unknown Seller"
-
-            if uid := data.get("@id", None):
-                seller = get_seller_from_url(uid)
-
-            # create a new product object
-            product = Product(
-                id=data.get("@id", None),
-                productId=uuid5(NAMESPACE_DNS, data.get("@id", None)).hex,
-                url=url,
-                title=data.get("name", "No Title"),
-                imageURL=data.get("image", [None])[0] if data.get("image") else "No Image URL",
-                description=data.get("description", "No Description"),
-                price=data.get("offers", {}).get("price", -1.0),
-                seller=seller,
-                isOriginal=data.get("isOriginal", False),
-                offerType=data.get("offers", {}).get("@type", "Unknown Offer Type"),
-                priceCurrency=data.get("offers", {}).get("priceCurrency", "USD"),
-                timeCreated=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                availability=data.get("offers", {}).get("availability", "Unknown Availability")
-            )
-            print("Created Product Object...")
-            
-
-            
-
-            print(f"===Extracted JSON-LD for URL: {url}===\n")
-            json_ld.append(product.__dict__)
-        except (json.JSONDecodeError, TypeError, Exception) as e:
-            print(f"Error parsing JSON-LD for {url}, Error Message: {e}\n")
-            print("Skipping...")
-            continue
-    return json_ld
+    Yields:
+        tuple: (url, list of product dicts or None if the fetch failed)
+    """
+    session = html_session.session
 
+    async def fetch_with_url(url):
+        return url, await fetch_and_extract_url(url, session, use_cache)
+
+    tasks = [asyncio.create_task(fetch_with_url(url)) for url in urls]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # the client may disconnect mid stream, don't leave fetches running
+        for task in tasks:
+            task.cancel()
 
 def extract_product_originization_info(json_ld):
     print("Extracting product originization info...")
@@ -256,11 +361,133 @@ def extract_product_originization_info(json_ld):
 # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=- #
 """
 
+@app.on_event("startup")
+async def startup():
+    await search_client.start()
+    await html_session.start()
+    parse_executor.start()
+    firestore_sink.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await search_client.close()
+    await html_session.close()
+    parse_executor.close()
+    # commit what is still buffered
+    await asyncio.to_thread(firestore_sink.close)
+    if catalogue_index:
+        catalogue_index.close()
+    if image_index:
+        image_index.close()
+
+
 @app.get("/")
 async def home():
     return {"message": "This is the home route"}
 
 
+@app.get("/api/poolStats")
+async def pool_stats():
+    return {"html": html_session.stats(), "parse": parse_executor.stats(), "firestore": firestore_sink.stats()}
+
+
+@app.get("/api/cacheStats")
+async def cache_stats():
+    return {
+        "search": search_cache.stats() if search_cache else None,
+        "products": product_cache.stats() if product_cache else None,
+        "catalogue": catalogue_index.stats() if catalogue_index else None,
+        "facets": catalogue_facets.stats() if catalogue_facets else None,
+        "images": image_index.stats() if image_index else None,
+    }
+
+
+@app.get("/api/catalogueSearch")
+async def catalogue_search(query: str, limit: int = 20, offset: int = 0):
+    """
+    Search the products already crawled, in the local catalogue index only
+    """
+    if catalogue_index is None:
+        raise HTTPException(status_code=404, detail="Catalogue index is disabled")
+    if not 0 < limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+
+    startTime = time.time()
+    products = await asyncio.to_thread(catalogue_index.search, query, limit, offset)
+    return {
+        "products": products,
+        "count": len(products),
+        "time": round(time.time() - startTime, 4),
+    }
+
+
+@app.post("/api/catalogueQuery")
+async def catalogue_query(request: CatalogueQuery):
+    """
+    Filter the crawled products by seller, availability, color, size, currency and price range
+    (optionally within a text search), with the product count of every facet value
+    """
+    if catalogue_facets is None:
+        raise HTTPException(status_code=404, detail="Catalogue index is disabled")
+    if not 0 < request.limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+
+    startTime = time.time()
+    filters = {
+        "seller": request.sellers,
+        "availability": request.availability,
+        "color": request.colors,
+        "size": request.sizes,
+        "priceCurrency": request.priceCurrency,
+    }
+    result = await asyncio.to_thread(
+        catalogue_facets.query,
+        filters,
+        min_price=request.minPrice,
+        max_price=request.maxPrice,
+        text=request.query,
+        limit=request.limit,
+        offset=request.offset
+    )
+    return {**result, "time": round(time.time() - startTime, 4)}
+
+
+@app.post("/api/imageSearch")
+async def image_search(request: Request, limit: int = 10):
+    """
+    Find the catalogue products whose image looks like the uploaded one, the raw image
+    (JPEG, PNG, WebP, ...) is the request body
+    """
+    if image_index is None:
+        raise HTTPException(status_code=404, detail="Image index is disabled")
+    if not 0 < limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+
+    data = await request.body()
+    if not data:
+        raise HTTPException(status_code=400, detail="The request body must be an image")
+    if len(data) > IMAGE_SEARCH_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Images are limited to {IMAGE_SEARCH_MAX_BYTES} bytes")
+
+    startTime = time.time()
+    try:
+        matches = await asyncio.to_thread(image_index.search_image, data, limit)
+    except RuntimeError as e:
+        # Pillow is not installed, the index can't compute the signature of the query image
+        logger.error(f"Image search unavailable: {e}")
+        raise HTTPException(status_code=503, detail="Image search is unavailable")
+    except (OSError, ValueError) as e:
+        # Pillow raises UnidentifiedImageError (an OSError) for anything that is not an image
+        raise HTTPException(status_code=400, detail=f"Could not read the image: {e}")
+
+    return {
+        "matches": matches,
+        "count": len(matches),
+        "time": round(time.time() - startTime, 4),
+    }
+
+
 @app.post("/api/productSearch")
 async def generic_search(request: SearchRequest):
 
@@ -272,19 +499,28 @@ async def generic_search(request: SearchRequest):
 
     if pagesToQuery > 10:
         raise HTTPException(status_code=400, detail="Must query at Most 9 Pages")
+    if request.source not in SEARCH_SOURCES:
+        raise HTTPException(status_code=400, detail=f"source must be one of {', '.join(SEARCH_SOURCES)}")
+    if request.source == "local" and catalogue_index is None:
+        # only "localFirst" falls back to the live search, "local" never costs a Custom Search query
+        raise HTTPException(status_code=503, detail="Catalogue index is disabled")
     # final result that we send to the front end
     result = {}
 
     try:
-        
-        beforeSearchTime = time.time()
+        # products we already crawled, answered from the local index in milliseconds
+        localProducts = []
+        if request.source != "live" and catalogue_index is not None:
+            localProducts = await asyncio.to_thread(catalogue_index.search, query, LOCAL_SEARCH_LIMIT)
+            print(f"Local Results Amount: {len(localProducts)} ({time.time() - startTime:.3f} seconds)")
 
-        # perform google search
-        raw_search_results = perform_google_text_search(query, 1)
+            if request.source == "local" or len(localProducts) >= LOCAL_SEARCH_MIN_RESULTS:
+                return localProducts
+
+        beforeSearchTime = time.time()
 
-        # perform search the amount of pages
-        for i in range(2, pagesToQuery+1):
-            raw_search_results.extend(perform_google_text_search(query, (i*10)))
+        # perform google search for all the pages concurrently
+        raw_search_results = await search_client.search(query, pagesToQuery)
         
         # log search time taken
         print(f"Search Results Amount: {len(raw_search_results)}")
@@ -296,7 +532,7 @@ async def generic_search(request: SearchRequest):
         print("Analyzing Context Links...")
         urls = [result["image"]["contextLink"] for result in raw_search_results]
 
-        extracted_data = await fetch_and_extract(urls)
+        extracted_data = await fetch_and_extract(urls, use_cache=not request.bypassCache)
 
         print(f"Extracted Data Amount: {len(extracted_data)}")
         
@@ -309,6 +545,11 @@ async def generic_search(request: SearchRequest):
         print(f"Total Execution Time: {timeTaken:.2f} seconds")
         logger.info(f"Total Execution Time: {timeTaken:.2f} seconds")
 
+        # local hits first, then the live products we didn't have
+        if localProducts:
+            localUrls = {product["url"] for product in localProducts}
+            extracted_data = localProducts + [product for product in extracted_data if product.get("url") not in localUrls]
+
         # TODO: Send diagnostic info to firebase/database
         return extracted_data
 
@@ -317,6 +558,69 @@ async def generic_search(request: SearchRequest):
         print(e)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/productSearch/stream")
+async def generic_search_stream(request: SearchRequest):
+    """
+    Same as /api/productSearch but streams the products back as NDJSON.
+    Every line is a frame: {"type": "product", ...} as soon as a page has been
+    parsed, then a final {"type": "summary", ...} frame with timings and failures.
+    """
+
+    query = request.query
+    pagesToQuery = request.pages
+
+    startTime = time.time()
+
+    if pagesToQuery > 10:
+        raise HTTPException(status_code=400, detail="Must query at Most 9 Pages")
+
+    # the search itself is not streamed so errors are still returned as a 500
+    try:
+        raw_search_results = await search_client.search(query, pagesToQuery)
+        urls = [result["image"]["contextLink"] for result in raw_search_results]
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    searchTime = time.time() - startTime
+    print(f"Search Results Amount: {len(raw_search_results)}")
+    print(f"Search Execution Time: {searchTime:.2f} seconds")
+
+    async def stream_products():
+        firstResultTime = None
+        productsSent = 0
+        pagesFetched = 0
+        failedUrls = []
+
+        async for url, products in fetch_and_extract_stream(urls, use_cache=not request.bypassCache):
+            if products is None:
+                failedUrls.append(url)
+                continue
+
+            pagesFetched += 1
+            for product in products:
+                if firstResultTime is None:
+                    firstResultTime = time.time() - startTime
+                productsSent += 1
+                yield json.dumps({"type": "product", "product": jsonable_encoder(product)}) + "\n"
+
+        timeTaken = time.time() - startTime
+        logger.info(f"Total Stream Execution Time: {timeTaken:.2f} seconds")
+
+        summary = {
+            "type": "summary",
+            "searchResults": len(raw_search_results),
+            "pagesFetched": pagesFetched,
+            "productsSent": productsSent,
+            "failedUrls": failedUrls,
+            "searchTime": round(searchTime, 3),
+            "firstResultTime": round(firstResultTime, 3) if firstResultTime is not None else None,
+            "totalTime": round(timeTaken, 3),
+        }
+        yield json.dumps(summary) + "\n"
+
+    return StreamingResponse(stream_products(), media_type="application/x-ndjson")
+
 @app.post("/api/test")
 async def test(request: SearchRequest):
 
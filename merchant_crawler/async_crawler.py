@@ -0,0 +1,392 @@
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+
+from jsonld_extractor import scan_json_ld_stream, load_json_ld_documents
+
+HTML_CHUNK_SIZE = 64 * 1024
+
+# crawl defaults, a domain in domains.json can override the per-domain ones
+CRAWL_CONCURRENCY = 32
+DOMAIN_CONCURRENCY = 4
+DOMAIN_REQUESTS_PER_SECOND = 2.0
+MAX_RETRIES = 3
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+REQUEST_TIMEOUT = 30
+# how many urls are read ahead from the url iterable
+URL_READ_AHEAD = 1000
+
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+ResultHandler = Callable[[str, Optional[List[Dict[str, Any]]], Optional[str]], Awaitable[None]]
+
+def get_domain(url: str) -> str:
+    return urlparse(url).netloc
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a Retry-After header, either seconds or an HTTP date
+
+    Args:
+        value (str): Header value
+
+    Returns:
+        float: Seconds to wait, None if missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class RetryableError(Exception):
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        Token bucket rate limiter
+
+        Args:
+            rate (float): Tokens added per second (0 disables the limit)
+            capacity (float): Max burst, defaults to one second worth of tokens
+        """
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class DomainPolicy:
+    def __init__(self, domain: str, max_concurrency: int = DOMAIN_CONCURRENCY, requests_per_second: float = DOMAIN_REQUESTS_PER_SECOND):
+        """
+        Politeness limits of a single merchant domain
+
+        Args:
+            domain (str): Domain (netloc) the policy applies to
+            max_concurrency (int): Max requests in flight to the domain
+            requests_per_second (float): Sustained request rate to the domain
+        """
+        self.domain = domain
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.bucket = TokenBucket(requests_per_second)
+        # set from Retry-After, pauses every request to the domain
+        self.paused_until = 0.0
+        # pages of the domain taken by a crawl worker, until their retries are over
+        self.claimed = 0
+
+    def try_claim(self) -> bool:
+        """
+        Take a slot of the domain for a page, False if every slot is taken
+
+        Claims are made and released synchronously on the event loop, so checking and
+        taking a slot can't be interleaved with another worker.
+        """
+        if self.claimed >= self.max_concurrency:
+            return False
+        self.claimed += 1
+        return True
+
+    def release_claim(self):
+        self.claimed -= 1
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        try:
+            while (wait := self.paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(wait)
+            await self.bucket.acquire()
+        except BaseException:
+            self.semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.semaphore.release()
+
+class AsyncCrawlEngine:
+    def __init__(
+        self,
+        headers: Optional[Dict[str, str]] = None,
+        concurrency: int = CRAWL_CONCURRENCY,
+        domain_concurrency: int = DOMAIN_CONCURRENCY,
+        domain_requests_per_second: float = DOMAIN_REQUESTS_PER_SECOND,
+        domain_settings: Optional[Dict[str, Dict[str, Any]]] = None,
+        max_retries: int = MAX_RETRIES,
+        backoff_base: float = BACKOFF_BASE,
+        backoff_max: float = BACKOFF_MAX,
+        timeout: float = REQUEST_TIMEOUT,
+        read_ahead: int = URL_READ_AHEAD
+    ):
+        """
+        Asyncio crawl engine: fetches product pages and extracts their JSON-LD
+
+        Args:
+            headers (dict): Request headers
+            concurrency (int): Max requests in flight over every domain
+            domain_concurrency (int): Default max requests in flight per domain
+            domain_requests_per_second (float): Default request rate per domain
+            domain_settings (dict): Per domain overrides, {domain: {"max_concurrency", "requests_per_second"}}
+            max_retries (int): Retries of a page after the first attempt
+            backoff_base (float): Base of the exponential backoff in seconds
+            backoff_max (float): Max backoff in seconds
+            timeout (float): Total timeout of a single request in seconds
+            read_ahead (int): Urls read ahead from every source
+        """
+        self.headers = headers or {}
+        self.concurrency = concurrency
+        self.domain_concurrency = domain_concurrency
+        self.domain_requests_per_second = domain_requests_per_second
+        self.domain_settings = domain_settings or {}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.read_ahead = read_ahead
+        # created per crawl, their semaphores and locks belong to the event loop of that crawl
+        self.policies = {}
+        self.logger = logging.getLogger(__name__)
+        self.stats = {}
+
+    def policy_for(self, domain: str) -> DomainPolicy:
+        policy = self.policies.get(domain)
+        if policy is None:
+            settings = self.domain_settings.get(domain, {})
+            policy = DomainPolicy(
+                domain,
+                max_concurrency=settings.get("max_concurrency", self.domain_concurrency),
+                requests_per_second=settings.get("requests_per_second", self.domain_requests_per_second)
+            )
+            self.policies[domain] = policy
+        return policy
+
+    def create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency,
+            limit_per_host=max([self.domain_concurrency] + [s.get("max_concurrency", 0) for s in self.domain_settings.values()]),
+            ttl_dns_cache=300
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            headers=self.headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
+
+    def backoff(self, attempt: int) -> float:
+        # full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def fetch_json_ld(self, session: aiohttp.ClientSession, url: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        Fetch a page once and extract its JSON-LD documents
+
+        Args:
+            session (aiohttp.ClientSession): Session to use
+            url (str): Product page URL
+
+        Returns:
+            list: JSON-LD documents, None if the page has none
+        """
+        try:
+            async with session.get(url) as response:
+                if response.status in RETRYABLE_STATUSES:
+                    raise RetryableError(
+                        f"HTTP {response.status}",
+                        retry_after=parse_retry_after(response.headers.get("Retry-After"))
+                    )
+                response.raise_for_status()
+
+                scripts, _ = await scan_json_ld_stream(
+                    response.content.iter_chunked(HTML_CHUNK_SIZE),
+                    encoding=response.charset or "utf-8"
+                )
+        except (aiohttp.ClientPayloadError, aiohttp.ServerDisconnectedError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            raise RetryableError(f"{type(e).__name__}: {e}")
+
+        return load_json_ld_documents(scripts) or None
+
+    async def fetch_with_retries(self, session: aiohttp.ClientSession, url: str):
+        """
+        Fetch a page within the domain limits, retrying with jittered backoff
+
+        Returns:
+            tuple: (JSON-LD documents or None, error message or None)
+        """
+        policy = self.policy_for(get_domain(url))
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with policy:
+                    return await self.fetch_json_ld(session, url), None
+            except RetryableError as e:
+                if attempt == self.max_retries:
+                    return None, str(e)
+
+                delay = self.backoff(attempt)
+                if e.retry_after is not None:
+                    # the merchant told us how long to back off, for the whole domain
+                    delay = max(delay, e.retry_after)
+                    policy.pause(e.retry_after)
+
+                self.stats["retries"] += 1
+                self.logger.warning(f"Retrying {url} in {delay:.1f}s ({e}), attempt {attempt + 1}/{self.max_retries}")
+                await asyncio.sleep(delay)
+            except aiohttp.ClientResponseError as e:
+                return None, f"HTTP {e.status}"
+            except Exception as e:
+                return None, f"{type(e).__name__}: {e}"
+
+    async def crawl(self, urls: Iterable[str], handle_result: ResultHandler, session: Optional[aiohttp.ClientSession] = None) -> Dict[str, Any]:
+        """
+        Crawl every url with bounded global concurrency and per domain politeness
+
+        Args:
+            urls (iterable): Product page URLs, can be a (blocking) generator
+            handle_result: Coroutine called with (url, JSON-LD documents or None, error or None)
+            session (aiohttp.ClientSession): Shared session, one is created if not given
+
+        Returns:
+            dict: Crawl stats
+        """
+        return await self.crawl_sources([urls], handle_result, session)
+
+    async def crawl_sources(self, sources: List[Iterable[str]], handle_result: ResultHandler, session: Optional[aiohttp.ClientSession] = None) -> Dict[str, Any]:
+        """
+        Crawl the urls of several sources (e.g. one per merchant) at once
+
+        Every source is read on its own with its own read-ahead, so a source that
+        discovers urls faster than its domain allows fetching them doesn't hold back the
+        others. Domains are served round robin so one large merchant doesn't starve the others.
+
+        Args:
+            sources (list): Iterables of product page URLs, can be (blocking) generators
+            handle_result: Coroutine called with (url, JSON-LD documents or None, error or None)
+            session (aiohttp.ClientSession): Shared session, one is created if not given
+
+        Returns:
+            dict: Crawl stats
+        """
+        self.stats = {"queued": 0, "fetched": 0, "failed": 0, "retries": 0, "elapsed": 0.0}
+        self.policies = {}
+        start_time = time.monotonic()
+
+        # {domain: deque of (url, read ahead semaphore of its source)}, rotated for fairness
+        queues = OrderedDict()
+        queued = 0
+        work_available = asyncio.Condition()
+        feeders_running = len(sources)
+
+        async def feed(urls):
+            nonlocal feeders_running, queued
+            read_ahead = asyncio.Semaphore(self.read_ahead)
+            iterator = iter(urls)
+            sentinel = object()
+            try:
+                while True:
+                    await read_ahead.acquire()
+                    # the iterable may do blocking io (sitemap downloads)
+                    url = await asyncio.to_thread(next, iterator, sentinel)
+                    if url is sentinel:
+                        read_ahead.release()
+                        break
+                    async with work_available:
+                        queues.setdefault(get_domain(url), deque()).append((url, read_ahead))
+                        queued += 1
+                        self.stats["queued"] += 1
+                        work_available.notify()
+            finally:
+                async with work_available:
+                    feeders_running -= 1
+                    work_available.notify_all()
+
+        def pick_url():
+            nonlocal queued
+            # first domain (in rotation) with work and a free slot, the slot is claimed with the url
+            for domain in list(queues):
+                queue = queues[domain]
+                if not queue:
+                    del queues[domain]
+                    continue
+                policy = self.policy_for(domain)
+                if not policy.try_claim():
+                    continue
+                queues.move_to_end(domain)
+                queued -= 1
+                url, read_ahead = queue.popleft()
+                return url, read_ahead, policy
+            return None
+
+        async def worker():
+            while True:
+                async with work_available:
+                    while True:
+                        picked = pick_url()
+                        if picked is not None:
+                            break
+                        if not feeders_running and queued == 0:
+                            return
+                        # woken up by new urls, a released domain slot or the end of the sources
+                        await work_available.wait()
+
+                url, read_ahead, policy = picked
+                try:
+                    json_ld_data, error = await self.fetch_with_retries(session, url)
+                    if error:
+                        self.stats["failed"] += 1
+                        self.logger.error(f"Error fetching product page {url}: {error}")
+                    else:
+                        self.stats["fetched"] += 1
+                    await handle_result(url, json_ld_data, error)
+                except Exception as e:
+                    self.logger.error(f"Error handling result of {url}: {e}")
+                finally:
+                    read_ahead.release()
+                    async with work_available:
+                        policy.release_claim()
+                        work_available.notify_all()
+
+        own_session = session is None
+        if own_session:
+            session = self.create_session()
+        try:
+            feeders = [asyncio.create_task(feed(urls)) for urls in sources]
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+            await asyncio.gather(*feeders)
+        finally:
+            if own_session:
+                await session.close()
+
+        self.stats["elapsed"] = round(time.monotonic() - start_time, 2)
+        return self.stats
@@ -0,0 +1,644 @@
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+from urllib.parse import urlparse
+
+# shared by the crawler (writes) and the API (reads), both run from the repo root
+CATALOGUE_INDEX_PATH = "catalogue_index.sqlite3"
+# seconds a connection waits for the other process' write lock
+BUSY_TIMEOUT = 30
+# relevance weight of each indexed column (title, description, seller, color, size)
+COLUMN_WEIGHTS = (10.0, 1.0, 2.0, 4.0, 4.0)
+# facets of CatalogueFacets, in the order of facet_values
+FACETS = ("seller", "availability", "priceCurrency", "color", "size", "price")
+# lower bounds of the price facet buckets
+PRICE_BUCKETS = (0, 10, 25, 50, 100, 250, 500)
+# min seconds between two refreshes of the facet bitmaps
+FACET_REFRESH_INTERVAL = 2.0
+# columns of the products table returned by the queries, see row_to_product
+# (qualified, products_fts has title, description and seller columns too)
+PRODUCT_COLUMNS = ", ".join(f"products.{column}" for column in (
+    "product_id", "product_key", "url", "title", "description", "seller", "image_url",
+    "price", "price_currency", "availability", "indexed_at",
+))
+
+def _first_image(image: Any) -> Optional[str]:
+    # "image" can be a string, an ImageObject or a list of either
+    if isinstance(image, str):
+        return image or None
+    if isinstance(image, list):
+        for item in image:
+            resolved = _first_image(item)
+            if resolved:
+                return resolved
+        return None
+    if isinstance(image, dict):
+        return image.get("url") or image.get("contentUrl")
+    return None
+
+def _price(price: Any) -> Optional[float]:
+    try:
+        return float(price)
+    except (TypeError, ValueError):
+        return None
+
+def document_to_row(document: Dict[str, Any]) -> tuple:
+    """
+    Index row of a product document written by the crawler (see ProductProcessor.store_product_variants)
+    """
+    url = document.get("productUrl") or document.get("sourceUrl") or document.get("baseUrl")
+    return (
+        document["productId"],
+        document.get("jsonLdId") or url,
+        url,
+        document.get("name") or document.get("baseName"),
+        document.get("description") or document.get("baseDescription"),
+        urlparse(url).netloc if url else None,
+        document.get("color"),
+        document.get("size"),
+        _first_image(document.get("image")) or _first_image(document.get("baseImage")),
+        _price(document.get("price")),
+        document.get("priceCurrency"),
+        document.get("availability"),
+        document.get("contentHash"),
+        time.time(),
+    )
+
+def row_to_product(row: tuple) -> Dict[str, Any]:
+    """
+    Product dict (fields of the API's Product model) of a row selected with PRODUCT_COLUMNS
+    """
+    product_id, product_key, url, title, description, seller, image_url, price, price_currency, availability, indexed_at = row
+    return {
+        "productId": product_id,
+        "id": product_key or url or product_id,
+        "url": url or "",
+        "title": title or "No Title",
+        "imageURL": image_url or "No Image URL",
+        "description": description or "No Description",
+        "price": price if price is not None else -1.0,
+        "seller": seller or "Unknown Seller",
+        "isOriginal": False,
+        "offerType": "Offer",
+        "priceCurrency": price_currency or "USD",
+        "timeCreated": datetime.fromtimestamp(indexed_at).strftime("%Y-%m-%d %H:%M:%S"),
+        "availability": availability or "Unknown Availability",
+    }
+
+def match_expression(query: str) -> Optional[str]:
+    """
+    FTS5 query matching every word of a search query, the last one as a prefix (the user
+    may still be typing it, "stitch backp" finds "stitch backpack")
+
+    Returns:
+        str: MATCH expression, None if the query has no words
+    """
+    words = re.findall(r"\w+", query.lower())
+    if not words:
+        return None
+    # only the last word is expanded, prefix terms are what makes a query slow
+    return " ".join([f'"{word}"' for word in words[:-1]] + [f'"{words[-1]}"*'])
+
+# version of the schema below, kept in PRAGMA user_version of the index file
+SCHEMA_VERSION = 1
+# statements creating the schema, each one a no-op if its object already exists
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS products (
+        id INTEGER PRIMARY KEY,
+        product_id TEXT NOT NULL UNIQUE,
+        product_key TEXT,
+        url TEXT,
+        title TEXT,
+        description TEXT,
+        seller TEXT,
+        color TEXT,
+        size TEXT,
+        image_url TEXT,
+        price REAL,
+        price_currency TEXT,
+        availability TEXT,
+        content_hash TEXT,
+        indexed_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS products_indexed_at ON products (indexed_at)",
+    # last change of every inserted, updated or deleted row, so the facet bitmaps can follow them
+    # incrementally. seq is assigned in the write transaction and only ever increases (unlike a
+    # clock read before the write), a row changed again gets a new seq
+    """
+    CREATE TABLE IF NOT EXISTS product_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        id INTEGER NOT NULL UNIQUE
+    )
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        title, description, seller, color, size,
+        content='products', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    # keep the full-text index and the change log in sync with the products table
+    """
+    CREATE TRIGGER IF NOT EXISTS products_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts (rowid, title, description, seller, color, size)
+        VALUES (new.id, new.title, new.description, new.seller, new.color, new.size);
+        DELETE FROM product_changes WHERE id = new.id;
+        INSERT INTO product_changes (id) VALUES (new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, title, description, seller, color, size)
+        VALUES ('delete', old.id, old.title, old.description, old.seller, old.color, old.size);
+        DELETE FROM product_changes WHERE id = old.id;
+        INSERT INTO product_changes (id) VALUES (old.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_au AFTER UPDATE ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, title, description, seller, color, size)
+        VALUES ('delete', old.id, old.title, old.description, old.seller, old.color, old.size);
+        INSERT INTO products_fts (rowid, title, description, seller, color, size)
+        VALUES (new.id, new.title, new.description, new.seller, new.color, new.size);
+        DELETE FROM product_changes WHERE id = new.id;
+        INSERT INTO product_changes (id) VALUES (new.id);
+    END
+    """,
+)
+# run before SCHEMA on files from before the versioning (user_version 0): their triggers
+# don't write the change log and are created again, removed_products was replaced by it
+LEGACY_SCHEMA = (
+    "DROP TABLE IF EXISTS removed_products",
+    "DROP TRIGGER IF EXISTS products_ai",
+    "DROP TRIGGER IF EXISTS products_ad",
+    "DROP TRIGGER IF EXISTS products_au",
+)
+
+class CatalogueIndex:
+    def __init__(self, path: str = CATALOGUE_INDEX_PATH):
+        """
+        Local full-text index (SQLite FTS5) of the products the crawler stored in Firestore
+
+        Title, description, seller, color and size are searchable, results are ranked with
+        bm25 and returned in the shape of the Product model of the API. The crawler keeps it
+        up to date as its Firestore writes are committed, the API only reads it.
+
+        Args:
+            path (str): Path to the SQLite file
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.counters = {
+            "indexed": 0,
+            "searches": 0,
+            "searchSeconds": 0.0,
+        }
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+
+    def _migrate(self):
+        # the crawler and the API open the same file, a file already at SCHEMA_VERSION is never
+        # written to here, so a write of the other process can't happen between a DROP and its CREATE
+        if self._schema_version() >= SCHEMA_VERSION:
+            return
+        # one write transaction: the other process sees the old schema or the new one, never half of it
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            # checked again with the write lock held, the other process may have just migrated it
+            version = self._schema_version()
+            if version < SCHEMA_VERSION:
+                statements = (LEGACY_SCHEMA if version == 0 else ()) + SCHEMA
+                for statement in statements:
+                    self.conn.execute(statement)
+                self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+    def _schema_version(self) -> int:
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+    def upsert(self, documents: Iterable[Dict[str, Any]]) -> int:
+        """
+        Index product documents, documents whose content hash didn't change are left alone
+
+        Args:
+            documents (iterable): Product documents written by the crawler
+
+        Returns:
+            int: Amount of documents passed
+        """
+        rows = [document_to_row(document) for document in documents if document.get("productId")]
+        if not rows:
+            return 0
+        with self.lock:
+            self.conn.executemany(
+                """
+                INSERT INTO products (
+                    product_id, product_key, url, title, description, seller, color, size,
+                    image_url, price, price_currency, availability, content_hash, indexed_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(product_id) DO UPDATE SET
+                    product_key = excluded.product_key, url = excluded.url, title = excluded.title,
+                    description = excluded.description, seller = excluded.seller, color = excluded.color,
+                    size = excluded.size, image_url = excluded.image_url, price = excluded.price,
+                    price_currency = excluded.price_currency, availability = excluded.availability,
+                    content_hash = excluded.content_hash, indexed_at = excluded.indexed_at
+                WHERE products.content_hash IS NOT excluded.content_hash
+                """,
+                rows
+            )
+            self.conn.commit()
+            self.counters["indexed"] += len(rows)
+        return len(rows)
+
+    def delete(self, product_ids: Iterable[str]):
+        with self.lock:
+            self.conn.executemany("DELETE FROM products WHERE product_id = ?", [(product_id,) for product_id in product_ids])
+            self.conn.commit()
+
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
+        """
+        Search the indexed products, every word of the query has to match
+
+        Args:
+            query (str): Search query
+            limit (int): Max amount of products
+            offset (int): Products to skip (pagination)
+
+        Returns:
+            list: Product dicts (fields of the API's Product model), best match first
+        """
+        match = match_expression(query)
+        if match is None:
+            return []
+
+        start_time = time.perf_counter()
+        weights = ", ".join(str(weight) for weight in COLUMN_WEIGHTS)
+        with self.lock:
+            rows = self.conn.execute(
+                f"""
+                SELECT {PRODUCT_COLUMNS}
+                FROM products_fts JOIN products ON products.id = products_fts.rowid
+                WHERE products_fts MATCH ?
+                ORDER BY bm25(products_fts, {weights})
+                LIMIT ? OFFSET ?
+                """,
+                (match, limit, offset)
+            ).fetchall()
+            self.counters["searches"] += 1
+            self.counters["searchSeconds"] += time.perf_counter() - start_time
+
+        return [row_to_product(row) for row in rows]
+
+    def match_ids(self, query: str) -> List[int]:
+        """
+        Row ids of every product matching a search query (unranked, for filtering)
+        """
+        match = match_expression(query)
+        if match is None:
+            return []
+        with self.lock:
+            rows = self.conn.execute("SELECT rowid FROM products_fts WHERE products_fts MATCH ?", (match,)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_products(self, ids: Sequence[int]) -> List[Dict[str, Any]]:
+        """
+        Products by row id, in the order of the ids
+        """
+        if not ids:
+            return []
+        placeholders = ", ".join("?" for _ in ids)
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT id, {PRODUCT_COLUMNS} FROM products WHERE id IN ({placeholders})", list(ids)
+            ).fetchall()
+        products = {row[0]: row_to_product(row[1:]) for row in rows}
+        return [products[id] for id in ids if id in products]
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+            searches = self.counters["searches"]
+            return {
+                "path": self.path,
+                "entries": entries,
+                "indexed": self.counters["indexed"],
+                "searches": searches,
+                "avgSearchMs": round(self.counters["searchSeconds"] / searches * 1000, 3) if searches else None,
+            }
+
+def _bitmap(ids: Iterable[int]) -> int:
+    # building the int from bytes is linear, setting the bits one by one would copy it every time
+    ids = list(ids)
+    if not ids:
+        return 0
+    bits = bytearray(max(ids) // 8 + 1)
+    for id in ids:
+        bits[id >> 3] |= 1 << (id & 7)
+    return int.from_bytes(bits, "little")
+
+def _iter_ids_descending(bitmap: int) -> Iterator[int]:
+    # scanned as bytes, shifting the int itself would copy it for every id
+    bits = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    for byte_index in range(len(bits) - 1, -1, -1):
+        byte = bits[byte_index]
+        if not byte:
+            continue
+        for bit in range(7, -1, -1):
+            if byte >> bit & 1:
+                yield byte_index * 8 + bit
+
+def price_bucket(price: Optional[float]) -> Optional[str]:
+    """
+    Label of the PRICE_BUCKETS range a price falls in ("25-50", "500+")
+    """
+    if price is None or price < 0:
+        return None
+    for low, high in zip(PRICE_BUCKETS, PRICE_BUCKETS[1:]):
+        if low <= price < high:
+            return f"{low:g}-{high:g}"
+    return f"{PRICE_BUCKETS[-1]:g}+"
+
+def facet_values(seller, availability, price_currency, color, size, price) -> tuple:
+    """
+    Value of every facet (FACETS order) of a product row
+    """
+    # "https://schema.org/InStock" -> "InStock"
+    if availability:
+        availability = availability.rstrip("/").rsplit("/", 1)[-1]
+    return (seller, availability, price_currency, color, size, price_bucket(price))
+
+class CatalogueFacets:
+    def __init__(self, index: CatalogueIndex, refresh_interval: float = FACET_REFRESH_INTERVAL):
+        """
+        Filtered, faceted queries over the catalogue index, answered from in-memory bitmaps
+
+        Every facet value (seller, availability, currency, color, size, price bucket) keeps a
+        bitmap (a Python int, bit n = product row n) of its products. Filters are ANDs of ORs
+        of bitmaps and facet counts are popcounts, so nothing is scanned per query. The
+        bitmaps are loaded once and then updated incrementally from the rows indexed (or
+        removed) since the last refresh.
+
+        Args:
+            index (CatalogueIndex): Catalogue index to read the products from
+            refresh_interval (float): Min seconds between two incremental refreshes
+        """
+        self.index = index
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+
+        # {facet: {value: bitmap}}
+        self.bitmaps = {facet: {} for facet in FACETS}
+        self.all = 0
+        # {row id: facet values} to clear the old bits of an updated row
+        self.row_values = {}
+        self.prices = {}
+        # seq of the last change applied, None before the first load
+        self.last_seq = None
+        self.refreshed_at = 0.0
+        self.counters = {
+            "queries": 0,
+            "querySeconds": 0.0,
+            "refreshes": 0,
+            "rowsApplied": 0,
+        }
+
+    def _set_row(self, id: int, values: tuple, price: Optional[float]):
+        bit = 1 << id
+        self._clear_row(id)
+        for facet, value in zip(FACETS, values):
+            if value is not None:
+                bitmaps = self.bitmaps[facet]
+                bitmaps[value] = bitmaps.get(value, 0) | bit
+        self.all |= bit
+        self.row_values[id] = values
+        if price is not None and price >= 0:
+            self.prices[id] = price
+
+    def _clear_row(self, id: int):
+        values = self.row_values.pop(id, None)
+        if values is None:
+            return
+        mask = ~(1 << id)
+        for facet, value in zip(FACETS, values):
+            if value is not None:
+                bitmaps = self.bitmaps[facet]
+                bitmaps[value] &= mask
+                if not bitmaps[value]:
+                    del bitmaps[value]
+        self.all &= mask
+        self.prices.pop(id, None)
+
+    def _load(self):
+        with self.index.lock:
+            # one read transaction, the products are exactly the ones as of last_seq
+            self.index.conn.execute("BEGIN")
+            try:
+                self.last_seq = self.index.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM product_changes").fetchone()[0]
+                rows = self.index.conn.execute(
+                    "SELECT id, seller, availability, price_currency, color, size, price FROM products"
+                ).fetchall()
+            finally:
+                self.index.conn.execute("COMMIT")
+
+        ids = {facet: {} for facet in FACETS}
+        for id, seller, availability, price_currency, color, size, price in rows:
+            values = facet_values(seller, availability, price_currency, color, size, price)
+            self.row_values[id] = values
+            if price is not None and price >= 0:
+                self.prices[id] = price
+            for facet, value in zip(FACETS, values):
+                if value is not None:
+                    ids[facet].setdefault(value, []).append(id)
+
+        self.bitmaps = {facet: {value: _bitmap(value_ids) for value, value_ids in values.items()} for facet, values in ids.items()}
+        self.all = _bitmap(self.row_values)
+        self.counters["rowsApplied"] += len(rows)
+
+    def refresh(self, force: bool = False):
+        """
+        Apply the products indexed or removed since the last refresh (loads everything the first time)
+        """
+        with self.lock:
+            now = time.monotonic()
+            if not force and self.last_seq is not None and now - self.refreshed_at < self.refresh_interval:
+                return
+            self.refreshed_at = now
+
+            if self.last_seq is None:
+                self._load()
+                return
+
+            with self.index.lock:
+                # a changed row that is gone from products was deleted
+                changes = self.index.conn.execute(
+                    """
+                    SELECT c.seq, c.id, p.id, p.seller, p.availability, p.price_currency, p.color, p.size, p.price
+                    FROM product_changes c LEFT JOIN products p ON p.id = c.id
+                    WHERE c.seq > ? ORDER BY c.seq
+                    """,
+                    (self.last_seq,)
+                ).fetchall()
+
+            for seq, id, product_id, seller, availability, price_currency, color, size, price in changes:
+                if product_id is None:
+                    self._clear_row(id)
+                else:
+                    self._set_row(id, facet_values(seller, availability, price_currency, color, size, price), price)
+                self.last_seq = seq
+
+            self.counters["refreshes"] += 1
+            self.counters["rowsApplied"] += len(changes)
+
+    def _price_bitmap(self, min_price: Optional[float], max_price: Optional[float]) -> int:
+        # whole buckets inside the range are ORed, the products of the edge buckets are checked one by one
+        bitmap = 0
+        edges = 0
+        buckets = self.bitmaps["price"]
+        for low, high in zip(PRICE_BUCKETS, list(PRICE_BUCKETS[1:]) + [float("inf")]):
+            label = price_bucket(low)
+            if label not in buckets:
+                continue
+            if (max_price is not None and low > max_price) or (min_price is not None and high <= min_price):
+                continue
+            if (min_price is None or low >= min_price) and (max_price is None or high <= max_price):
+                bitmap |= buckets[label]
+            else:
+                edges |= buckets[label]
+        matching = [
+            id for id in _iter_ids_descending(edges)
+            if (min_price is None or self.prices[id] >= min_price) and (max_price is None or self.prices[id] <= max_price)
+        ]
+        return bitmap | _bitmap(matching)
+
+    def query(
+        self,
+        filters: Optional[Dict[str, Sequence[str]]] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+        text: Optional[str] = None,
+        limit: int = 20,
+        offset: int = 0
+    ) -> Dict[str, Any]:
+        """
+        Filter the catalogue and count the products of every facet value
+
+        A facet's counts apply every filter except its own (selecting "InStock" still shows
+        how many products are "OutOfStock").
+
+        Args:
+            filters (dict): {facet: accepted values}, facets of FACETS (price excluded)
+            min_price (float): Min price, inclusive
+            max_price (float): Max price, inclusive
+            text (str): Full-text search query the products also have to match
+            limit (int): Max amount of products
+            offset (int): Products to skip (pagination)
+
+        Returns:
+            dict: products (newest first), total and facets ({facet: {value: count}})
+        """
+        filters = {facet: values for facet, values in (filters or {}).items() if values}
+        unknown = set(filters) - set(FACETS) | ({"price"} & set(filters))
+        if unknown:
+            raise ValueError(f"Unknown facets: {', '.join(sorted(unknown))} (price is filtered with min_price / max_price)")
+
+        self.refresh()
+        text_ids = self.index.match_ids(text) if text and text.strip() else None
+
+        start_time = time.perf_counter()
+        with self.lock:
+            base = self.all if text_ids is None else self.all & _bitmap(text_ids)
+
+            # one bitmap per filtered facet, OR of its accepted values
+            selected = {
+                facet: _or_all(self.bitmaps[facet].get(value, 0) for value in values)
+                for facet, values in filters.items()
+            }
+            if min_price is not None or max_price is not None:
+                selected["price"] = self._price_bitmap(min_price, max_price)
+
+            matches = base
+            for bitmap in selected.values():
+                matches &= bitmap
+
+            facets = {}
+            for facet in FACETS:
+                # every filter but the facet's own
+                others = base
+                for other, bitmap in selected.items():
+                    if other != facet:
+                        others &= bitmap
+                facets[facet] = {
+                    value: count
+                    for value, count in sorted(
+                        ((value, (bitmap & others).bit_count()) for value, bitmap in self.bitmaps[facet].items()),
+                        key=lambda item: -item[1]
+                    )
+                    if count
+                }
+
+            total = matches.bit_count()
+            page = list(islice(_iter_ids_descending(matches), offset, offset + limit))
+            self.counters["queries"] += 1
+            self.counters["querySeconds"] += time.perf_counter() - start_time
+
+        return {
+            "products": self.index.get_products(page),
+            "total": total,
+            "facets": facets,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            queries = self.counters["queries"]
+            return {
+                "products": self.all.bit_count(),
+                "facetValues": {facet: len(values) for facet, values in self.bitmaps.items()},
+                "refreshes": self.counters["refreshes"],
+                "rowsApplied": self.counters["rowsApplied"],
+                "queries": queries,
+                "avgQueryMs": round(self.counters["querySeconds"] / queries * 1000, 3) if queries else None,
+            }
+
+def _or_all(bitmaps: Iterable[int]) -> int:
+    result = 0
+    for bitmap in bitmaps:
+        result |= bitmap
+    return result
+
+if __name__ == '__main__':
+    # rebuild the index from the products already stored in Firestore
+    import argparse
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    parser = argparse.ArgumentParser(description="Rebuild the local catalogue index from the Firestore products collection")
+    parser.add_argument("--credentials", default=r'credentials\bag-haven-qt9s4v-firebase-adminsdk-h9x05-e584032402.json')
+    parser.add_argument("--index", default=CATALOGUE_INDEX_PATH)
+    args = parser.parse_args()
+
+    firebase_admin.initialize_app(credentials.Certificate(args.credentials))
+    db = firestore.client()
+
+    index = CatalogueIndex(args.index)
+    batch = []
+    for snapshot in db.collection("products").stream():
+        batch.append(snapshot.to_dict())
+        if len(batch) >= 500:
+            index.upsert(batch)
+            batch = []
+    index.upsert(batch)
+    print(f"Catalogue index: {index.stats()}")
+    index.close()
@@ -0,0 +1,389 @@
+import sqlite3
+import threading
+import time
+import logging
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+# unchanged since the last crawl (sitemap <lastmod>), not fetched
+SKIPPED = 'skipped'
+
+# a failed URL is given up on after this many crawl attempts
+MAX_ATTEMPTS = 5
+# status updates are committed in batches, a crash loses at most this many
+COMMIT_EVERY = 200
+# discovered urls recorded per transaction
+RECORD_BATCH_SIZE = 250
+
+class CrawlState:
+    def __init__(self, path: str, max_attempts: int = MAX_ATTEMPTS, commit_every: int = COMMIT_EVERY):
+        """
+        On-disk crawl state so a crawl can resume where it stopped
+
+        Keeps per domain whether the sitemaps were already discovered, per URL its
+        status, attempts and last fetch time, and the sitemap <lastmod> values seen
+        so an incremental crawl only fetches what changed. Also keeps the content hash
+        of every product stored in Firestore, so unchanged variants are not written again.
+
+        Args:
+            path (str): Path to the SQLite file
+            max_attempts (int): Attempts after which a failed URL is not retried anymore
+            commit_every (int): Amount of status updates per commit
+        """
+        self.path = path
+        self.max_attempts = max_attempts
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS domains (
+                domain TEXT PRIMARY KEY,
+                discovery_complete INTEGER NOT NULL DEFAULT 0,
+                crawl_started_at REAL,
+                crawl_finished_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                domain TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_fetched REAL,
+                last_error TEXT,
+                lastmod REAL,
+                crawled_lastmod REAL,
+                seen_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS urls_domain_status ON urls (domain, status);
+            CREATE TABLE IF NOT EXISTS sitemaps (
+                url TEXT PRIMARY KEY,
+                domain TEXT NOT NULL,
+                lastmod REAL
+            );
+            CREATE TABLE IF NOT EXISTS product_hashes (
+                product_id TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                stored_at REAL
+            );
+            """
+        )
+        # state files written before the lastmod columns existed
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(urls)')}
+        for column in ('lastmod', 'crawled_lastmod', 'seen_at'):
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE urls ADD COLUMN {column} REAL')
+        self.conn.commit()
+
+    def _maybe_commit(self, updates: int = 1):
+        self.uncommitted += updates
+        if self.uncommitted >= self.commit_every:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def flush(self):
+        """
+        Commit every pending status update
+        """
+        with self.lock:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def start_crawl(self, domain: str, fresh: bool = False) -> bool:
+        """
+        Start a crawl of a domain, or resume the one that didn't finish
+
+        Args:
+            domain (str): Domain to crawl
+            fresh (bool): Start over even if the last crawl didn't finish
+
+        Returns:
+            bool: True if an unfinished crawl is resumed
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT crawl_started_at, crawl_finished_at FROM domains WHERE domain = ?', (domain,)
+            ).fetchone()
+
+            if row is not None and row[0] is not None and row[1] is None and not fresh:
+                return True
+
+            # new crawl: sitemaps are discovered again and every known URL is due again
+            self.conn.execute(
+                """
+                INSERT INTO domains (domain, discovery_complete, crawl_started_at, crawl_finished_at)
+                VALUES (?, 0, ?, NULL)
+                ON CONFLICT(domain) DO UPDATE SET
+                    discovery_complete = 0, crawl_started_at = excluded.crawl_started_at, crawl_finished_at = NULL
+                """,
+                (domain, time.time())
+            )
+            self.conn.execute(
+                'UPDATE urls SET status = ?, attempts = 0, last_error = NULL WHERE domain = ?', (PENDING, domain)
+            )
+            self.conn.commit()
+            return False
+
+    def finish_crawl(self, domain: str):
+        with self.lock:
+            self.conn.execute('UPDATE domains SET crawl_finished_at = ? WHERE domain = ?', (time.time(), domain))
+            self.conn.commit()
+
+    def is_discovery_complete(self, domain: str) -> bool:
+        with self.lock:
+            row = self.conn.execute('SELECT discovery_complete FROM domains WHERE domain = ?', (domain,)).fetchone()
+        return bool(row and row[0])
+
+    def record_entries(
+        self,
+        domain: str,
+        entries: Iterable[Tuple[str, Optional[float]]],
+        skip_unchanged: bool = False
+    ) -> Iterator[str]:
+        """
+        Record discovered URLs with their sitemap <lastmod> while they stream in, and
+        yield the ones to crawl so fetching can start before discovery ends
+
+        Args:
+            domain (str): Domain of the URLs
+            entries (iterable): (url, lastmod timestamp or None), can be a generator
+            skip_unchanged (bool): Mark URLs whose <lastmod> didn't change since they were
+                last crawled as skipped instead of yielding them (incremental crawl).
+                URLs without a <lastmod> are always crawled.
+
+        Yields:
+            str: URLs still to crawl (pending, or failed with attempts left), in discovery order
+        """
+        crawl_id = self._crawl_id(domain)
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) >= RECORD_BATCH_SIZE:
+                yield from self._record_batch(domain, crawl_id, batch, skip_unchanged)
+                batch = []
+        if batch:
+            yield from self._record_batch(domain, crawl_id, batch, skip_unchanged)
+
+    def _crawl_id(self, domain: str) -> Optional[float]:
+        # start time of the current crawl, tells which urls were seen in its sitemaps
+        with self.lock:
+            row = self.conn.execute('SELECT crawl_started_at FROM domains WHERE domain = ?', (domain,)).fetchone()
+        return row[0] if row else None
+
+    def _record_batch(self, domain: str, crawl_id: Optional[float], batch: List[Tuple[str, Optional[float]]], skip_unchanged: bool) -> List[str]:
+        urls = [url for url, _ in batch]
+        placeholders = ', '.join('?' for _ in urls)
+        with self.lock:
+            self.conn.executemany(
+                """
+                INSERT INTO urls (url, domain, status, lastmod, seen_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET lastmod = excluded.lastmod, seen_at = excluded.seen_at
+                """,
+                [(url, domain, PENDING, lastmod, crawl_id) for url, lastmod in batch]
+            )
+            if skip_unchanged:
+                self.conn.execute(
+                    f"""
+                    UPDATE urls SET status = ?
+                    WHERE url IN ({placeholders}) AND status = ?
+                        AND lastmod IS NOT NULL AND crawled_lastmod IS NOT NULL AND lastmod <= crawled_lastmod
+                    """,
+                    (SKIPPED, *urls, PENDING)
+                )
+            pending = {
+                row[0] for row in self.conn.execute(
+                    f'SELECT url FROM urls WHERE url IN ({placeholders}) AND (status = ? OR (status = ? AND attempts < ?))',
+                    (*urls, PENDING, FAILED, self.max_attempts)
+                )
+            }
+            self.conn.commit()
+        # the lock is released before the urls are handed out
+        return [url for url in urls if url in pending]
+
+    def complete_discovery(self, domain: str, skip_unchanged: bool = False) -> List[str]:
+        """
+        Settle the known URLs that were not in the sitemaps read by this crawl, and mark the discovery complete
+
+        In an incremental crawl they are the URLs of the skipped (unchanged) child sitemaps:
+        unchanged ones are skipped, the others are returned to be crawled. In a full crawl
+        they are no longer in the sitemaps and are skipped. Only call it once every sitemap
+        was read, a URL of a sitemap that failed would be skipped too.
+
+        Args:
+            domain (str): Domain of the URLs
+            skip_unchanged (bool): True for an incremental crawl
+
+        Returns:
+            list: URLs still to crawl that record_entries didn't yield
+        """
+        crawl_id = self._crawl_id(domain)
+        with self.lock:
+            unseen = '(seen_at IS NULL OR seen_at != ?)'
+            if skip_unchanged:
+                self.conn.execute(
+                    f"""
+                    UPDATE urls SET status = ?
+                    WHERE domain = ? AND status = ? AND {unseen}
+                        AND lastmod IS NOT NULL AND crawled_lastmod IS NOT NULL AND lastmod <= crawled_lastmod
+                    """,
+                    (SKIPPED, domain, PENDING, crawl_id)
+                )
+            else:
+                self.conn.execute(
+                    f'UPDATE urls SET status = ? WHERE domain = ? AND status IN (?, ?) AND {unseen}',
+                    (SKIPPED, domain, PENDING, FAILED, crawl_id)
+                )
+            rows = self.conn.execute(
+                f"""
+                SELECT url FROM urls
+                WHERE domain = ? AND {unseen} AND (status = ? OR (status = ? AND attempts < ?))
+                ORDER BY rowid
+                """,
+                (domain, crawl_id, PENDING, FAILED, self.max_attempts)
+            ).fetchall()
+            self.conn.execute('UPDATE domains SET discovery_complete = 1 WHERE domain = ?', (domain,))
+            self.conn.commit()
+        return [row[0] for row in rows]
+
+    def is_sitemap_unchanged(self, sitemap_url: str, lastmod: Optional[float]) -> bool:
+        """
+        Check if a child sitemap didn't change since its URLs were last recorded
+
+        Args:
+            sitemap_url (str): URL of the child sitemap
+            lastmod (float): Its <lastmod> in the sitemap index
+
+        Returns:
+            bool: True if it can be skipped
+        """
+        if lastmod is None:
+            return False
+        with self.lock:
+            row = self.conn.execute('SELECT lastmod FROM sitemaps WHERE url = ?', (sitemap_url,)).fetchone()
+        return row is not None and row[0] is not None and lastmod <= row[0]
+
+    def set_sitemap_lastmods(self, domain: str, sitemaps: Iterable[Tuple[str, Optional[float]]]):
+        """
+        Record the <lastmod> of child sitemaps whose URLs were recorded
+
+        Args:
+            domain (str): Domain of the sitemaps
+            sitemaps (iterable): (sitemap url, lastmod timestamp or None)
+        """
+        with self.lock:
+            self.conn.executemany(
+                """
+                INSERT INTO sitemaps (url, domain, lastmod) VALUES (?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET lastmod = excluded.lastmod
+                """,
+                [(url, domain, lastmod) for url, lastmod in sitemaps]
+            )
+            self.conn.commit()
+
+    def get_urls(self, domain: str, statuses: Sequence[str] = (PENDING, FAILED)) -> Iterator[str]:
+        """
+        Get the URLs of a domain that still have to be crawled
+
+        Args:
+            domain (str): Domain of the URLs
+            statuses (sequence): Statuses to return, failed URLs are only returned below max_attempts
+
+        Returns:
+            iterator: URLs in discovery order
+        """
+        placeholders = ', '.join('?' for _ in statuses)
+        with self.lock:
+            rows = self.conn.execute(
+                f"""
+                SELECT url FROM urls
+                WHERE domain = ? AND status IN ({placeholders}) AND (status != ? OR attempts < ?)
+                ORDER BY rowid
+                """,
+                (domain, *statuses, FAILED, self.max_attempts)
+            ).fetchall()
+        return (row[0] for row in rows)
+
+    def mark_done(self, url: str):
+        with self.lock:
+            self.conn.execute(
+                """
+                UPDATE urls SET status = ?, attempts = attempts + 1, last_fetched = ?, last_error = NULL, crawled_lastmod = lastmod
+                WHERE url = ?
+                """,
+                (DONE, time.time(), url)
+            )
+            self._maybe_commit()
+
+    def mark_failed(self, url: str, error: Optional[str] = None):
+        with self.lock:
+            self.conn.execute(
+                'UPDATE urls SET status = ?, attempts = attempts + 1, last_fetched = ?, last_error = ? WHERE url = ?',
+                (FAILED, time.time(), error, url)
+            )
+            self._maybe_commit()
+
+    def get_content_hashes(self, product_ids: Sequence[str]) -> Dict[str, str]:
+        """
+        Get the content hash of the products last stored in Firestore
+
+        Args:
+            product_ids (sequence): Product document ids
+
+        Returns:
+            dict: {product id: content hash}, products never stored are left out
+        """
+        if not product_ids:
+            return {}
+        placeholders = ', '.join('?' for _ in product_ids)
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT product_id, content_hash FROM product_hashes WHERE product_id IN ({placeholders})',
+                list(product_ids)
+            ).fetchall()
+        return {product_id: content_hash for product_id, content_hash in rows}
+
+    def set_content_hashes(self, hashes: Iterable[Tuple[str, str]]):
+        """
+        Record the content hash of products once their Firestore write is committed
+
+        Args:
+            hashes (iterable): (product id, content hash)
+        """
+        now = time.time()
+        rows = [(product_id, content_hash, now) for product_id, content_hash in hashes]
+        with self.lock:
+            self.conn.executemany(
+                """
+                INSERT INTO product_hashes (product_id, content_hash, stored_at) VALUES (?, ?, ?)
+                ON CONFLICT(product_id) DO UPDATE SET content_hash = excluded.content_hash, stored_at = excluded.stored_at
+                """,
+                rows
+            )
+            self._maybe_commit(len(rows))
+
+    def counts(self, domain: str) -> Dict[str, int]:
+        """
+        Get the amount of URLs per status of a domain
+
+        Returns:
+            dict: {status: count}, failed URLs that ran out of attempts are counted as 'given_up'
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                """
+                SELECT CASE WHEN status = ? AND attempts >= ? THEN 'given_up' ELSE status END, COUNT(*)
+                FROM urls WHERE domain = ? GROUP BY 1
+                """,
+                (FAILED, self.max_attempts, domain)
+            ).fetchall()
+        return {status: count for status, count in rows}
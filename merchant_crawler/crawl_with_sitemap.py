@@ -1,67 +1,268 @@
 import requests
 import xml.etree.ElementTree as ET
 import logging
+import queue
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from datetime import datetime, timezone
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional
 from urllib.parse import urljoin, urlparse
 
+SITEMAP_NAMESPACE = {'ns': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
+SITEMAP_ENTRY_TAGS = {f"{{{SITEMAP_NAMESPACE['ns']}}}url", f"{{{SITEMAP_NAMESPACE['ns']}}}sitemap"}
+SITEMAP_CHUNK_SIZE = 64 * 1024
+SITEMAP_TIMEOUT = 30
+GZIP_MAGIC = b'\x1f\x8b'
+# child sitemaps downloaded at once
+SITEMAP_WORKERS = 8
+# entries handed from a download thread at a time, and batches buffered between them
+SITEMAP_BATCH_SIZE = 500
+SITEMAP_QUEUE_SIZE = 32
+
+class SitemapEntry(NamedTuple):
+    """
+    A <url> of a sitemap or a <sitemap> of a sitemap index
+    """
+    loc: str
+    lastmod: Optional[str] = None
+    changefreq: Optional[str] = None
+    priority: Optional[float] = None
+
+def parse_sitemap_entry(element) -> Optional[SitemapEntry]:
+    """
+    Build a SitemapEntry from a <url> / <sitemap> element
+
+    Args:
+        element (Element): The <url> or <sitemap> element
+
+    Returns:
+        SitemapEntry: The entry, None if it has no <loc>
+    """
+    def text(tag):
+        child = element.find(f'ns:{tag}', SITEMAP_NAMESPACE)
+        if child is None or child.text is None:
+            return None
+        return child.text.strip() or None
+
+    loc = text('loc')
+    if loc is None:
+        return None
+
+    priority = text('priority')
+    try:
+        priority = float(priority) if priority is not None else None
+    except ValueError:
+        priority = None
+
+    return SitemapEntry(loc, text('lastmod'), text('changefreq'), priority)
+
+def iter_sitemap_xml(chunks: Iterable[bytes]) -> Iterator[SitemapEntry]:
+    """
+    Incrementally parse a sitemap read chunk by chunk, memory stays flat whatever its size
+
+    A gzipped sitemap (.xml.gz served without Content-Encoding) is decompressed on the fly.
+
+    Args:
+        chunks (iterable): Byte chunks of the sitemap (e.g. requests iter_content)
+
+    Yields:
+        SitemapEntry: Every <url> / <sitemap> entry as soon as its closing tag is read
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    decompressor = None
+    root = None
+    # first bytes, kept until we can tell if the sitemap is gzipped
+    head = b''
+
+    def entries():
+        nonlocal root
+        for event, element in parser.read_events():
+            if event == 'start':
+                if root is None:
+                    root = element
+            elif element.tag in SITEMAP_ENTRY_TAGS:
+                entry = parse_sitemap_entry(element)
+                # drop the parsed entries so the tree never grows
+                root.clear()
+                if entry is not None:
+                    yield entry
+
+    for chunk in chunks:
+        if head is not None:
+            head += chunk
+            if len(head) < len(GZIP_MAGIC):
+                continue
+            if head.startswith(GZIP_MAGIC):
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            chunk, head = head, None
+        if decompressor is None:
+            parser.feed(chunk)
+            yield from entries()
+            continue
+        # decompress in bounded pieces, sitemaps compress very well
+        while chunk:
+            parser.feed(decompressor.decompress(chunk, SITEMAP_CHUNK_SIZE))
+            chunk = decompressor.unconsumed_tail
+            yield from entries()
+
+    if head:
+        parser.feed(head)
+    if decompressor is not None:
+        parser.feed(decompressor.flush())
+    parser.close()
+    yield from entries()
+
+def url_fingerprint(url: str) -> int:
+    """
+    64-bit fingerprint of a URL, a collision between two URLs of a merchant is astronomically unlikely
+
+    Args:
+        url (str): URL
+
+    Returns:
+        int: Fingerprint
+    """
+    return int.from_bytes(blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def dedupe_entries(entries: Iterable[SitemapEntry]) -> Iterator[SitemapEntry]:
+    """
+    Drop repeated URLs from a stream of entries, keeping the first occurrence in discovery order
+
+    Only a 64-bit fingerprint of every URL seen is kept, not the URL itself.
+
+    Args:
+        entries (iterable): Sitemap entries, can be a generator
+
+    Yields:
+        SitemapEntry: Entries whose URL wasn't seen before
+    """
+    seen = set()
+    for entry in entries:
+        fingerprint = url_fingerprint(entry.loc)
+        if fingerprint not in seen:
+            seen.add(fingerprint)
+            yield entry
+
+def parse_lastmod(lastmod: Optional[str]) -> Optional[float]:
+    """
+    Parse a sitemap <lastmod> (W3C datetime, e.g. 2024-05-01 or 2024-05-01T10:00:00+00:00)
+
+    Args:
+        lastmod (str): The <lastmod> text
+
+    Returns:
+        float: Unix timestamp, None if missing or invalid. Values without a timezone are taken as UTC.
+    """
+    if not lastmod:
+        return None
+    try:
+        value = datetime.fromisoformat(lastmod.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
 class BoxLunchSitemapCrawler:
-    def __init__(self, base_url='https://www.boxlunch.com', sitemap_url='sitemap_index.xml'):
+    def __init__(self, base_url='https://www.boxlunch.com', sitemap_url='sitemap_index.xml', max_workers=SITEMAP_WORKERS):
         """
         Initialize BoxLunch sitemap crawler
         
         Args:
             base_url (str): Base URL of the website
+            sitemap_url (str): Path of the sitemap index
+            max_workers (int): Child sitemaps downloaded at once
         """
         self.sitemap_url = sitemap_url
         self.base_url = base_url
+        self.max_workers = max_workers
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
+        # one keep-alive connection per download thread
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         logging.basicConfig(level=logging.INFO)
         self.logger = logging.getLogger(__name__)
 
-    def extract_sitemap_urls(self, sitemap_url):
+    def extract_sitemap_entries(self, sitemap_url: str) -> List[SitemapEntry]:
         """
-        Extract URLs from a specific sitemap
+        Extract the entries (<url> or <sitemap>) of a specific sitemap
         
         Args:
             sitemap_url (str): URL of the sitemap to crawl
         
         Returns:
-            list: URLs extracted from the sitemap
+            list: SitemapEntry of every location in the sitemap, empty on error
         """
         try:
-            # Fetch sitemap
-            response = requests.get(sitemap_url, headers=self.headers)
-            response.raise_for_status()
-            
-            # Parse XML
-            root = ET.fromstring(response.text)
-            
-            # Namespace handling
-            namespace = {'ns': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
-            
-            # Extract URLs
-            urls = []
-            
-            # Check if it's a sitemap index or a regular sitemap
-            if root.tag.endswith('sitemapindex'):
-                # If it's a sitemap index, return the sitemap locations
-                sitemap_locs = root.findall('.//ns:loc', namespace)
-                urls = [loc.text.strip() for loc in sitemap_locs]
-            else:
-                # If it's a regular sitemap, extract URL locations
-                url_elements = root.findall('.//ns:loc', namespace)
-                urls = [url.text.strip() for url in url_elements]
-            
-            return urls
+            return self.fetch_sitemap_entries(sitemap_url)
         
         except requests.RequestException as e:
             self.logger.error(f"Error fetching sitemap {sitemap_url}: {e}")
             return []
-        except ET.ParseError as e:
+        except (ET.ParseError, zlib.error) as e:
             self.logger.error(f"Error parsing sitemap XML: {e}")
             return []
 
+    def fetch_sitemap_entries(self, sitemap_url: str) -> List[SitemapEntry]:
+        """
+        Same as extract_sitemap_entries but raises on fetch / parse errors
+        """
+        return list(self.iter_sitemap_entries(sitemap_url))
+
+    def iter_sitemap_entries(self, sitemap_url: str) -> Iterator[SitemapEntry]:
+        """
+        Stream a sitemap (plain or gzipped) and yield its entries while it downloads
+        
+        Args:
+            sitemap_url (str): URL of the sitemap to crawl
+        
+        Yields:
+            SitemapEntry: Every <url> / <sitemap> entry, in document order
+        
+        Raises:
+            requests.RequestException, ET.ParseError, zlib.error: Fetch or parse errors,
+            entries before the error were already yielded
+        """
+        with self.session.get(sitemap_url, headers=self.headers, stream=True, timeout=SITEMAP_TIMEOUT) as response:
+            response.raise_for_status()
+            yield from iter_sitemap_xml(response.iter_content(chunk_size=SITEMAP_CHUNK_SIZE))
+
+    def extract_sitemap_urls(self, sitemap_url):
+        """
+        Extract URLs from a specific sitemap
+        
+        Args:
+            sitemap_url (str): URL of the sitemap to crawl
+        
+        Returns:
+            list: URLs extracted from the sitemap
+        """
+        return [entry.loc for entry in self.extract_sitemap_entries(sitemap_url)]
+
+    def is_product_sitemap(self, sitemap_url):
+        return '-product.xml' in sitemap_url
+
+    def get_product_sitemap_entries(self, sitemap_index_url: str) -> List[SitemapEntry]:
+        """
+        Extract the product-specific sitemap entries from the sitemap index
+        
+        Args:
+            sitemap_index_url (str): URL of the sitemap index
+        
+        Returns:
+            list: SitemapEntry of the product-specific sitemaps
+        """
+        return [
+            entry for entry in self.extract_sitemap_entries(sitemap_index_url)
+            if self.is_product_sitemap(entry.loc)
+        ]
+
     def get_product_sitemaps(self, sitemap_index_url):
         """
         Extract product-specific sitemaps from the sitemap index
@@ -72,42 +273,151 @@ class BoxLunchSitemapCrawler:
         Returns:
             list: URLs of product-specific sitemaps
         """
-        # Fetch sitemap index
-        sitemaps = self.extract_sitemap_urls(sitemap_index_url)
+        return [entry.loc for entry in self.get_product_sitemap_entries(sitemap_index_url)]
+
+    def crawl_product_sitemap_entries(
+        self,
+        skip_sitemap: Optional[Callable[[SitemapEntry], bool]] = None,
+        on_sitemap_crawled: Optional[Callable[[SitemapEntry], None]] = None
+    ) -> List[SitemapEntry]:
+        """
+        Crawl the product sitemaps and extract their URL entries
         
-        # Filter for product sitemaps
-        product_sitemaps = [
-            sitemap for sitemap in sitemaps 
-            if '-product.xml' in sitemap
-        ]
+        Args:
+            skip_sitemap (callable): Called with the index entry of a child sitemap, True skips it (e.g. unchanged since the last crawl)
+            on_sitemap_crawled (callable): Called with the index entry of every child sitemap read successfully
         
-        return product_sitemaps
+        Returns:
+            list: SitemapEntry of every product URL, first occurrence of each URL kept
+        """
+        return list(self.iter_product_sitemap_entries(skip_sitemap, on_sitemap_crawled))
 
-    def crawl_product_sitemaps(self):
+    def iter_product_sitemap_entries(
+        self,
+        skip_sitemap: Optional[Callable[[SitemapEntry], bool]] = None,
+        on_sitemap_crawled: Optional[Callable[[SitemapEntry], None]] = None,
+        on_sitemap_failed: Optional[Callable[[SitemapEntry], None]] = None
+    ) -> Iterator[SitemapEntry]:
         """
-        Crawl all product sitemaps and extract product URLs
+        Generator version of crawl_product_sitemap_entries, entries are yielded while the sitemaps download
         
-        Returns:
-            list: Comprehensive list of product URLs
+        Args:
+            skip_sitemap (callable): Called with the index entry of a child sitemap, True skips it
+            on_sitemap_crawled (callable): Called with the index entry of every child sitemap read successfully
+            on_sitemap_failed (callable): Called with the index entry of every child sitemap that failed
+        
+        Yields:
+            SitemapEntry: Every product URL entry, first occurrence of each URL only
+        
+        Raises:
+            requests.RequestException, ET.ParseError, zlib.error: The sitemap index could not be read
         """
         # Construct sitemap index URL
         sitemap_index_url = urljoin(self.base_url, self.sitemap_url)
         
-        # Get product-specific sitemaps
-        product_sitemaps = self.get_product_sitemaps(sitemap_index_url)
-        
-        # Collect all product URLs
-        all_product_urls = []
+        # Get product-specific sitemaps, an unreadable index is an error (not an empty site)
+        product_sitemaps = [
+            entry for entry in self.fetch_sitemap_entries(sitemap_index_url)
+            if self.is_product_sitemap(entry.loc)
+        ]
         
+        to_crawl = []
         for sitemap in product_sitemaps:
-            self.logger.info(f"Crawling sitemap: {sitemap}")
-            product_urls = self.extract_sitemap_urls(sitemap)
-            all_product_urls.extend(product_urls)
+            if skip_sitemap is not None and skip_sitemap(sitemap):
+                self.logger.info(f"Skipping unchanged sitemap: {sitemap.loc}")
+                continue
+            to_crawl.append(sitemap)
+        
+        # child sitemaps are read in parallel, their urls merged without duplicates
+        yield from dedupe_entries(self.iter_sitemaps_parallel(to_crawl, on_sitemap_crawled, on_sitemap_failed))
+
+    def iter_sitemaps_parallel(
+        self,
+        sitemaps: List[SitemapEntry],
+        on_sitemap_crawled: Optional[Callable[[SitemapEntry], None]] = None,
+        on_sitemap_failed: Optional[Callable[[SitemapEntry], None]] = None
+    ) -> Iterator[SitemapEntry]:
+        """
+        Stream several sitemaps at once and yield their entries as they arrive
+        
+        A bounded queue between the download threads and the caller keeps memory flat
+        when the caller is slower than the downloads.
+        
+        Args:
+            sitemaps (list): Index entries of the sitemaps to read
+            on_sitemap_crawled (callable): Called (in the caller thread) with every sitemap read successfully
+            on_sitemap_failed (callable): Called (in the caller thread) with every sitemap that failed
+        
+        Yields:
+            SitemapEntry: Entries of every sitemap, duplicates included
+        """
+        if not sitemaps:
+            return
+        
+        results = queue.Queue(maxsize=SITEMAP_QUEUE_SIZE)
+        stop = threading.Event()
         
-        # Remove duplicates
-        unique_product_urls = list(set(all_product_urls))
+        def put(item):
+            # give up when the caller is gone
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
         
-        return unique_product_urls
+        def read_sitemap(sitemap):
+            self.logger.info(f"Crawling sitemap: {sitemap.loc}")
+            try:
+                batch = []
+                for entry in self.iter_sitemap_entries(sitemap.loc):
+                    batch.append(entry)
+                    if len(batch) >= SITEMAP_BATCH_SIZE:
+                        if not put((batch, None, None)):
+                            return
+                        batch = []
+                if batch and not put((batch, None, None)):
+                    return
+                put((None, sitemap, None))
+            except Exception as e:
+                # entries already sent are kept, the sitemap is read again next crawl
+                put((None, sitemap, e))
+        
+        executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(sitemaps)), thread_name_prefix='sitemap')
+        try:
+            for sitemap in sitemaps:
+                executor.submit(read_sitemap, sitemap)
+            
+            remaining = len(sitemaps)
+            while remaining:
+                batch, sitemap, error = results.get()
+                if batch is not None:
+                    yield from batch
+                    continue
+                
+                remaining -= 1
+                if error is not None:
+                    self.logger.error(f"Error crawling sitemap {sitemap.loc}: {error}")
+                    if on_sitemap_failed is not None:
+                        on_sitemap_failed(sitemap)
+                elif on_sitemap_crawled is not None:
+                    on_sitemap_crawled(sitemap)
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def crawl_product_sitemaps(self):
+        """
+        Crawl all product sitemaps and extract product URLs
+        
+        Returns:
+            list: Comprehensive list of product URLs
+        """
+        return [entry.loc for entry in self.crawl_product_sitemap_entries()]
+
+    def is_product_url(self, url):
+        return '/product/' in url and url.startswith(self.base_url.rstrip('/'))
 
     def filter_product_urls(self, urls):
         """
@@ -120,10 +430,7 @@ class BoxLunchSitemapCrawler:
             list: Filtered product URLs
         """
         # Filter for valid product URLs
-        valid_product_urls = [
-            url for url in urls
-            if '/product/' in url and url.startswith('https://www.boxlunch.com')
-        ]
+        valid_product_urls = [url for url in urls if self.is_product_url(url)]
         
         return valid_product_urls
 
@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional
+from urllib.parse import urlparse
+
+from async_crawler import DOMAIN_CONCURRENCY, DOMAIN_REQUESTS_PER_SECOND
+from catalogue_index import CatalogueIndex
+from crawl_state import CrawlState
+from process_products import ProductProcessor
+from scheduler import domain_name, domain_product_urls, finish_completed_crawls, get_domain_settings
+from work_queue import DONE, TaskQueue
+
+# tasks leased at a time, small enough to be processed well within the visibility timeout
+LEASE_SIZE = 20
+# seconds between polls of an empty queue
+POLL_INTERVAL = 5.0
+WORKER_CONCURRENCY = 32
+
+def sync_finished_tasks(work_queue: TaskQueue, crawl_state: CrawlState) -> int:
+    """
+    Report the tasks finished by the workers back to the crawl state
+
+    Args:
+        work_queue (TaskQueue): Shared work queue
+        crawl_state (CrawlState): Crawl state of the discovery
+
+    Returns:
+        int: Amount of finished tasks reported
+    """
+    reported = 0
+    while True:
+        finished = work_queue.drain_finished()
+        if not finished:
+            break
+        for url, status, error in finished:
+            if status == DONE:
+                crawl_state.mark_done(url)
+            else:
+                crawl_state.mark_failed(url, error)
+        reported += len(finished)
+    crawl_state.flush()
+    return reported
+
+def discover_to_queue(
+    domains: List[Dict[str, Any]],
+    crawl_state: CrawlState,
+    work_queue: TaskQueue,
+    incremental: bool = False,
+    fresh: bool = False,
+    limit: Optional[int] = None
+) -> Dict[str, int]:
+    """
+    Discover the product URLs of every domain (in parallel) and fill the work queue with them
+
+    The results of the previous run are reported to the crawl state first, so crawls are
+    resumed, finished and recrawled incrementally like a local crawl.
+
+    Args:
+        domains (list): Entries of domains.json
+        crawl_state (CrawlState): Crawl state shared by every domain
+        work_queue (TaskQueue): Shared work queue
+        incremental (bool): Only enqueue new product pages and pages with a newer <lastmod>
+        fresh (bool): Start new crawls instead of resuming interrupted ones
+        limit (int): Max product URLs per domain (for testing)
+
+    Returns:
+        dict: {domain: amount of URLs enqueued}
+    """
+    print(f"Finished tasks reported to the crawl state: {sync_finished_tasks(work_queue, crawl_state)}")
+    finish_completed_crawls(domains, crawl_state)
+
+    with ThreadPoolExecutor(max_workers=max(1, len(domains)), thread_name_prefix='discover') as executor:
+        futures = {
+            domain_name(domain): executor.submit(
+                work_queue.enqueue,
+                domain_name(domain),
+                domain_product_urls(domain, crawl_state, incremental=incremental, fresh=fresh, limit=limit)
+            )
+            for domain in domains
+        }
+
+    return {domain: future.result() for domain, future in futures.items()}
+
+def share_domain_settings(domain_settings: Dict[str, Dict[str, Any]], worker_count: int, worker_index: int = 0) -> Dict[str, Dict[str, Any]]:
+    """
+    Split the politeness limits of every domain over the workers, so all of them together stay within them
+
+    The concurrency of a domain is handed out in whole requests: the first workers get
+    one more for the remainder, and a worker can get none when there are more workers
+    than the domain allows (it then doesn't crawl the domain).
+
+    Args:
+        domain_settings (dict): {domain: {"max_concurrency", "requests_per_second"}}
+        worker_count (int): Amount of workers running at once
+        worker_index (int): Position of this worker, from 0 to worker_count - 1
+
+    Returns:
+        dict: Limits of a single worker
+    """
+    shared = {}
+    for domain, settings in domain_settings.items():
+        max_concurrency = settings.get("max_concurrency", DOMAIN_CONCURRENCY)
+        shared[domain] = {
+            "max_concurrency": max_concurrency // worker_count + (1 if worker_index < max_concurrency % worker_count else 0),
+            "requests_per_second": settings.get("requests_per_second", DOMAIN_REQUESTS_PER_SECOND) / worker_count,
+        }
+    return shared
+
+class CrawlWorker:
+    def __init__(
+        self,
+        work_queue: TaskQueue,
+        firebase_credentials_path: str,
+        domains: Optional[List[Dict[str, Any]]] = None,
+        worker_id: Optional[str] = None,
+        worker_count: int = 1,
+        worker_index: int = 0,
+        lease_size: int = LEASE_SIZE,
+        concurrency: int = WORKER_CONCURRENCY,
+        poll_interval: float = POLL_INTERVAL,
+        exit_when_empty: bool = True,
+        hash_store: Optional[CrawlState] = None,
+        catalogue_index: Optional[CatalogueIndex] = None
+    ):
+        """
+        Takes product URLs from the work queue, fetches and extracts them, stores the
+        products and acks (or nacks) every task
+
+        Args:
+            work_queue (TaskQueue): Shared work queue
+            firebase_credentials_path (str): Path to Firebase credentials JSON file
+            domains (list): Entries of domains.json, for the politeness limits
+            worker_id (str): Id of the worker, defaults to host-pid
+            worker_count (int): Amount of workers running at once, the domain limits are split between them
+            worker_index (int): Position of this worker, from 0 to worker_count - 1
+            lease_size (int): Tasks leased at a time
+            concurrency (int): Max requests in flight
+            poll_interval (float): Seconds between polls of an empty queue
+            exit_when_empty (bool): Stop once every task is finished, otherwise keep polling
+            hash_store (CrawlState): Content hashes of the stored products, unchanged variants are not written again
+            catalogue_index (CatalogueIndex): Local search index, updated as the products are stored
+        """
+        self.work_queue = work_queue
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_size = lease_size
+        self.poll_interval = poll_interval
+        self.exit_when_empty = exit_when_empty
+        self.logger = logging.getLogger(__name__)
+
+        # {url: id of its leased task}
+        self.tasks = {}
+        self.stop_renewing = threading.Event()
+
+        worker_count = max(1, worker_count)
+        if not 0 <= worker_index < worker_count:
+            raise ValueError(f"worker_index must be between 0 and {worker_count - 1}")
+        domain_settings = share_domain_settings(get_domain_settings(domains or []), worker_count, worker_index)
+        # no share of the domain's concurrency, its tasks are left to the other workers
+        self.excluded_domains = [domain for domain, settings in domain_settings.items() if settings["max_concurrency"] == 0]
+        domain_settings = {domain: settings for domain, settings in domain_settings.items() if settings["max_concurrency"] > 0}
+        self.processor = ProductProcessor(
+            firebase_credentials_path,
+            crawl_settings={"domain_settings": domain_settings, "concurrency": concurrency, "read_ahead": lease_size},
+            hash_store=hash_store,
+            catalogue_index=catalogue_index
+        )
+
+    def leased_urls(self) -> Iterator[str]:
+        """
+        Lease tasks as the crawl engine asks for more urls
+
+        Yields:
+            str: URLs of the leased tasks
+        """
+        while True:
+            tasks = self.work_queue.lease(self.worker_id, self.lease_size, exclude_domains=self.excluded_domains)
+            if tasks:
+                for task in tasks:
+                    self.tasks[task.url] = task.id
+                    yield task.url
+                continue
+
+            stats = self.work_queue.stats()
+            if self.exit_when_empty and not any(stats.get(status) for status in ("queued", "leased", "expired")):
+                return
+            # tasks leased by other workers may still come back
+            time.sleep(self.poll_interval)
+
+    def renew_leases(self):
+        # renewed from a thread while the worker runs, so a page that takes long (retries,
+        # backoff, slow merchant) keeps its lease; a crashed worker stops renewing and loses them
+        while not self.stop_renewing.wait(self.work_queue.visibility_timeout / 3):
+            try:
+                self.work_queue.extend(self.worker_id)
+            except Exception as e:
+                self.logger.error(f"Error renewing the leases of {self.worker_id}: {e}")
+
+    # the worker reports to the queue the way a local crawl reports to its CrawlState
+
+    def mark_done(self, url: str):
+        if not self.work_queue.ack(self.tasks.pop(url), self.worker_id):
+            # the lease expired and another worker has the task, it is processed again there
+            self.logger.warning(f"Lease of {url} lost before it was acked")
+
+    def mark_failed(self, url: str, error: Optional[str] = None):
+        task_id = self.tasks.pop(url, None)
+        if task_id is None:
+            # already acked, its Firestore writes failed after the page was processed
+            self.work_queue.enqueue(urlparse(url).netloc, [url])
+            return
+        if not self.work_queue.nack(task_id, self.worker_id, error):
+            self.logger.warning(f"Lease of {url} lost before it was nacked")
+
+    def flush(self):
+        pass
+
+    def run(self) -> Dict[str, Dict[str, str]]:
+        """
+        Work until the queue is empty (or forever with exit_when_empty=False)
+
+        Returns:
+            dict: Mapping of URLs to their variant results
+        """
+        print(f"Worker {self.worker_id} started")
+        self.stop_renewing.clear()
+        renewer = threading.Thread(target=self.renew_leases, name="lease-renewer", daemon=True)
+        renewer.start()
+        try:
+            return asyncio.run(self.processor.process_url_sources_async([self.leased_urls()], crawl_state=self))
+        finally:
+            self.stop_renewing.set()
+            renewer.join()
+            self.processor.close()
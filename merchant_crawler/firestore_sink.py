@@ -0,0 +1,304 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+try:
+    from google.api_core import exceptions as google_exceptions
+    # contention and overload, the same batch can be committed again
+    RETRYABLE_ERRORS = (
+        google_exceptions.Aborted,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+    )
+    ALREADY_EXISTS_ERRORS = (google_exceptions.AlreadyExists,)
+except ImportError:
+    RETRYABLE_ERRORS = ()
+    ALREADY_EXISTS_ERRORS = ()
+
+# Firestore rejects batches with more writes
+MAX_BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+MAX_CONCURRENT_COMMITS = 4
+# batches committing or waiting for a commit slot before writers are blocked
+MAX_PENDING_BATCHES = 16
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+class Write(NamedTuple):
+    collection: str
+    # auto-generated ids are assigned when the write is queued
+    document_id: str
+    data: Dict[str, Any]
+    merge: bool
+    # what the write came from (e.g. the product page URL), reported back on failure
+    source: Optional[str]
+    # fields only written when the write creates the document (e.g. a creation date)
+    create_fields: Optional[Dict[str, Any]] = None
+
+class FirestoreSink:
+    def __init__(
+        self,
+        db,
+        batch_size: int = MAX_BATCH_SIZE,
+        flush_interval: float = FLUSH_INTERVAL,
+        max_concurrent_commits: int = MAX_CONCURRENT_COMMITS,
+        max_pending_batches: int = MAX_PENDING_BATCHES,
+        max_retries: int = MAX_RETRIES,
+        on_commit: Optional[Callable[[List[Write]], None]] = None,
+        on_failure: Optional[Callable[[List[Write], Exception], None]] = None
+    ):
+        """
+        Write-behind Firestore writer: buffers document writes and commits them in
+        batches of up to 500, on a size or time trigger, several commits at once
+
+        Writers only block when max_pending_batches batches are already waiting to be
+        committed (backpressure). Commits failing on contention or overload are retried
+        with jittered backoff.
+
+        Args:
+            db (firestore.Client): Firestore client
+            batch_size (int): Writes per batch, at most 500
+            flush_interval (float): Max seconds a write stays buffered
+            max_concurrent_commits (int): Batches committed at once
+            max_pending_batches (int): Batches committing or waiting before writers block
+            max_retries (int): Retries of a batch after the first commit
+            on_commit (callable): Called with the writes of every committed batch
+            on_failure (callable): Called with the writes of a batch that could not be committed and the error
+        """
+        if not 0 < batch_size <= MAX_BATCH_SIZE:
+            raise ValueError(f"batch_size must be between 1 and {MAX_BATCH_SIZE}")
+
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_concurrent_commits = max_concurrent_commits
+        self.max_retries = max_retries
+        self.on_commit = on_commit
+        self.on_failure = on_failure
+        self.logger = logging.getLogger(__name__)
+
+        self.buffer = []
+        self.buffer_started = None
+        # batches taken from the buffer but not submitted yet, flush() waits for them too
+        self.unsubmitted = 0
+        self.lock = threading.Condition()
+        self.pending_batches = threading.BoundedSemaphore(max_pending_batches)
+        self.futures = set()
+        self.executor = None
+        self.flusher = None
+        self.running = False
+
+        self.started_at = None
+        self.counters = {
+            "writesQueued": 0,
+            "writesCommitted": 0,
+            "writesFailed": 0,
+            "batchesCommitted": 0,
+            "batchesFailed": 0,
+            "retries": 0,
+            "commitSeconds": 0.0,
+        }
+
+    def start(self):
+        """
+        Start the commit workers and the timed flusher, called once before writing (set starts it too)
+        """
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.started_at = time.monotonic()
+            self.executor = ThreadPoolExecutor(max_workers=self.max_concurrent_commits, thread_name_prefix="firestore-commit")
+            self.flusher = threading.Thread(target=self._flush_periodically, name="firestore-flush", daemon=True)
+            self.flusher.start()
+
+    def close(self):
+        """
+        Commit everything still buffered and stop the workers
+        """
+        self.flush()
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            self.lock.notify_all()
+        self.flusher.join()
+        self.executor.shutdown(wait=True)
+
+    def set(
+        self,
+        collection: str,
+        document_id: Optional[str],
+        data: Dict[str, Any],
+        merge: bool = False,
+        source: Optional[str] = None,
+        create_fields: Optional[Dict[str, Any]] = None
+    ):
+        """
+        Queue a document write, committed within flush_interval seconds
+
+        Args:
+            collection (str): Collection name
+            document_id (str): Document id, None for an auto-generated one
+            data (dict): Document data
+            merge (bool): Merge into the existing document instead of replacing it
+            source (str): What the write came from, passed to on_failure
+            create_fields (dict): Fields only written if the document doesn't exist yet, the
+                document is then created on its own (one more request) before its batch commits
+        """
+        self.start()
+        if document_id is None:
+            # generated once (client side), a retried batch that did commit doesn't create a second document
+            document_id = self.db.collection(collection).document().id
+
+        batch = None
+        with self.lock:
+            self.buffer.append(Write(collection, document_id, data, merge, source, create_fields))
+            self.counters["writesQueued"] += 1
+            if self.buffer_started is None:
+                self.buffer_started = time.monotonic()
+            if len(self.buffer) >= self.batch_size:
+                batch = self._take_buffer()
+
+        if batch:
+            self._submit(batch)
+
+    def flush(self):
+        """
+        Commit the buffered writes now and wait for every pending commit
+        """
+        with self.lock:
+            batch = self._take_buffer()
+        if batch:
+            self._submit(batch)
+
+        with self.lock:
+            # a batch the flusher (or a writer) took is submitted before we look at the futures
+            while self.unsubmitted:
+                self.lock.wait()
+            futures = list(self.futures)
+        wait(futures)
+
+    def _take_buffer(self) -> List[Write]:
+        # called with the lock held, the batch has to be given to _submit
+        batch = self.buffer
+        self.buffer = []
+        self.buffer_started = None
+        if batch:
+            self.unsubmitted += 1
+        return batch
+
+    def _submit(self, batch: List[Write]):
+        try:
+            # backpressure: block the writer while too many batches are pending
+            self.pending_batches.acquire()
+            try:
+                future = self.executor.submit(self._commit, batch)
+            except BaseException:
+                self.pending_batches.release()
+                raise
+            with self.lock:
+                self.futures.add(future)
+        finally:
+            with self.lock:
+                self.unsubmitted -= 1
+                self.lock.notify_all()
+        future.add_done_callback(self._commit_done)
+
+    def _commit_done(self, future):
+        with self.lock:
+            self.futures.discard(future)
+        self.pending_batches.release()
+
+    def _flush_periodically(self):
+        while True:
+            with self.lock:
+                if not self.running:
+                    return
+                timeout = self.flush_interval
+                if self.buffer_started is not None:
+                    timeout = self.buffer_started + self.flush_interval - time.monotonic()
+                if timeout > 0:
+                    self.lock.wait(timeout)
+                    continue
+                batch = self._take_buffer()
+            if batch:
+                self._submit(batch)
+
+    def _commit(self, writes: List[Write]):
+        start_time = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            try:
+                batch = self.db.batch()
+                batched = 0
+                for write in writes:
+                    reference = self.db.collection(write.collection).document(write.document_id)
+                    if write.create_fields is not None and self._create(reference, write):
+                        continue
+                    batch.set(reference, write.data, merge=write.merge)
+                    batched += 1
+                if batched:
+                    batch.commit()
+                break
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    self._commit_failed(writes, e)
+                    return
+                with self.lock:
+                    self.counters["retries"] += 1
+                delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+                self.logger.warning(f"Retrying Firestore batch of {len(writes)} writes in {delay:.1f}s: {e}")
+                time.sleep(delay)
+            except Exception as e:
+                self._commit_failed(writes, e)
+                return
+
+        with self.lock:
+            self.counters["writesCommitted"] += len(writes)
+            self.counters["batchesCommitted"] += 1
+            self.counters["commitSeconds"] += time.monotonic() - start_time
+        if self.on_commit is not None:
+            try:
+                self.on_commit(writes)
+            except Exception as e:
+                self.logger.error(f"Error in Firestore sink commit handler: {e}")
+
+    def _create(self, reference, write: Write) -> bool:
+        # a batched set can't be made create-only (a failed precondition fails the whole batch),
+        # so the document is created on its own; False if it already exists
+        try:
+            reference.create({**write.create_fields, **write.data})
+            return True
+        except ALREADY_EXISTS_ERRORS:
+            return False
+
+    def _commit_failed(self, writes: List[Write], error: Exception):
+        self.logger.error(f"Error committing Firestore batch of {len(writes)} writes: {error}")
+        with self.lock:
+            self.counters["writesFailed"] += len(writes)
+            self.counters["batchesFailed"] += 1
+        if self.on_failure is not None:
+            try:
+                self.on_failure(writes, error)
+            except Exception as e:
+                self.logger.error(f"Error in Firestore sink failure handler: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+            committed = self.counters["writesCommitted"]
+            batches = self.counters["batchesCommitted"]
+            return {
+                **self.counters,
+                "commitSeconds": round(self.counters["commitSeconds"], 3),
+                "buffered": len(self.buffer),
+                "pendingBatches": len(self.futures),
+                "writesPerSecond": round(committed / elapsed, 1) if elapsed else 0.0,
+                "avgCommitSeconds": round(self.counters["commitSeconds"] / batches, 3) if batches else None,
+            }
@@ -0,0 +1,393 @@
+import html
+import json
+import re
+from typing import Any, AsyncIterable, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+JSON_LD_TYPE = "application/ld+json"
+
+# next thing we care about in the text: a comment, or a script / style start tag
+_TOKEN = re.compile(rb"<!--|<(script|style)(?=[\s/>])", re.I)
+# rest of a start tag, quoted attribute values may contain '>'
+_TAG_END = re.compile(rb"""(?:"[^"]*"|'[^']*'|[^'">])*>""")
+_ATTRIBUTE = re.compile(rb"""([^\s/>"'=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]*)))?""")
+# same end tags html.parser uses for raw text elements
+_END_TAGS = {
+    b"script": re.compile(rb"</\s*script\s*>", re.I),
+    b"style": re.compile(rb"</\s*style\s*>", re.I),
+}
+# bytes kept between chunks so a token split over two chunks is still found
+_TOKEN_TAIL = len(b"<script ")
+_END_TAG_TAIL = 64
+_PRODUCT_TYPE = re.compile(r'"@type"\s*:\s*(?:\[\s*)?"(?:Product|ProductGroup)"')
+
+_TEXT, _COMMENT, _START_TAG, _RAW_TEXT = range(4)
+
+def _is_json_ld_tag(attributes: bytes) -> bool:
+    # html.parser keeps the last duplicate attribute, so do the same
+    script_type = None
+    for match in _ATTRIBUTE.finditer(attributes):
+        if match.group(1).lower() == b"type":
+            value = match.group(2) or match.group(3) or match.group(4) or b""
+            script_type = html.unescape(value.decode("utf-8", errors="replace"))
+    return script_type == JSON_LD_TYPE
+
+class JsonLdScanner:
+    def __init__(self):
+        """
+        Incremental scanner that finds <script type="application/ld+json"> blocks in raw
+        HTML bytes without building a DOM. Feed it the page chunk by chunk, every call
+        returns the bodies of the JSON-LD scripts completed so far.
+
+        Comments and the bodies of other scripts / styles are skipped the same way
+        html.parser does, so a "<script" inside them is not picked up.
+        """
+        self.buffer = bytearray()
+        self.state = _TEXT
+        self.pos = 0
+        self.tag_name = None
+        self.keep = False
+        self.body_start = 0
+        self.bytes_scanned = 0
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        """
+        Scan the next chunk of the page
+
+        Args:
+            chunk (bytes): Next bytes of the page
+
+        Returns:
+            list: Raw bodies (bytes) of the JSON-LD scripts completed in this chunk
+        """
+        self.bytes_scanned += len(chunk)
+        self.buffer += chunk
+        return self._scan()
+
+    def close(self) -> List[bytes]:
+        """
+        Finish the scan, an unterminated script is dropped like html.parser does
+
+        Returns:
+            list: Always empty, kept so callers can treat it like feed()
+        """
+        self.buffer = bytearray()
+        self.pos = 0
+        return []
+
+    def _scan(self) -> List[bytes]:
+        buffer = self.buffer
+        pos = self.pos
+        blocks = []
+
+        while True:
+            if self.state == _TEXT:
+                match = _TOKEN.search(buffer, pos)
+                if match is None:
+                    pos = max(pos, len(buffer) - _TOKEN_TAIL)
+                    break
+                pos = match.end()
+                if match.group(1) is None:
+                    self.state = _COMMENT
+                else:
+                    self.state = _START_TAG
+                    self.tag_name = match.group(1).lower()
+
+            elif self.state == _COMMENT:
+                end = buffer.find(b"-->", pos)
+                if end < 0:
+                    pos = max(pos, len(buffer) - 2)
+                    break
+                pos = end + 3
+                self.state = _TEXT
+
+            elif self.state == _START_TAG:
+                match = _TAG_END.match(buffer, pos)
+                if match is None:
+                    # wait for the rest of the tag
+                    break
+                attributes = bytes(buffer[pos:match.end() - 1])
+                pos = match.end()
+
+                # <script ... /> has no body for html.parser
+                if attributes.rstrip().endswith(b"/"):
+                    self.state = _TEXT
+                    continue
+
+                self.keep = self.tag_name == b"script" and _is_json_ld_tag(attributes)
+                self.body_start = pos
+                self.state = _RAW_TEXT
+
+            elif self.state == _RAW_TEXT:
+                match = _END_TAGS[self.tag_name].search(buffer, pos)
+                if match is None:
+                    pos = max(pos, len(buffer) - _END_TAG_TAIL)
+                    break
+                if self.keep:
+                    blocks.append(bytes(buffer[self.body_start:match.start()]))
+                pos = match.end()
+                self.state = _TEXT
+
+        # drop everything we are done with, only a JSON-LD body in progress is kept
+        discard = self.body_start if self.state == _RAW_TEXT and self.keep else pos
+        if discard:
+            del buffer[:discard]
+            pos -= discard
+            self.body_start = max(self.body_start - discard, 0)
+        self.pos = pos
+        return blocks
+
+def is_product_json_ld(script: str) -> bool:
+    """
+    Cheap check (no JSON parse) for a script describing a Product or ProductGroup
+
+    Args:
+        script (str): JSON-LD script body
+
+    Returns:
+        bool: True if the script declares a Product / ProductGroup type
+    """
+    return _PRODUCT_TYPE.search(script) is not None
+
+def extract_json_ld_scripts(page: Union[str, bytes], encoding: str = "utf-8") -> List[str]:
+    """
+    Get the bodies of every JSON-LD script of a page already in memory
+
+    Args:
+        page (str | bytes): Page HTML
+        encoding (str): Encoding of the page when given as bytes
+
+    Returns:
+        list: JSON-LD script bodies, in page order
+    """
+    if isinstance(page, str):
+        page = page.encode("utf-8")
+        encoding = "utf-8"
+
+    scanner = JsonLdScanner()
+    blocks = scanner.feed(page) + scanner.close()
+    return [block.decode(encoding, errors="replace") for block in blocks]
+
+def scan_json_ld_chunks(
+    chunks: Iterable[bytes],
+    encoding: str = "utf-8",
+    stop_when: Optional[Callable[[str], bool]] = None
+) -> Tuple[List[str], bool]:
+    """
+    Get the JSON-LD script bodies from a page read chunk by chunk
+
+    Args:
+        chunks (iterable): Byte chunks of the page (e.g. requests iter_content)
+        encoding (str): Encoding of the page
+        stop_when (callable): Stop reading as soon as it returns True for a script
+
+    Returns:
+        tuple: (script bodies, True if we stopped before the end of the page)
+    """
+    scanner = JsonLdScanner()
+    scripts = []
+    for chunk in chunks:
+        for block in scanner.feed(chunk):
+            script = block.decode(encoding, errors="replace")
+            scripts.append(script)
+            if stop_when is not None and stop_when(script):
+                return scripts, True
+    scanner.close()
+    return scripts, False
+
+async def scan_json_ld_stream(
+    chunks: AsyncIterable[bytes],
+    encoding: str = "utf-8",
+    stop_when: Optional[Callable[[str], bool]] = None
+) -> Tuple[List[str], bool]:
+    """
+    Async version of scan_json_ld_chunks (e.g. for aiohttp response.content.iter_chunked)
+
+    Args:
+        chunks (async iterable): Byte chunks of the page
+        encoding (str): Encoding of the page
+        stop_when (callable): Stop reading as soon as it returns True for a script
+
+    Returns:
+        tuple: (script bodies, True if we stopped before the end of the page)
+    """
+    scanner = JsonLdScanner()
+    scripts = []
+    async for chunk in chunks:
+        for block in scanner.feed(chunk):
+            script = block.decode(encoding, errors="replace")
+            scripts.append(script)
+            if stop_when is not None and stop_when(script):
+                return scripts, True
+    scanner.close()
+    return scripts, False
+
+def load_json_ld_documents(scripts: Iterable[str]) -> List[Any]:
+    """
+    Parse JSON-LD script bodies, skipping the ones that are not valid JSON
+
+    Args:
+        scripts (iterable): JSON-LD script bodies
+
+    Returns:
+        list: Every parsed document, top level arrays are flattened
+    """
+    documents = []
+    for script in scripts:
+        try:
+            data = json.loads(script)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(data, list):
+            documents.extend(data)
+        else:
+            documents.append(data)
+    return documents
+
+PRODUCT_TYPES = {"Product", "IndividualProduct", "ProductModel"}
+PRODUCT_GROUP_TYPE = "ProductGroup"
+
+def get_json_ld_types(node: Dict[str, Any]) -> Set[str]:
+    """
+    Get the schema.org types of a JSON-LD node ("@type" can be a string or a list)
+
+    Args:
+        node (dict): JSON-LD node
+
+    Returns:
+        set: Type names without their schema.org prefix
+    """
+    types = node.get("@type")
+    if isinstance(types, str):
+        types = [types]
+    elif not isinstance(types, list):
+        return set()
+    return {t.rsplit("/", 1)[-1].rsplit(":", 1)[-1] for t in types if isinstance(t, str)}
+
+def resolve_offer(offers: Any) -> Dict[str, Any]:
+    """
+    Get the offer to use for a product, "offers" can be a dict, a list or an AggregateOffer
+
+    Args:
+        offers: Value of the "offers" property
+
+    Returns:
+        dict: First usable offer, empty if there is none
+    """
+    if isinstance(offers, list):
+        for offer in offers:
+            resolved = resolve_offer(offer)
+            if resolved:
+                return resolved
+        return {}
+
+    if not isinstance(offers, dict):
+        return {}
+
+    if "AggregateOffer" in get_json_ld_types(offers) and offers.get("price") is None:
+        nested = resolve_offer(offers.get("offers"))
+        if nested:
+            return nested
+        return {**offers, "price": offers.get("lowPrice")}
+
+    return offers
+
+def resolve_image(image: Any) -> Optional[str]:
+    """
+    Get the first image URL, "image" can be a string, an ImageObject or a list of either
+
+    Args:
+        image: Value of the "image" property
+
+    Returns:
+        str: Image URL, None if there is none
+    """
+    if isinstance(image, str):
+        return image or None
+    if isinstance(image, list):
+        for item in image:
+            resolved = resolve_image(item)
+            if resolved:
+                return resolved
+        return None
+    if isinstance(image, dict):
+        return image.get("url") or image.get("contentUrl")
+    return None
+
+def _as_list(value: Any) -> List[Any]:
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+def iter_json_ld_products(documents: Any) -> Iterator[Tuple[Dict[str, Any], Optional[Dict[str, Any]], Dict[str, Any]]]:
+    """
+    Walk JSON-LD documents once and yield every product on the page
+
+    Handles top level arrays, "@graph", products nested in other nodes (WebPage,
+    ItemList, ...), ProductGroup variants (inline or referenced by "@id") and
+    products pointing at their group with "isVariantOf".
+
+    Args:
+        documents: Parsed JSON-LD, a single document or a list of them
+
+    Yields:
+        tuple: (product node, its ProductGroup node or None, resolved offer dict)
+    """
+    nodes_by_id = {}
+    found = {}
+    variant_refs = []
+
+    stack = [(documents, None)]
+    while stack:
+        value, group = stack.pop()
+
+        if isinstance(value, list):
+            stack.extend((item, group) for item in reversed(value))
+            continue
+        if not isinstance(value, dict):
+            continue
+
+        node_id = value.get("@id")
+        if isinstance(node_id, str) and len(value) > 1:
+            nodes_by_id.setdefault(node_id, value)
+
+        types = get_json_ld_types(value)
+
+        if PRODUCT_GROUP_TYPE in types:
+            variants = _as_list(value.get("hasVariant"))
+            if not variants:
+                # a group without variants is the product itself
+                found[id(value)] = [value, None]
+                continue
+            for variant in reversed(variants):
+                if isinstance(variant, dict) and set(variant) == {"@id"}:
+                    variant_refs.append((variant["@id"], value))
+                else:
+                    stack.append((variant, value))
+            continue
+
+        if types & PRODUCT_TYPES:
+            found[id(value)] = [value, group]
+            continue
+
+        # any other node may hold products (@graph, mainEntity, itemListElement, ...)
+        stack.extend(
+            (child, None) for child in reversed(list(value.values()))
+            if isinstance(child, (dict, list))
+        )
+
+    # variants listed by reference only
+    for ref_id, group in variant_refs:
+        node = nodes_by_id.get(ref_id)
+        if node is not None and get_json_ld_types(node) & PRODUCT_TYPES:
+            found.setdefault(id(node), [node, None])[1] = group
+
+    for product, group in found.values():
+        if group is None and isinstance(product.get("isVariantOf"), dict):
+            parent = product["isVariantOf"]
+            group = nodes_by_id.get(parent.get("@id"), parent) if set(parent) == {"@id"} else parent
+
+        offer = resolve_offer(product.get("offers"))
+        if not offer and group is not None:
+            offer = resolve_offer(group.get("offers"))
+
+        yield product, group, offer
@@ -1,10 +1,18 @@
 import json
-from crawl_with_sitemap import BoxLunchSitemapCrawler
-from process_products import ProductProcessor
+import argparse
+from crawl_state import CrawlState
+from scheduler import CrawlScheduler
+from work_queue import WorkQueue
+from crawl_worker import CrawlWorker, discover_to_queue
+from catalogue_index import CATALOGUE_INDEX_PATH, CatalogueIndex
 
 
 pathToDomainsJSON = r"merchant_crawler\domains.json"
 FIREBASE_CREDENTIALS = r'credentials\bag-haven-qt9s4v-firebase-adminsdk-h9x05-e584032402.json'
+# per url crawl status, an interrupted crawl resumes from here
+CRAWL_STATE_PATH = r"merchant_crawler\crawl_state.sqlite3"
+# shared by the discovery and the workers of a distributed crawl
+WORK_QUEUE_PATH = r"merchant_crawler\work_queue.sqlite3"
 
 def read_domains(pathToDomainsJSON):
 
@@ -19,72 +27,98 @@ def read_domains(pathToDomainsJSON):
 
     return domains
 
-def main():
+def main(fresh=False, incremental=False):
     domains = None
 
     # read domains from domains.json file
     domains = read_domains(pathToDomainsJSON)
 
     print(f"Domains: {domains}")
-    
-    for domain in domains:
 
-        domainBaseUrl = domain["base_url"]
-        domainSitemapUrl = domain["sitemap_url"]
-
-        print(f"Domain: {domainBaseUrl}")
-        print(f"Sitemap: {domainSitemapUrl}")
-
-        # Create BoxLunch sitemap crawler
-        crawler = BoxLunchSitemapCrawler(domainBaseUrl, domainSitemapUrl)
-
-        print(f"BoxLunch sitemap crawler created. With attributes: {crawler.__dict__}")
-
-        # Crawl product sitemaps
-        all_urls = crawler.crawl_product_sitemaps()
-
-        # Filter product URLs
-        product_urls = crawler.filter_product_urls(all_urls)
-
-        # Print results
-        print(f"Total URLs discovered: {len(all_urls)}")
-        print(f"Product URLs: {len(product_urls)}")
-
-        # for each of the product urls
-        limit = -1
-
-        if (limit < 0):
-            limit = len(product_urls)
-
-        processor = ProductProcessor(FIREBASE_CREDENTIALS)
-
-        results = processor.process_product_urls(product_urls[:limit])
-
-        # Print results
-        print("\nProcessing Results:")
-        for url, variants in results.items():
-            print(f"\nURL: {url}")
-            print("Variants:")
-            for sku, product_id in variants.items():
-                print(f"  SKU: {sku} -> Product ID: {product_id}")
-        # for url in product_urls[:limit]:
-
-        #     processor = ProductProcessor(FIREBASE_CREDENTIALS)
-            
-        #     results = processor.process_product_urls(product_urls)
-            
-        #     print("\nProcessing Results:")
-        #     for url, variants in results.items():
-        #         print(f"\nURL: {url}")
-        #         print("Variants:")
-        #         for sku, product_id in variants.items():
-        #             print(f"  SKU: {sku} -> Product ID: {product_id}")
-        #             print(f"URL: {url}")
-
-        # get all the JSON LD data for each of the product urls
-
-        # print the results
-        
+    crawl_state = CrawlState(CRAWL_STATE_PATH)
+    # searched by the API before it goes to the live search
+    catalogue_index = CatalogueIndex(CATALOGUE_INDEX_PATH)
+
+    # every domain is crawled at once, sharing one Firestore client and one HTTP session
+    try:
+        scheduler = CrawlScheduler(
+            domains, crawl_state, FIREBASE_CREDENTIALS,
+            incremental=incremental, fresh=fresh, catalogue_index=catalogue_index
+        )
+        results = scheduler.run()
+    finally:
+        crawl_state.close()
+        catalogue_index.close()
+
+    # Print results
+    print("\nProcessing Results:")
+    for url, variants in results.items():
+        print(f"\nURL: {url}")
+        print("Variants:")
+        for sku, product_id in variants.items():
+            print(f"  SKU: {sku} -> Product ID: {product_id}")
+
+def discover(queue_path, fresh=False, incremental=False):
+    """
+    Distributed crawl: discover the product URLs of every domain into the work queue
+    """
+    domains = read_domains(pathToDomainsJSON)
 
+    crawl_state = CrawlState(CRAWL_STATE_PATH)
+    work_queue = WorkQueue(queue_path)
+    try:
+        enqueued = discover_to_queue(domains, crawl_state, work_queue, incremental=incremental, fresh=fresh)
+        print(f"Enqueued: {enqueued} - queue: {work_queue.stats()}")
+    finally:
+        work_queue.close()
+        crawl_state.close()
+
+def work(queue_path, worker_id=None, worker_count=1, worker_index=0, keep_running=False, hashes_path=CRAWL_STATE_PATH):
+    """
+    Distributed crawl: process product URLs from the work queue until it is empty
+    """
+    domains = read_domains(pathToDomainsJSON)
 
-main()
\ No newline at end of file
+    work_queue = WorkQueue(queue_path)
+    # content hashes of the stored products, shared with the discovery unless --hashes gives the worker its own
+    hash_store = CrawlState(hashes_path)
+    catalogue_index = CatalogueIndex(CATALOGUE_INDEX_PATH)
+    try:
+        worker = CrawlWorker(
+            work_queue,
+            FIREBASE_CREDENTIALS,
+            domains=domains,
+            worker_id=worker_id,
+            worker_count=worker_count,
+            worker_index=worker_index,
+            exit_when_empty=not keep_running,
+            hash_store=hash_store,
+            catalogue_index=catalogue_index
+        )
+        results = worker.run()
+        print(f"Worker {worker.worker_id} processed {len(results)} product pages - queue: {work_queue.stats()}")
+    finally:
+        work_queue.close()
+        hash_store.close()
+        catalogue_index.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Crawl the product pages of every domain in domains.json")
+    parser.add_argument("--mode", choices=["local", "discover", "worker"], default="local",
+                        help="local: discover and crawl in this process. discover / worker: distributed crawl over a shared work queue")
+    parser.add_argument("--fresh", action="store_true", help="Start a new crawl instead of resuming the last one")
+    parser.add_argument("--incremental", action="store_true", help="Only fetch new product pages and pages with a newer sitemap <lastmod>")
+    parser.add_argument("--queue", default=WORK_QUEUE_PATH, help="Path of the shared work queue")
+    parser.add_argument("--worker-id", help="Id of this worker, defaults to host-pid")
+    parser.add_argument("--workers", type=int, default=1, help="Amount of workers running at once, they share the domain limits")
+    parser.add_argument("--worker-index", type=int, default=0, help="Position of this worker (0 to --workers - 1), for its share of the domain limits")
+    parser.add_argument("--keep-running", action="store_true", help="Keep polling the queue once it is empty")
+    parser.add_argument("--hashes", default=CRAWL_STATE_PATH, help="Worker: SQLite file keeping the content hashes of the stored products")
+    args = parser.parse_args()
+
+    if args.mode == "discover":
+        discover(args.queue, fresh=args.fresh, incremental=args.incremental)
+    elif args.mode == "worker":
+        work(args.queue, worker_id=args.worker_id, worker_count=args.workers, worker_index=args.worker_index, keep_running=args.keep_running, hashes_path=args.hashes)
+    else:
+        main(fresh=args.fresh, incremental=args.incremental)
\ No newline at end of file
@@ -1,24 +1,59 @@
 import requests
-from bs4 import BeautifulSoup
+import asyncio
 import json
 import firebase_admin
 from firebase_admin import credentials, firestore
 import uuid
+import hashlib
 import logging
-from typing import Optional, Dict, Any, List
+import threading
+from urllib.parse import urlparse
+from typing import Optional, Dict, Any, Iterable, List
+from jsonld_extractor import scan_json_ld_chunks, load_json_ld_documents, iter_json_ld_products
+from async_crawler import AsyncCrawlEngine
+from crawl_state import CrawlState
+from firestore_sink import FirestoreSink
+from catalogue_index import CatalogueIndex
+
+HTML_CHUNK_SIZE = 64 * 1024
+
+def content_hash(data: Dict[str, Any]) -> str:
+    """
+    Hash of a product document, equal for documents with the same content (key order doesn't matter)
+    """
+    serialized = json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.blake2b(serialized.encode('utf-8'), digest_size=16).hexdigest()
 
 class ProductProcessor:
-    def __init__(self, firebase_credentials_path: str):
+    def __init__(
+        self,
+        firebase_credentials_path: str,
+        crawl_settings: Optional[Dict[str, Any]] = None,
+        db=None,
+        sink_settings: Optional[Dict[str, Any]] = None,
+        hash_store: Optional[CrawlState] = None,
+        catalogue_index: Optional[CatalogueIndex] = None
+    ):
         """
         Initialize the product processor
         
         Args:
             firebase_credentials_path (str): Path to Firebase credentials JSON file
+            crawl_settings (dict): Keyword arguments of the AsyncCrawlEngine (concurrency, domain_settings, ...)
+            db (firestore.Client): Shared Firestore client, created from the credentials if not given
+            sink_settings (dict): Keyword arguments of the FirestoreSink (batch_size, flush_interval, ...)
+            hash_store (CrawlState): Content hashes of the stored products, unchanged variants are not written again
+            catalogue_index (CatalogueIndex): Local search index, updated as the products are stored
         """
-        # Initialize Firebase
-        cred = credentials.Certificate(firebase_credentials_path)
-        firebase_admin.initialize_app(cred)
-        self.db = firestore.client()
+        # Initialize Firebase, only once per process
+        if db is None:
+            try:
+                firebase_admin.get_app()
+            except ValueError:
+                cred = credentials.Certificate(firebase_credentials_path)
+                firebase_admin.initialize_app(cred)
+            db = firestore.client()
+        self.db = db
         
         # Set up logging
         logging.basicConfig(level=logging.INFO)
@@ -28,6 +63,55 @@ class ProductProcessor:
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
+        
+        # Async engine used to crawl many URLs at once
+        self.crawl_engine = AsyncCrawlEngine(headers=self.headers, **(crawl_settings or {}))
+
+        # Variants are written behind the crawl, in batches committed in parallel
+        self.sink = FirestoreSink(self.db, on_commit=self.on_write_commit, on_failure=self.on_write_failure, **(sink_settings or {}))
+        self.hash_store = hash_store
+        self.catalogue_index = catalogue_index
+        self.lock = threading.Lock()
+        # source URLs of the writes the sink couldn't commit
+        self.failed_writes = {}
+        self.variant_counts = {"written": 0, "unchanged": 0}
+        # hashes queued on the sink, not recorded in the hash store until committed
+        self.queued_hashes = {}
+
+    def close(self):
+        """
+        Commit the writes still buffered and stop the Firestore sink
+        """
+        self.sink.close()
+
+    def on_write_commit(self, writes):
+        # only committed writes are recorded, a failed one is written again next crawl
+        if self.hash_store is not None:
+            self.hash_store.set_content_hashes(
+                (write.document_id, write.data['contentHash']) for write in writes if 'contentHash' in write.data
+            )
+        if self.catalogue_index is not None:
+            self.catalogue_index.upsert(write.data for write in writes if write.collection == 'products')
+
+    def on_write_failure(self, writes, error: Exception):
+        with self.lock:
+            for write in writes:
+                # written again when its page is retried
+                self.queued_hashes.pop(write.document_id, None)
+                if write.source:
+                    self.failed_writes[write.source] = f"Firestore write failed: {type(error).__name__}: {error}"
+
+    def pop_failed_writes(self) -> Dict[str, str]:
+        """
+        Get (and forget) the source URLs whose variants could not be committed
+
+        Returns:
+            dict: Mapping of URLs to the error
+        """
+        with self.lock:
+            failed = self.failed_writes
+            self.failed_writes = {}
+        return failed
 
     def extract_json_ld(self, url: str) -> Optional[List[Dict[str, Any]]]:
         """
@@ -40,26 +124,19 @@ class ProductProcessor:
             list: List of JSON-LD data objects or None if not found
         """
         try:
-            # Fetch the page
-            response = requests.get(url, headers=self.headers)
+            # Stream the page, we only need the JSON-LD scripts
+            response = requests.get(url, headers=self.headers, stream=True)
             response.raise_for_status()
+            encoding = response.encoding or 'utf-8'
             
-            # Parse HTML
-            soup = BeautifulSoup(response.text, 'html.parser')
+            # Scan the raw bytes for JSON-LD script tags (no DOM), keep every script of the page
+            try:
+                scripts, _ = scan_json_ld_chunks(response.iter_content(chunk_size=HTML_CHUNK_SIZE), encoding)
+            finally:
+                response.close()
+            json_ld_list = load_json_ld_documents(scripts)
             
-            # Find JSON-LD script tags
-            json_ld_scripts = soup.find_all('script', type='application/ld+json')
-            
-            for script in json_ld_scripts:
-                if script and script.string:
-                    try:
-                        json_ld_data = json.loads(script.string)
-                        # Return as list if it's a list, otherwise wrap in list
-                        return json_ld_data if isinstance(json_ld_data, list) else [json_ld_data]
-                    except json.JSONDecodeError:
-                        continue
-            
-            return None
+            return json_ld_list or None
         
         except requests.RequestException as e:
             self.logger.error(f"Error fetching product page {url}: {e}")
@@ -77,90 +154,122 @@ class ProductProcessor:
         """
         products = []
         
-        for item in json_ld_list:
-            # Check if this is a ProductGroup
-            if isinstance(item, dict) and item.get('@type') == 'ProductGroup':
-                # Base product information
-                base_product = {
-                    'groupId': item.get('productGroupID'),
-                    'baseUrl': item.get('url'),
-                    'baseName': item.get('name'),
-                    'baseDescription': item.get('description'),
-                    'baseImage': item.get('image'),
-                    'variesBy': item.get('variesBy', [])
-                }
-                
-                # Process each variant
-                variants = item.get('hasVariant', [])
-                for variant in variants:
-                    if variant.get('@type') == 'Product':
-                        variant_data = {
-                            **base_product,  # Include base product info
-                            'sku': variant.get('sku'),
-                            'name': variant.get('name'),
-                            'description': variant.get('description'),
-                            'image': variant.get('image'),
-                            'color': variant.get('color'),
-                            'size': variant.get('size'),
-                            'productUrl': variant.get('offers', {}).get('url'),
-                            'price': variant.get('offers', {}).get('price'),
-                            'priceCurrency': variant.get('offers', {}).get('priceCurrency'),
-                            'availability': variant.get('offers', {}).get('availability'),
-                            'type': 'variant'
-                        }
-                        products.append(variant_data)
+        # Walk every document once: @graph, nested arrays, ProductGroup variants and standalone Products
+        for product, group, offer in iter_json_ld_products(json_ld_list):
+            # Base product information comes from the group, or the product itself when it has none
+            base = group if group is not None else product
+            base_product = {
+                'groupId': base.get('productGroupID'),
+                'baseUrl': base.get('url'),
+                'baseName': base.get('name'),
+                'baseDescription': base.get('description'),
+                'baseImage': base.get('image'),
+                'variesBy': base.get('variesBy', [])
+            }
+            
+            variant_data = {
+                **base_product,  # Include base product info
+                'jsonLdId': product.get('@id'),
+                'sku': product.get('sku'),
+                'name': product.get('name'),
+                'description': product.get('description'),
+                'image': product.get('image'),
+                'color': product.get('color'),
+                'size': product.get('size'),
+                'productUrl': offer.get('url'),
+                'price': offer.get('price'),
+                'priceCurrency': offer.get('priceCurrency'),
+                'availability': offer.get('availability'),
+                'type': 'variant' if group is not None else 'product'
+            }
+            products.append(variant_data)
         
         return products
 
-    def generate_product_id(self) -> str:
+    def generate_product_id(self, domain: str, variant: Dict[str, Any], source_url: str) -> str:
         """
-        Generate a unique product ID
+        Generate the product ID of a variant, the same on every crawl so a recrawl updates
+        the document instead of adding a duplicate
+        
+        Args:
+            domain (str): Domain of the merchant
+            variant (dict): Variant data
+            source_url (str): Page the variant was extracted from
         
         Returns:
-            str: Unique product ID
+            str: Product ID, derived from the SKU, else the JSON-LD @id, else the product URL and name
         """
-        return str(uuid.uuid4())
+        key = variant.get('sku') or variant.get('jsonLdId') or f"{variant.get('productUrl') or source_url}#{variant.get('name')}"
+        return str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{domain}:{key}"))
 
     def store_product_variants(self, variants_data: List[Dict[str, Any]], source_url: str) -> Dict[str, str]:
         """
         Store all product variants in Firebase
+
+        Variants whose content hash didn't change since they were last stored are skipped,
+        the others are upserted. The writes are queued on the Firestore sink and committed
+        in the background, call sink.flush (process_url_sources_async does at the end) to
+        wait for them.
         
         Args:
             variants_data (list): List of product variants to store
             source_url (str): Original URL where the data was extracted from
             
         Returns:
-            dict: Mapping of SKUs to their generated product IDs
+            dict: Mapping of SKUs to their product IDs
         """
         results = {}
+        domain = urlparse(source_url).netloc
         
         try:
-            # Create a batch write
-            batch = self.db.batch()
-            
+            documents = {}
             for variant in variants_data:
-                # Generate product ID
-                product_id = self.generate_product_id()
+                # Stable product ID
+                product_id = self.generate_product_id(domain, variant, source_url)
                 
-                # Add metadata
+                # Add metadata, the hash leaves out the page the variant was found on (a SKU
+                # listed on several pages would be written again for every one of them)
                 enriched_data = {
                     'productId': product_id,
                     'sourceUrl': source_url,
-                    'dateAdded': firestore.SERVER_TIMESTAMP,
-                    **variant  # Include all variant data
+                    **variant,  # Include all variant data
+                    'contentHash': content_hash(variant)
                 }
-                
-                # Add to batch
-                doc_ref = self.db.collection('products').document(product_id)
-                batch.set(doc_ref, enriched_data)
+                documents[product_id] = enriched_data
                 
                 # Store mapping of SKU to product ID
                 results[variant['sku']] = product_id
             
-            # Commit the batch
-            batch.commit()
+            stored_hashes = self.hash_store.get_content_hashes(list(documents)) if self.hash_store is not None else {}
+            
+            written = 0
+            unchanged = []
+            for product_id, enriched_data in documents.items():
+                stored_hash = stored_hashes.get(product_id)
+                with self.lock:
+                    # the same variant on another page of this crawl
+                    if self.queued_hashes.get(product_id, stored_hash) == enriched_data['contentHash']:
+                        unchanged.append(enriched_data)
+                        continue
+                    self.queued_hashes[product_id] = enriched_data['contentHash']
+                enriched_data['dateUpdated'] = firestore.SERVER_TIMESTAMP
+                # not in the hash store, probably new: dateAdded is only written if the document
+                # doesn't exist (the hash store can be empty or another worker's)
+                create_fields = {'dateAdded': firestore.SERVER_TIMESTAMP} if stored_hash is None else None
+                
+                # Queue the upsert, blocks only while the sink is backed up
+                self.sink.set('products', product_id, enriched_data, merge=True, source=source_url, create_fields=create_fields)
+                written += 1
+            
+            # already stored, indexed in case the index is newer than the hash store (a no-op otherwise)
+            if self.catalogue_index is not None and unchanged:
+                self.catalogue_index.upsert(unchanged)
             
-            self.logger.info(f"Successfully stored {len(variants_data)} variants")
+            with self.lock:
+                self.variant_counts["written"] += written
+                self.variant_counts["unchanged"] += len(documents) - written
+            
+            self.logger.info(f"Queued {written} variants, {len(documents) - written} unchanged")
             return results
         
         except Exception as e:
@@ -180,6 +289,25 @@ class ProductProcessor:
         # Extract JSON-LD
         json_ld_data = self.extract_json_ld(url)
         
+        results = self.process_json_ld(url, json_ld_data)
+
+        # a single page is stored before returning
+        self.sink.flush()
+        if self.pop_failed_writes():
+            return {}
+        return results
+
+    def process_json_ld(self, url: str, json_ld_data: Optional[List[Dict[str, Any]]]) -> Dict[str, str]:
+        """
+        Extract the variants from the JSON-LD of a page and store them in Firebase
+        
+        Args:
+            url (str): Product URL the JSON-LD was extracted from
+            json_ld_data (list): JSON-LD documents of the page
+        
+        Returns:
+            dict: Mapping of SKUs to their generated product IDs
+        """
         if not json_ld_data:
             self.logger.warning(f"No valid JSON-LD found for {url}")
             return {}
@@ -194,24 +322,79 @@ class ProductProcessor:
         # Store variants
         return self.store_product_variants(variants, url)
 
-    def process_product_urls(self, urls: List[str]) -> Dict[str, Dict[str, str]]:
+    def process_product_urls(self, urls: List[str], crawl_state: Optional[CrawlState] = None) -> Dict[str, Dict[str, str]]:
         """
-        Process multiple product URLs
+        Process multiple product URLs concurrently (see process_product_urls_async)
         
         Args:
             urls (list): List of product URLs to process
+            crawl_state (CrawlState): Crawl state to record the status of every URL in
         
         Returns:
             dict: Mapping of URLs to their variant results
         """
-        self.logger.info(f"Processing {len(urls)} URLs")
+        return asyncio.run(self.process_product_urls_async(urls, crawl_state))
+
+    async def process_product_urls_async(self, urls: Iterable[str], crawl_state: Optional[CrawlState] = None) -> Dict[str, Dict[str, str]]:
+        """
+        Crawl product URLs with the async engine, bounded globally and per domain
         
-        results = {}
+        Args:
+            urls (iterable): Product URLs to process, can be a generator
+            crawl_state (CrawlState): Crawl state to record the status of every URL in
         
-        for url in urls:
-            variant_results = self.process_product_url(url)
+        Returns:
+            dict: Mapping of URLs to their variant results
+        """
+        return await self.process_url_sources_async([urls], crawl_state)
+
+    async def process_url_sources_async(self, sources: List[Iterable[str]], crawl_state: Optional[CrawlState] = None) -> Dict[str, Dict[str, str]]:
+        """
+        Crawl the product URLs of several sources (e.g. one per merchant) at once, sharing one session
+        
+        Args:
+            sources (list): Iterables of product URLs, can be generators
+            crawl_state (CrawlState): Crawl state to record the status of every URL in (anything with
+                mark_done / mark_failed / flush, a CrawlWorker reports to its work queue)
+        
+        Returns:
+            dict: Mapping of URLs to their variant results
+        """
+        results = {}
+
+        # the crawl state / work queue writes to disk (or the network), never on the event loop
+        async def handle_result(url, json_ld_data, error):
+            if error:
+                if crawl_state is not None:
+                    await asyncio.to_thread(crawl_state.mark_failed, url, error)
+                return
+            # queueing on the sink blocks when Firestore falls behind, keep it off the event loop
+            try:
+                variant_results = await asyncio.to_thread(self.process_json_ld, url, json_ld_data)
+            except Exception as e:
+                if crawl_state is not None:
+                    await asyncio.to_thread(crawl_state.mark_failed, url, f"{type(e).__name__}: {e}")
+                raise
+            if crawl_state is not None:
+                await asyncio.to_thread(crawl_state.mark_done, url)
             if variant_results:
                 results[url] = variant_results
+
+        try:
+            stats = await self.crawl_engine.crawl_sources(sources, handle_result)
+        finally:
+            # wait for the writes behind the crawl, pages whose writes failed are retried next run
+            await asyncio.to_thread(self.sink.flush)
+            failed_writes = self.pop_failed_writes()
+            for url, error in failed_writes.items():
+                results.pop(url, None)
+                if crawl_state is not None:
+                    await asyncio.to_thread(crawl_state.mark_failed, url, error)
+            if crawl_state is not None:
+                await asyncio.to_thread(crawl_state.flush)
+            if self.hash_store is not None and self.hash_store is not crawl_state:
+                await asyncio.to_thread(self.hash_store.flush)
+        self.logger.info(f"Processed URLs: {stats} - variants: {self.variant_counts} - Firestore writes: {self.sink.stats()}")
         
         return results
 
@@ -233,6 +416,7 @@ if __name__ == '__main__':
     
     # Process products
     results = processor.process_product_urls(product_urls)
+    processor.close()
     
     # Print results
     print("\nProcessing Results:")
@@ -0,0 +1,215 @@
+import asyncio
+import logging
+from itertools import islice
+from typing import Any, Dict, Iterator, List, Optional
+from urllib.parse import urlparse
+
+from async_crawler import DOMAIN_CONCURRENCY
+from crawl_state import CrawlState
+from crawl_with_sitemap import BoxLunchSitemapCrawler, parse_lastmod
+from catalogue_index import CatalogueIndex
+from process_products import ProductProcessor
+
+# cap of the requests in flight over every domain together
+SCHEDULER_MAX_CONCURRENCY = 128
+
+def discover_product_urls(crawler, crawl_state, domainName, incremental=False):
+    """
+    Stream the product sitemaps of a domain into the crawl state
+
+    Args:
+        crawler (BoxLunchSitemapCrawler): Sitemap crawler of the domain
+        crawl_state (CrawlState): Crawl state to record the urls in
+        domainName (str): Domain (netloc)
+        incremental (bool): Skip child sitemaps and product pages unchanged since the last crawl
+
+    Yields:
+        str: Product URLs to crawl, as soon as they are discovered
+    """
+    # child sitemaps unchanged since the last crawl are not downloaded again
+    skip_sitemap = None
+    if incremental:
+        skip_sitemap = lambda sitemap: crawl_state.is_sitemap_unchanged(sitemap.loc, parse_lastmod(sitemap.lastmod))
+
+    crawled_sitemaps = []
+    failed_sitemaps = []
+
+    # Crawl product sitemaps, keeping <lastmod> of every url (raises if the sitemap index can't be read)
+    entries = crawler.iter_product_sitemap_entries(
+        skip_sitemap=skip_sitemap,
+        on_sitemap_crawled=crawled_sitemaps.append,
+        on_sitemap_failed=failed_sitemaps.append
+    )
+
+    # Filter product URLs
+    product_entries = (
+        (entry.loc, parse_lastmod(entry.lastmod)) for entry in entries
+        if crawler.is_product_url(entry.loc)
+    )
+
+    discovered = 0
+    for url in crawl_state.record_entries(domainName, product_entries, skip_unchanged=incremental):
+        discovered += 1
+        yield url
+
+    # only recorded once their urls are, so a crash never skips a sitemap we didn't read
+    crawl_state.set_sitemap_lastmods(domainName, ((sitemap.loc, parse_lastmod(sitemap.lastmod)) for sitemap in crawled_sitemaps))
+
+    if failed_sitemaps:
+        # the urls of a sitemap we couldn't read are not gone: leave the unseen urls as they are and
+        # keep the discovery open, the next run reads the sitemaps again
+        logging.getLogger(__name__).error(
+            f"{len(failed_sitemaps)} sitemaps of {domainName} failed, discovery left incomplete"
+        )
+    else:
+        # urls of skipped sitemaps that still have to be crawled
+        for url in crawl_state.complete_discovery(domainName, skip_unchanged=incremental):
+            discovered += 1
+            yield url
+
+    print(f"Product URLs to crawl: {discovered} - crawl state: {crawl_state.counts(domainName)}")
+
+def domain_name(domain: Dict[str, Any]) -> str:
+    return urlparse(domain["base_url"]).netloc
+
+def get_domain_settings(domains: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Politeness limits of every domain (see domains.json), in the format of AsyncCrawlEngine domain_settings
+    """
+    return {
+        domain_name(domain): {
+            key: domain[key] for key in ("max_concurrency", "requests_per_second") if key in domain
+        }
+        for domain in domains
+    }
+
+def domain_product_urls(
+    domain: Dict[str, Any],
+    crawl_state: CrawlState,
+    incremental: bool = False,
+    fresh: bool = False,
+    limit: Optional[int] = None
+) -> Iterator[str]:
+    """
+    Product URLs to crawl for a domain, resumed from the crawl state or discovered from its sitemaps
+
+    Args:
+        domain (dict): Entry of domains.json
+        crawl_state (CrawlState): Crawl state shared by every domain
+        incremental (bool): Only fetch new product pages and pages with a newer <lastmod>
+        fresh (bool): Start a new crawl instead of resuming an interrupted one
+        limit (int): Max product URLs (for testing)
+
+    Yields:
+        str: Product URLs
+    """
+    domainName = domain_name(domain)
+
+    try:
+        # Resume the last crawl of the domain if it was interrupted
+        resumed = crawl_state.start_crawl(domainName, fresh=fresh)
+
+        if resumed and crawl_state.is_discovery_complete(domainName):
+            # the sitemaps were already crawled, don't download them again
+            print(f"Resuming crawl of {domainName}: {crawl_state.counts(domainName)}")
+
+            # only urls not done yet, failed ones are retried
+            urls = crawl_state.get_urls(domainName)
+        else:
+            crawler = BoxLunchSitemapCrawler(domain["base_url"], domain["sitemap_url"])
+            print(f"Discovering {domainName} from {domain['sitemap_url']}")
+
+            # streamed: product pages are fetched while the sitemaps are still downloading
+            urls = discover_product_urls(crawler, crawl_state, domainName, incremental)
+
+        if limit is not None and limit >= 0:
+            urls = islice(urls, limit)
+
+        yield from urls
+
+    except Exception as e:
+        # one broken merchant doesn't stop the others, its crawl resumes next run
+        logging.getLogger(__name__).error(f"Error discovering {domainName}: {e}")
+
+def finish_completed_crawls(domains: List[Dict[str, Any]], crawl_state: CrawlState):
+    """
+    Mark the crawls with nothing left to retry finished, the next run of those domains starts a new one
+    """
+    for domain in domains:
+        domainName = domain_name(domain)
+        counts = crawl_state.counts(domainName)
+        print(f"Crawl state of {domainName}: {counts}")
+        if crawl_state.is_discovery_complete(domainName) and not counts.get("pending") and not counts.get("failed"):
+            crawl_state.finish_crawl(domainName)
+
+class CrawlScheduler:
+    def __init__(
+        self,
+        domains: List[Dict[str, Any]],
+        crawl_state: CrawlState,
+        firebase_credentials_path: str,
+        incremental: bool = False,
+        fresh: bool = False,
+        limit: Optional[int] = None,
+        max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+        catalogue_index: Optional[CatalogueIndex] = None
+    ):
+        """
+        Crawls every domain of domains.json at once with one processor, one Firestore
+        client and one HTTP session
+
+        Every domain gets its own concurrency budget and request rate (see domains.json),
+        the crawl engine serves the domains round robin so each gets a fair share of the
+        workers. The global concurrency is the sum of the budgets, so adding merchants
+        adds workers instead of making the run longer.
+
+        Args:
+            domains (list): Entries of domains.json
+            crawl_state (CrawlState): Crawl state shared by every domain
+            firebase_credentials_path (str): Path to Firebase credentials JSON file
+            incremental (bool): Only fetch new product pages and pages with a newer <lastmod>
+            fresh (bool): Start new crawls instead of resuming interrupted ones
+            limit (int): Max product URLs crawled per domain (for testing)
+            max_concurrency (int): Cap of the global concurrency
+            catalogue_index (CatalogueIndex): Local search index, updated as the products are stored
+        """
+        self.domains = domains
+        self.crawl_state = crawl_state
+        self.incremental = incremental
+        self.fresh = fresh
+        self.limit = limit
+        self.logger = logging.getLogger(__name__)
+
+        # politeness limits of every domain (see domains.json)
+        self.domain_settings = get_domain_settings(domains)
+        budget = sum(settings.get("max_concurrency", DOMAIN_CONCURRENCY) for settings in self.domain_settings.values())
+        self.concurrency = max(1, min(max_concurrency, budget))
+
+        # the crawl state also keeps the content hashes, unchanged products are not written again
+        self.processor = ProductProcessor(
+            firebase_credentials_path,
+            crawl_settings={"domain_settings": self.domain_settings, "concurrency": self.concurrency},
+            hash_store=crawl_state,
+            catalogue_index=catalogue_index
+        )
+
+    def domain_urls(self, domain: Dict[str, Any]) -> Iterator[str]:
+        # runs in the crawl engine's reader threads, so the domains are discovered in parallel
+        return domain_product_urls(domain, self.crawl_state, incremental=self.incremental, fresh=self.fresh, limit=self.limit)
+
+    def run(self) -> Dict[str, Dict[str, str]]:
+        """
+        Crawl every domain
+
+        Returns:
+            dict: Mapping of URLs to their variant results
+        """
+        sources = [self.domain_urls(domain) for domain in self.domains]
+        try:
+            results = asyncio.run(self.processor.process_url_sources_async(sources, self.crawl_state))
+        finally:
+            self.processor.close()
+
+        finish_completed_crawls(self.domains, self.crawl_state)
+
+        return results
@@ -0,0 +1,299 @@
+import sqlite3
+import threading
+import time
+import logging
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+QUEUED = 'queued'
+LEASED = 'leased'
+DONE = 'done'
+# ran out of attempts
+DEAD = 'dead'
+
+# a leased task not acked within this time is delivered to another worker
+VISIBILITY_TIMEOUT = 600
+MAX_ATTEMPTS = 5
+# delay before a nacked task can be leased again
+RETRY_DELAY = 30
+# seconds a connection waits for another process' write lock
+BUSY_TIMEOUT = 30
+
+class Task(NamedTuple):
+    id: int
+    url: str
+    domain: str
+    attempts: int
+
+class TaskQueue(ABC):
+    """
+    Crawl work queue shared by the discovery and the workers
+
+    Tasks are leased, not popped: a worker that crashes never acks its tasks and they
+    are delivered again once their visibility timeout expires. WorkQueue keeps them in a
+    SQLite file (workers on one host), a networked backend implements the same methods
+    to spread the workers over several hosts.
+    """
+
+    visibility_timeout: float
+
+    @abstractmethod
+    def enqueue(self, domain: str, urls: Iterable[str], batch_size: int = 500) -> int:
+        """Add product URLs, the ones queued or leased are left alone and finished ones are queued again"""
+
+    @abstractmethod
+    def lease(self, worker_id: str, count: int, exclude_domains: Iterable[str] = ()) -> List[Task]:
+        """Lease the next tasks, including the ones whose lease expired"""
+
+    @abstractmethod
+    def extend(self, worker_id: str) -> int:
+        """Renew the leases of every task a worker still holds"""
+
+    @abstractmethod
+    def ack(self, task_id: int, worker_id: str) -> bool:
+        """Mark a task done, False if the worker doesn't hold its lease anymore"""
+
+    @abstractmethod
+    def nack(self, task_id: int, worker_id: str, error: Optional[str] = None) -> bool:
+        """Give a failed task back, False if the worker doesn't hold its lease anymore"""
+
+    @abstractmethod
+    def drain_finished(self, limit: int = 10000) -> List[Tuple[str, str, Optional[str]]]:
+        """Remove the finished tasks, as (url, status, last error)"""
+
+    @abstractmethod
+    def stats(self) -> Dict[str, int]:
+        """Amount of tasks per status"""
+
+    def close(self):
+        pass
+
+class WorkQueue(TaskQueue):
+    def __init__(
+        self,
+        path: str,
+        visibility_timeout: float = VISIBILITY_TIMEOUT,
+        max_attempts: int = MAX_ATTEMPTS,
+        retry_delay: float = RETRY_DELAY
+    ):
+        """
+        TaskQueue in a SQLite file, shared by any number of worker processes
+
+        Every process opens its own WorkQueue on the same file. The file uses WAL, which needs memory shared by every
+        process: they must run on the same host, with the file on a local disk (not a network
+        filesystem).
+
+        Args:
+            path (str): Path to the SQLite file
+            visibility_timeout (float): Seconds a leased task is hidden from other workers
+            max_attempts (int): Leases after which a failing task is dead
+            retry_delay (float): Seconds before a nacked task can be leased again
+        """
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+        # autocommit, transactions are explicit so leasing can take the write lock up front
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL UNIQUE,
+                domain TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                lease_owner TEXT,
+                last_error TEXT,
+                updated_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS tasks_status_seq ON tasks (status, seq);
+            """
+        )
+
+    def close(self):
+        self.conn.close()
+
+    def enqueue(self, domain: str, urls: Iterable[str], batch_size: int = 500) -> int:
+        """
+        Add product URLs to the queue, URLs already queued or leased are left alone and
+        finished ones are queued again
+
+        Args:
+            domain (str): Domain of the URLs
+            urls (iterable): Product URLs, can be a generator
+            batch_size (int): URLs per transaction
+
+        Returns:
+            int: Amount of URLs enqueued
+        """
+        enqueued = 0
+        batch = []
+        for url in urls:
+            batch.append(url)
+            if len(batch) >= batch_size:
+                enqueued += self._enqueue_batch(domain, batch)
+                batch = []
+        if batch:
+            enqueued += self._enqueue_batch(domain, batch)
+        return enqueued
+
+    def _enqueue_batch(self, domain: str, urls: List[str]) -> int:
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                # position within the domain, leasing by it interleaves the domains
+                seq = self.conn.execute('SELECT COALESCE(MAX(seq), 0) FROM tasks WHERE domain = ?', (domain,)).fetchone()[0]
+                self.conn.executemany(
+                    """
+                    INSERT INTO tasks (url, domain, seq, status, available_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(url) DO UPDATE SET
+                        status = excluded.status, seq = excluded.seq, attempts = 0, available_at = excluded.available_at,
+                        lease_owner = NULL, last_error = NULL, updated_at = excluded.updated_at
+                    WHERE tasks.status IN (?, ?)
+                    """,
+                    [(url, domain, seq + i + 1, QUEUED, now, now, DONE, DEAD) for i, url in enumerate(urls)]
+                )
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return len(urls)
+
+    def lease(self, worker_id: str, count: int, exclude_domains: Iterable[str] = ()) -> List[Task]:
+        """
+        Lease the next tasks, including the ones whose lease expired (their worker crashed)
+
+        Args:
+            worker_id (str): Id of the leasing worker
+            count (int): Max amount of tasks
+            exclude_domains (iterable): Domains the worker doesn't crawl (no share of their limits)
+
+        Returns:
+            list: Leased tasks, domains interleaved
+        """
+        now = time.time()
+        exclude_domains = list(exclude_domains)
+        excluded = f"AND domain NOT IN ({', '.join('?' * len(exclude_domains))})" if exclude_domains else ""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                # tasks that keep crashing their workers are not delivered forever
+                self.conn.execute(
+                    'UPDATE tasks SET status = ?, last_error = ?, updated_at = ? WHERE status = ? AND available_at <= ? AND attempts >= ?',
+                    (DEAD, 'lease expired', now, LEASED, now, self.max_attempts)
+                )
+                rows = self.conn.execute(
+                    """
+                    SELECT id, url, domain, attempts FROM tasks
+                    WHERE status IN (?, ?) AND available_at <= ? {excluded}
+                    ORDER BY seq, id
+                    LIMIT ?
+                    """.format(excluded=excluded),
+                    (QUEUED, LEASED, now, *exclude_domains, count)
+                ).fetchall()
+                tasks = [Task(id, url, domain, attempts + 1) for id, url, domain, attempts in rows]
+                self.conn.executemany(
+                    """
+                    UPDATE tasks SET status = ?, attempts = attempts + 1, available_at = ?, lease_owner = ?, updated_at = ?
+                    WHERE id = ?
+                    """,
+                    [(LEASED, now + self.visibility_timeout, worker_id, now, task.id) for task in tasks]
+                )
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return tasks
+
+    def extend(self, worker_id: str) -> int:
+        """
+        Renew the leases of every task a worker still holds, so a live worker keeps them
+
+        Returns:
+            int: Amount of renewed leases
+        """
+        now = time.time()
+        with self.lock:
+            return self.conn.execute(
+                'UPDATE tasks SET available_at = ?, updated_at = ? WHERE status = ? AND lease_owner = ?',
+                (now + self.visibility_timeout, now, LEASED, worker_id)
+            ).rowcount
+
+    def ack(self, task_id: int, worker_id: str) -> bool:
+        """
+        Mark a task done
+
+        Returns:
+            bool: False if the worker lost the lease (it expired and the task went to another worker)
+        """
+        with self.lock:
+            return self.conn.execute(
+                """
+                UPDATE tasks SET status = ?, lease_owner = NULL, last_error = NULL, updated_at = ?
+                WHERE id = ? AND status = ? AND lease_owner = ?
+                """,
+                (DONE, time.time(), task_id, LEASED, worker_id)
+            ).rowcount > 0
+
+    def nack(self, task_id: int, worker_id: str, error: Optional[str] = None) -> bool:
+        """
+        Give a failed task back, it is retried after retry_delay unless it ran out of attempts
+
+        Returns:
+            bool: False if the worker lost the lease (it expired and the task went to another worker)
+        """
+        now = time.time()
+        with self.lock:
+            return self.conn.execute(
+                """
+                UPDATE tasks SET
+                    status = CASE WHEN attempts >= ? THEN ? ELSE ? END,
+                    available_at = ?, lease_owner = NULL, last_error = ?, updated_at = ?
+                WHERE id = ? AND status = ? AND lease_owner = ?
+                """,
+                (self.max_attempts, DEAD, QUEUED, now + self.retry_delay, error, now, task_id, LEASED, worker_id)
+            ).rowcount > 0
+
+    def drain_finished(self, limit: int = 10000) -> List[Tuple[str, str, Optional[str]]]:
+        """
+        Remove finished tasks (done or dead) from the queue, to report them back to the crawl state
+
+        Returns:
+            list: (url, status, last error) of the removed tasks
+        """
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.conn.execute(
+                    'SELECT id, url, status, last_error FROM tasks WHERE status IN (?, ?) ORDER BY id LIMIT ?',
+                    (DONE, DEAD, limit)
+                ).fetchall()
+                self.conn.executemany('DELETE FROM tasks WHERE id = ?', [(row[0],) for row in rows])
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return [(url, status, error) for _, url, status, error in rows]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the amount of tasks per status, leases that expired are counted as 'expired'
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                """
+                SELECT CASE WHEN status = ? AND available_at <= ? THEN 'expired' ELSE status END, COUNT(*)
+                FROM tasks GROUP BY 1
+                """,
+                (LEASED, time.time())
+            ).fetchall()
+        return {status: count for status, count in rows}
@@ -0,0 +1,103 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+PARSE_EXECUTOR_MODES = ("process", "thread", "inline")
+
+class ParseExecutor:
+    def __init__(self, mode="thread", max_workers=None):
+        """
+        Runs the page scanning and parsing off the event loop
+
+        Threads are the default, they keep the event loop free but share the GIL with
+        it. Use "process" on multi-core deployments where the parsing is CPU-bound, the
+        pages are pickled to the workers.
+
+        Args:
+            mode (str): "thread", "process" (parsing spread over the cores) or "inline" (on the event loop)
+            max_workers (int): Amount of workers, defaults to the amount of cores
+        """
+        if mode not in PARSE_EXECUTOR_MODES:
+            raise ValueError(f"Unknown parse executor mode: {mode}")
+
+        self.mode = mode
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.executor = None
+        self.counters = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "poolRestarts": 0,
+        }
+
+    def start(self):
+        """
+        Create the worker pool, called once at app startup
+        """
+        if self.executor is not None or self.mode == "inline":
+            return
+
+        if self.mode == "process":
+            # spawn so the workers don't inherit the grpc / aiohttp state of the app
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="parse")
+
+    def close(self):
+        """
+        Shut the worker pool down, called once at app shutdown
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = None
+
+    async def run(self, function, *args):
+        """
+        Run a parse function on a worker as soon as a page arrives
+
+        The function has to be importable by the workers (not defined in main.py)
+        in process mode. Its exceptions are raised to the caller like an inline call.
+
+        Args:
+            function: Parse function to run
+            *args: Arguments of the function
+
+        Returns:
+            The result of the function
+        """
+        self.counters["submitted"] += 1
+        try:
+            if self.mode == "inline" or self.executor is None:
+                result = function(*args)
+            else:
+                loop = asyncio.get_running_loop()
+                executor = self.executor
+                try:
+                    result = await loop.run_in_executor(executor, function, *args)
+                except BrokenProcessPool:
+                    # a worker died, start a new pool (once, other callers may have hit the same broken one) and parse this page here
+                    if self.executor is executor:
+                        self.counters["poolRestarts"] += 1
+                        self.close()
+                        self.start()
+                    result = function(*args)
+        except Exception:
+            self.counters["failed"] += 1
+            raise
+
+        self.counters["completed"] += 1
+        return result
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "workers": self.max_workers if self.mode != "inline" else 0,
+            "running": self.executor is not None,
+            "inProgress": self.counters["submitted"] - self.counters["completed"] - self.counters["failed"],
+            **self.counters,
+        }
@@ -0,0 +1,161 @@
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+PRODUCT_CACHE_PATH = "product_cache.sqlite3"
+PRODUCT_CACHE_MAX_ENTRIES = 10000
+PRODUCT_CACHE_FRESH_FOR = 900
+
+def _encode(value):
+    # product dicts carry a datetime (timeCreated)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class ProductPageCache:
+    def __init__(self, path=PRODUCT_CACHE_PATH, max_entries=PRODUCT_CACHE_MAX_ENTRIES, fresh_for=PRODUCT_CACHE_FRESH_FOR):
+        """
+        Persistent cache of the products extracted from each context URL
+
+        Entries keep the ETag / Last-Modified of the page so stale entries can be
+        revalidated with a conditional request instead of re-downloading and re-parsing.
+
+        Args:
+            path (str): Path to the SQLite file
+            max_entries (int): Max cached pages before the least recently used are evicted
+            fresh_for (int): Seconds an entry is used without asking the merchant at all
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.fresh_for = fresh_for
+        self.lock = threading.Lock()
+        self.counters = {
+            "freshHits": 0,
+            "revalidated": 0,
+            "misses": 0,
+            "bypassed": 0,
+            "stored": 0,
+            "evictions": 0,
+        }
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # commits are not fsynced one by one, a crash can only lose the last few entries
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS product_pages (
+                url TEXT PRIMARY KEY,
+                products TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS product_pages_last_access ON product_pages (last_access)")
+        self.conn.commit()
+
+    def get(self, url):
+        """
+        Get the cached entry of a page
+
+        Args:
+            url (str): Context URL
+
+        Returns:
+            dict: products, etag, lastModified and fetchedAt, or None if not cached
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT products, etag, last_modified, fetched_at FROM product_pages WHERE url = ?", (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE product_pages SET last_access = ? WHERE url = ?", (time.time(), url))
+            self.conn.commit()
+
+        products, etag, last_modified, fetched_at = row
+        return {
+            "products": json.loads(products),
+            "etag": etag,
+            "lastModified": last_modified,
+            "fetchedAt": fetched_at,
+        }
+
+    def is_fresh(self, entry):
+        return time.time() - entry["fetchedAt"] < self.fresh_for
+
+    def conditional_headers(self, entry):
+        """
+        Get the headers to revalidate a cached entry
+
+        Args:
+            entry (dict): Entry returned by get()
+
+        Returns:
+            dict: If-None-Match / If-Modified-Since headers (empty if we have neither)
+        """
+        headers = {}
+        if entry is None:
+            return headers
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["lastModified"]:
+            headers["If-Modified-Since"] = entry["lastModified"]
+        return headers
+
+    def set(self, url, products, etag=None, last_modified=None):
+        """
+        Store the products extracted from a page
+
+        Args:
+            url (str): Context URL
+            products (list): Product dicts extracted from the page
+            etag (str): ETag header of the response
+            last_modified (str): Last-Modified header of the response
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO product_pages (url, products, etag, last_modified, fetched_at, last_access)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (url, json.dumps(products, default=_encode), etag, last_modified, now, now)
+            )
+            self.counters["stored"] += 1
+
+            overflow = self.conn.execute("SELECT COUNT(*) FROM product_pages").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                self.conn.execute(
+                    "DELETE FROM product_pages WHERE url IN (SELECT url FROM product_pages ORDER BY last_access LIMIT ?)",
+                    (overflow,)
+                )
+                self.counters["evictions"] += overflow
+            self.conn.commit()
+
+    def touch(self, url):
+        """
+        Restart the freshness window of a page after the merchant answered 304
+
+        Args:
+            url (str): Context URL
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute("UPDATE product_pages SET fetched_at = ?, last_access = ? WHERE url = ?", (now, now, url))
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM product_pages").fetchone()[0]
+        return {
+            "path": self.path,
+            "entries": entries,
+            "maxEntries": self.max_entries,
+            "freshFor": self.fresh_for,
+            **self.counters,
+        }
@@ -0,0 +1,99 @@
+from datetime import datetime
+from pydantic import BaseModel
+import json
+from uuid import uuid5, NAMESPACE_DNS
+from urllib.parse import urlparse
+from merchant_crawler.jsonld_extractor import extract_json_ld_scripts, iter_json_ld_products, resolve_image
+
+# kept out of main.py so the parse workers can import it without starting the app
+
+# products class
+class Product(BaseModel):
+    productId: str
+    id: str
+    url: str
+    title: str
+    imageURL: str
+    description: str
+    price: float
+    seller: str
+    isOriginal: bool
+    offerType: str
+    priceCurrency: str
+    timeCreated: datetime
+    availability: str
+
+def get_seller_from_url(url):
+    parsed_url = urlparse(url)
+    domain = parsed_url.netloc
+    return domain
+
+def extract_json_ld(html, url, encoding="utf-8"):
+    # html as str, or the raw page bytes in the given encoding (scanned and parsed in one job)
+    return extract_json_ld_from_scripts(extract_json_ld_scripts(html, encoding), url)
+
+def get_product_key(product, group, offer, url):
+    # variants usually have no @id of their own, fall back to the group / offer url + sku
+    if product.get("@id"):
+        return product["@id"]
+
+    base = (group or {}).get("@id") or product.get("url") or offer.get("url") or url
+    sku = product.get("sku")
+    return f"{base}#{sku}" if sku else base
+
+def build_product(product, group, offer, url):
+    group = group or {}
+    key = get_product_key(product, group, offer, url)
+
+    # get the seller
+    seller = "Unknown Seller"
+
+    if product.get("@id") or group.get("@id"):
+        seller = get_seller_from_url(key)
+
+    # create a new product object, variants fall back to their group's info
+    return Product(
+        id=key,
+        productId=uuid5(NAMESPACE_DNS, key).hex,
+        url=url,
+        title=product.get("name") or group.get("name") or "No Title",
+        imageURL=resolve_image(product.get("image")) or resolve_image(group.get("image")) or "No Image URL",
+        description=product.get("description") or group.get("description") or "No Description",
+        price=offer.get("price", -1.0) if offer.get("price") is not None else -1.0,
+        seller=seller,
+        isOriginal=product.get("isOriginal", False),
+        offerType=offer.get("@type", "Unknown Offer Type"),
+        priceCurrency=offer.get("priceCurrency", "USD"),
+        timeCreated=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        availability=offer.get("availability", "Unknown Availability")
+    )
+
+def extract_json_ld_from_scripts(scripts, url):
+    json_ld = []
+    for script in scripts:
+        try:
+            data = json.loads(script)
+        except (json.JSONDecodeError, TypeError) as e:
+            print(f"Error parsing JSON-LD for {url}, Error Message: {e}\n")
+            print("Skipping...")
+            continue
+
+        # every Product / ProductGroup variant in the document (@graph, arrays, nested nodes)
+        products = list(iter_json_ld_products(data))
+
+        # we only care about Products and Organizations (TODO: Add Logic for Organizations)
+        if not products:
+            print(f"Skipping {url} because it is not a product...")
+            continue
+
+        for product, group, offer in products:
+            try:
+                productObject = build_product(product, group, offer, url)
+            except Exception as e:
+                print(f"Error creating product for {url}, Error Message: {e}\n")
+                print("Skipping...")
+                continue
+
+            print(f"===Extracted JSON-LD for URL: {url}===\n")
+            json_ld.append(productObject.__dict__)
+    return json_ld
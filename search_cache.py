@@ -0,0 +1,246 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+SEARCH_CACHE_TTL = 3600
+SEARCH_CACHE_MAX_ENTRIES = 1000
+SEARCH_CACHE_PATH = "search_cache.sqlite3"
+
+class MemoryCacheBackend:
+    # get / set never wait on I/O, they run on the event loop
+    blocking = False
+
+    def __init__(self, max_entries=SEARCH_CACHE_MAX_ENTRIES):
+        """
+        In-process LRU cache, entries expire after their own TTL
+
+        Args:
+            max_entries (int): Max entries kept before the least recently used is evicted
+        """
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        if expires_at < time.time():
+            del self.entries[key]
+            return None
+
+        # mark as most recently used
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl):
+        self.entries[key] = (value, time.time() + ttl)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "entries": len(self.entries),
+            "maxEntries": self.max_entries,
+            "evictions": self.evictions,
+        }
+
+class SQLiteCacheBackend:
+    # get / set read and write the file, they run in a worker thread
+    blocking = True
+
+    def __init__(self, path=SEARCH_CACHE_PATH, max_entries=SEARCH_CACHE_MAX_ENTRIES):
+        """
+        LRU cache stored in a local SQLite file so it survives restarts
+
+        Args:
+            path (str): Path to the SQLite file
+            max_entries (int): Max entries kept before the least recently used are evicted
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS search_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS search_cache_last_access ON search_cache (last_access)")
+        self.conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, expires_at FROM search_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            value, expires_at = row
+            if expires_at < now:
+                self.conn.execute("DELETE FROM search_cache WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+
+            self.conn.execute("UPDATE search_cache SET last_access = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+        return json.loads(value)
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO search_cache (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + ttl, now)
+            )
+
+            # drop expired entries first, then the least recently used ones
+            self.conn.execute("DELETE FROM search_cache WHERE expires_at < ?", (now,))
+            overflow = self.conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                self.conn.execute(
+                    "DELETE FROM search_cache WHERE key IN (SELECT key FROM search_cache ORDER BY last_access LIMIT ?)",
+                    (overflow,)
+                )
+                self.evictions += overflow
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM search_cache")
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "entries": entries,
+            "maxEntries": self.max_entries,
+            "evictions": self.evictions,
+        }
+
+class SearchPageCache:
+    def __init__(self, backend, ttl=SEARCH_CACHE_TTL):
+        """
+        Cache in front of the Custom Search pages, keyed by (query, start)
+
+        Identical requests that are already in flight share the same upstream call.
+
+        Args:
+            backend: MemoryCacheBackend or SQLiteCacheBackend
+            ttl (int): Seconds a page stays cached
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(query, start):
+        return f"{start}:{query}"
+
+    async def get_or_fetch(self, query, start, fetch):
+        """
+        Get a page from the cache, or fetch it once for every waiting caller
+
+        Args:
+            query (str): Search query
+            start (int): Index of the first result on the page
+            fetch: Coroutine function returning the page results on a miss
+
+        Returns:
+            list: Raw search result items
+        """
+        key = self.make_key(query, start)
+
+        cached = await self._call_backend(self.backend.get, key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch_and_store(key, fetch))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+
+        # shield so one caller going away doesn't cancel the fetch for the others
+        return await asyncio.shield(task)
+
+    async def _fetch_and_store(self, key, fetch):
+        value = await fetch()
+        # errors are raised to every waiter and never cached
+        await self._call_backend(self.backend.set, key, value, self.ttl)
+        return value
+
+    async def _call_backend(self, function, *args):
+        if self.backend.blocking:
+            return await asyncio.to_thread(function, *args)
+        return function(*args)
+
+    def _finish(self, key, task):
+        self.in_flight.pop(key, None)
+        if not task.cancelled():
+            # mark the exception as retrieved, the waiters already got it
+            task.exception()
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "inFlight": len(self.in_flight),
+            "hitRate": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+            "ttl": self.ttl,
+            **self.backend.stats(),
+        }
+
+def create_search_cache(backend="memory", ttl=SEARCH_CACHE_TTL, max_entries=SEARCH_CACHE_MAX_ENTRIES, path=SEARCH_CACHE_PATH):
+    """
+    Build the search cache from its configuration
+
+    Args:
+        backend (str): "memory", "sqlite" or "none"
+        ttl (int): Seconds a page stays cached
+        max_entries (int): Max cached pages
+        path (str): SQLite file, only used by the sqlite backend
+
+    Returns:
+        SearchPageCache: The cache, or None when caching is disabled
+    """
+    if backend == "none":
+        return None
+    if backend == "memory":
+        return SearchPageCache(MemoryCacheBackend(max_entries), ttl)
+    if backend == "sqlite":
+        return SearchPageCache(SQLiteCacheBackend(path, max_entries), ttl)
+    raise ValueError(f"Unknown search cache backend: {backend}")
@@ -0,0 +1,127 @@
+import asyncio
+import aiohttp
+from fastapi import HTTPException
+
+GOOGLE_CUSTOM_SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
+SEARCH_TIMEOUT = 10
+SEARCH_MAX_CONNECTIONS = 20
+
+def get_page_starts(pages):
+    """
+    Get the `start` parameter for every page we query
+
+    Args:
+        pages (int): Amount of pages to query
+
+    Returns:
+        list: Start index of each page, in the order the results are returned
+    """
+    # first page starts at 1, every page after that at (page * 10)
+    return [1] + [i * 10 for i in range(2, pages + 1)]
+
+class GoogleSearchClient:
+    def __init__(self, api_key, search_engine_id, timeout=SEARCH_TIMEOUT, max_connections=SEARCH_MAX_CONNECTIONS, cache=None):
+        """
+        Async Google Custom Search client that shares one pooled session
+
+        Args:
+            api_key (str): Google API key
+            search_engine_id (str): Custom Search engine id (cx)
+            timeout (int): Total timeout for a single page request in seconds
+            max_connections (int): Max connections kept in the pool
+            cache (SearchPageCache): Optional cache in front of the pages
+        """
+        self.api_key = api_key
+        self.search_engine_id = search_engine_id
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.cache = cache
+        self.session = None
+
+    async def start(self):
+        """
+        Create the pooled session, called once at app startup
+        """
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+
+    async def close(self):
+        """
+        Close the pooled session, called once at app shutdown
+        """
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def search_page(self, query, start):
+        """
+        Get a single page of image search results, from the cache when possible
+
+        Args:
+            query (str): Search query
+            start (int): Index of the first result on the page
+
+        Returns:
+            list: Raw search result items
+        """
+        if self.cache is None:
+            return await self.fetch_page(query, start)
+        return await self.cache.get_or_fetch(query, start, lambda: self.fetch_page(query, start))
+
+    async def fetch_page(self, query, start):
+        """
+        Fetch a single page of image search results from Google
+
+        Args:
+            query (str): Search query
+            start (int): Index of the first result on the page
+
+        Returns:
+            list: Raw search result items
+        """
+        print(f"Starting at page {start}")
+        try:
+            await self.start()
+            params = {
+                "key": self.api_key,
+                "cx": self.search_engine_id,
+                "q": query,
+                "searchType": "image",
+                "num": 10,
+                "start": start
+            }
+            # requests used to drop unset params, aiohttp refuses them
+            params = {key: value for key, value in params.items() if value is not None}
+            async with self.session.get(GOOGLE_CUSTOM_SEARCH_URL, params=params) as response:
+                response.raise_for_status()
+                data = await response.json()
+
+            raw_search_results = data.get("items", [])
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+        return raw_search_results
+
+    async def search(self, query, pages):
+        """
+        Fetch all the requested pages concurrently
+
+        Args:
+            query (str): Search query
+            pages (int): Amount of pages to query
+
+        Returns:
+            list: Raw search result items, in page order
+        """
+        tasks = [self.search_page(query, start) for start in get_page_starts(pages)]
+        pages_results = await asyncio.gather(*tasks)
+
+        # flatten while keeping the page order
+        raw_search_results = []
+        for page_results in pages_results:
+            raw_search_results.extend(page_results)
+        return raw_search_results